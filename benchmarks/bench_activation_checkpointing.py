@@ -0,0 +1,173 @@
+"""
+Memory against throughput for the activation checkpointing policies of
+`llava_phi.model.activation_checkpointing`.  The step is set up like the reasoning stage:
+Phi frozen, CLIP tower and fusion head trained.
+
+    python -m benchmarks.bench_activation_checkpointing --batch-sizes 2 4 8
+    python -m benchmarks.bench_activation_checkpointing --model-path checkpoints/dual-view-slava-merged \
+        --device cuda --dtype bfloat16 --batch-sizes 2 4 8 --output-file checkpointing.json
+
+Without `--model-path`, the random-weight model of `benchmarks.tiny_model` is used, with a
+deeper CLIP tower at 224 px so that the vision activations dominate as they do in the full
+model.  For every policy and batch size, the table shows:
+- the activation bytes saved for backward on the device, counted with saved-tensor hooks,
+  so the number also means something on CPU;
+- the peak allocated memory (CUDA only);
+- the median training step time and samples/s.
+"""
+import argparse
+import json
+import statistics
+import time
+
+import torch
+
+from llava_phi.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from llava_phi.model.activation_checkpointing import configure_activation_checkpointing
+
+MB = 2 ** 20
+POLICIES = {
+    "none": {},
+    "vision_every_1": {"vision_every": 1},
+    "vision_every_2": {"vision_every": 2},
+    "vision_every_4": {"vision_every": 4},
+    "fusion": {"fusion": True},
+    "vision_every_1+fusion": {"vision_every": 1, "fusion": True},
+    "vision_every_2+offload": {"vision_every": 2, "offload": ("vision_tower",)},
+    "offload": {"offload": ("vision_tower", "fusion")},
+}
+TRAINED_MODULES = ("vision_tower", "med_feature_adapter", "cross_attention", "norm", "fuse_gate", "mm_projector")
+
+
+class SavedActivationCounter:
+    """Bytes of the non-parameter tensors saved for backward outside any inner hooks (checkpoint, offload)."""
+
+    def __init__(self, model):
+        self.param_storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+        self.storages = {}
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in self.param_storages and tensor.device.type != "meta":
+            self.storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    @staticmethod
+    def unpack(tensor):
+        return tensor
+
+    @property
+    def nbytes(self):
+        return sum(self.storages.values())
+
+
+def load_model(args):
+    if args.model_path:
+        from llava_phi.mm_utils import get_model_name_from_path
+        from llava_phi.model.builder import load_pretrained_model
+
+        _, model, _, _ = load_pretrained_model(args.model_path, args.model_base,
+                                               get_model_name_from_path(args.model_path),
+                                               device_map=args.device, device=args.device)
+    else:
+        from benchmarks.tiny_model import build_tiny_model
+
+        model = build_tiny_model(vision_layers=args.vision_layers, image_size=args.image_size).to(args.device)
+    model = model.to(dtype=getattr(torch, args.dtype))
+    model.train()
+    model.get_model().requires_grad_(False)
+    for name in TRAINED_MODULES:
+        getattr(model.get_model(), name).requires_grad_(True)
+    return model
+
+
+def make_batch(model, batch_size, seq_len, device):
+    image_size = model.config.vision_config["vision_tower"]["image_size"]
+    input_ids = torch.randint(0, model.config.vocab_size, (batch_size, seq_len), device=device)
+    input_ids[:, 1] = IMAGE_TOKEN_INDEX
+    labels = input_ids.clone()
+    labels[:, :2] = IGNORE_INDEX
+    images = torch.randn(batch_size, 2, 3, image_size, image_size, device=device, dtype=model.dtype)
+    return dict(input_ids=input_ids, attention_mask=torch.ones_like(input_ids, dtype=torch.bool),
+                labels=labels, images=images)
+
+
+def run_policy(model, optimizer, policy, batch, steps):
+    configure_activation_checkpointing(model, **policy)
+    cuda = batch["input_ids"].is_cuda
+    times, saved = [], 0
+    if cuda:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+    for step in range(steps + 1):  # the first step is warmup
+        counter = SavedActivationCounter(model)
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.autograd.graph.saved_tensors_hooks(counter.pack, counter.unpack):
+            loss = model(**batch).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        if cuda:
+            torch.cuda.synchronize()
+        if step:
+            times.append(time.perf_counter() - start)
+            saved = max(saved, counter.nbytes)
+    result = {"saved_activations_mb": saved / MB, "step_ms": 1000 * statistics.median(times),
+              "samples_per_s": batch["input_ids"].shape[0] / statistics.median(times)}
+    if cuda:
+        result["peak_allocated_mb"] = torch.cuda.max_memory_allocated() / MB
+    return result
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = load_model(args)
+    optimizer = torch.optim.SGD([p for p in model.parameters() if p.requires_grad], lr=1e-6)
+    policies = args.policies or list(POLICIES)
+    results = []
+    for batch_size in args.batch_sizes:
+        batch = make_batch(model, batch_size, args.seq_len, args.device)
+        for name in policies:
+            try:
+                result = run_policy(model, optimizer, POLICIES[name], batch, args.steps)
+            except torch.cuda.OutOfMemoryError as e:
+                result = {"oom": str(e).splitlines()[0]}
+                optimizer.zero_grad(set_to_none=True)
+            results.append(dict(policy=name, batch_size=batch_size, **result))
+
+    print(f"{'policy':<24} {'batch':>5} {'saved MB':>10} {'peak MB':>10} {'step ms':>10} {'samples/s':>10}")
+    for r in results:
+        if "oom" in r:
+            print(f"{r['policy']:<24} {r['batch_size']:>5} {'OOM':>10}")
+            continue
+        peak = f"{r['peak_allocated_mb']:>10.1f}" if "peak_allocated_mb" in r else f"{'-':>10}"
+        print(f"{r['policy']:<24} {r['batch_size']:>5} {r['saved_activations_mb']:>10.1f} {peak} "
+              f"{r['step_ms']:>10.1f} {r['samples_per_s']:>10.2f}")
+
+    if args.output_file:
+        settings = {k: v for k, v in vars(args).items() if k != "output_file"}
+        with open(args.output_file, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2)
+        print(f"Saved to {args.output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, default=None, help="default: the tiny random-weight model")
+    parser.add_argument("--model-base", type=str, default=None)
+    parser.add_argument("--vision-layers", type=int, default=8, help="tiny model only")
+    parser.add_argument("--image-size", type=int, default=224, help="tiny model only")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16", "float16"])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--seq-len", type=int, default=256)
+    parser.add_argument("--policies", type=str, nargs="+", default=None, choices=list(POLICIES))
+    parser.add_argument("--steps", type=int, default=3, help="timed steps per policy, after one warmup step")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--output-file", type=str, default=None)
+    args = parser.parse_args()
+
+    main(args)
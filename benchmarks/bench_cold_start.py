@@ -0,0 +1,117 @@
+"""
+Cold-start benchmark: seconds from process launch to the first generated token, and peak RSS.
+
+Every run is a fresh interpreter, so imports, weight loading and the first forward are all
+included.  Compares the regular LoRA path with a checkpoint written by
+`python -m llava_phi.model.merged_checkpoint`, loaded both lazily (meta device, parallel
+shard reads) and eagerly (full model built first, shards copied in):
+
+    python -m benchmarks.bench_cold_start \
+        --model-path checkpoints/dual-view-slava-lora --model-base checkpoints/llavaPhi-v0-3b-pretrain \
+        --merged-path checkpoints/dual-view-slava-merged --frontal f.png --lateral l.png
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def child(args):
+    start = time.perf_counter()
+    import torch
+    from PIL import Image
+
+    from llava_phi.constants import DEFAULT_IMAGE_TOKEN, IMAGE_TOKEN_INDEX
+    from llava_phi.conversation import conv_templates
+    from llava_phi.mm_utils import get_model_name_from_path, process_images, tokenizer_image_token
+    from llava_phi.model.builder import load_pretrained_model
+    from llava_phi.model.merged_checkpoint import load_merged_model
+    from llava_phi.utils import disable_torch_init
+    import_s = time.perf_counter() - start
+
+    disable_torch_init()
+    if args.eager:
+        tokenizer, model, image_processor, _ = load_merged_model(args.model_path, device=args.device, lazy=False)
+    else:
+        model_name = args.model_name or get_model_name_from_path(args.model_path)
+        tokenizer, model, image_processor, _ = load_pretrained_model(
+            args.model_path, args.model_base, model_name, device_map=args.device, device=args.device)
+    load_s = time.perf_counter() - start
+
+    if args.frontal:
+        images = [Image.open(args.frontal).convert("RGB"), Image.open(args.lateral or args.frontal).convert("RGB")]
+    else:
+        images = [Image.new("RGB", (512, 512), 128)] * 2
+    image_tensor = process_images(images, image_processor, model.config).unsqueeze(0)
+    conv = conv_templates[args.conv_mode].copy()
+    conv.append_message(conv.roles[0], DEFAULT_IMAGE_TOKEN + "\n" + args.query)
+    conv.append_message(conv.roles[1], None)
+    input_ids = tokenizer_image_token(conv.get_prompt(), tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0)
+
+    with torch.inference_mode():
+        model.generate(input_ids.to(model.device), images=image_tensor.to(model.device, dtype=model.dtype),
+                       do_sample=False, max_new_tokens=1, pad_token_id=tokenizer.eos_token_id)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    first_token_s = time.perf_counter() - start
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+    print("RESULT " + json.dumps({"import_s": import_s, "load_s": load_s, "first_token_s": first_token_s,
+                                  "peak_rss_mb": peak_rss_mb}))
+
+
+def run(args, model_path, model_base, eager=False):
+    cmd = [sys.executable, "-m", "benchmarks.bench_cold_start", "--child", "--model-path", model_path,
+           "--device", args.device, "--conv-mode", args.conv_mode, "--query", args.query]
+    for flag, value in (("--model-base", model_base), ("--model-name", args.model_name),
+                        ("--frontal", args.frontal), ("--lateral", args.lateral)):
+        if value:
+            cmd += [flag, value]
+    if eager:
+        cmd.append("--eager")
+    start = time.perf_counter()
+    out = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+    result = json.loads(next(line for line in out.splitlines() if line.startswith("RESULT "))[len("RESULT "):])
+    result["wall_s"] = time.perf_counter() - start
+    return result
+
+
+def main(args):
+    variants = {"lora": (args.model_path, args.model_base, False)}
+    if args.merged_path:
+        variants["merged_eager"] = (args.merged_path, None, True)
+        variants["merged"] = (args.merged_path, None, False)
+    summary = {}
+    for name, (model_path, model_base, eager) in variants.items():
+        runs = [run(args, model_path, model_base, eager) for _ in range(args.runs)]
+        summary[name] = {key: float(np.median([r[key] for r in runs])) for key in runs[0]}
+        print(name, json.dumps(summary[name]))
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump({"args": vars(args), "median": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--model-base", type=str, default=None)
+    parser.add_argument("--model-name", type=str, default=None)
+    parser.add_argument("--merged-path", type=str, default=None)
+    parser.add_argument("--frontal", type=str, default=None)
+    parser.add_argument("--lateral", type=str, default=None)
+    parser.add_argument("--query", type=str, default="Generate a radiology report for these chest X-rays.")
+    parser.add_argument("--conv-mode", type=str, default="v0")
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--output-file", type=str, default=None)
+    parser.add_argument("--child", action="store_true")
+    parser.add_argument("--eager", action="store_true")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+    else:
+        main(args)
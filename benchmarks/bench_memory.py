@@ -0,0 +1,134 @@
+"""
+Peak memory of a training step (forward, backward, optimizer step) over a grid of batch
+sizes and sequence lengths:
+
+    python -m benchmarks.bench_memory --batch-sizes 1 2 4 --seq-lens 256 512 1024 2048 \
+        --output-file memory_grid.json
+    python -m benchmarks.bench_memory --model-path checkpoints/dual-view-slava-merged \
+        --device cuda --dtype bfloat16 --gradient-checkpointing --batch-sizes 1 2 --seq-lens 1024 2048
+
+Without `--model-path`, the random-weight model of `benchmarks.tiny_model` is used, so the
+grid also runs offline on CPU.  Each configuration runs in a fresh process, so neither the
+process RSS nor a CUDA OOM carries over between configurations.  `MemoryProfiler` is
+active throughout the step, which runs as one `step` range.  Per configuration, the JSON
+holds the peak, the process RSS, the stage breakdown and the modules with the largest
+peaks.  The peak comes from the CUDA allocator, or on CPU from the profiler's count of the
+tensors created during the step (parameters excluded).  The peaks are also printed as a
+batch-size x sequence-length table.
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from llava_phi.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+
+GB = 2 ** 30
+
+
+def load_model(args):
+    if args.model_path:
+        from llava_phi.mm_utils import get_model_name_from_path
+        from llava_phi.model.builder import load_pretrained_model
+
+        _, model, _, _ = load_pretrained_model(args.model_path, args.model_base,
+                                               get_model_name_from_path(args.model_path),
+                                               device_map=args.device, device=args.device)
+    else:
+        from benchmarks.tiny_model import build_tiny_model
+
+        model = build_tiny_model(image_size=args.image_size).to(args.device)
+    return model.to(dtype=getattr(torch, args.dtype))
+
+
+def run_config(args, batch_size, seq_len):
+    from llava_phi.profiling import enable_profiling
+
+    model = load_model(args)
+    model.train()
+    if args.gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+        model.enable_input_require_grads()
+    trainable = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.AdamW(trainable, lr=1e-5)
+
+    vision_config = model.config.vision_config["vision_tower"]
+    image_size = vision_config["image_size"]
+    vocab_size = model.config.vocab_size
+    input_ids = torch.randint(0, vocab_size, (batch_size, seq_len), device=args.device)
+    input_ids[:, 1] = IMAGE_TOKEN_INDEX
+    labels = input_ids.clone()
+    labels[:, :2] = IGNORE_INDEX
+    images = torch.randn(batch_size, 2, 3, image_size, image_size, device=args.device, dtype=model.dtype)
+
+    profiler = enable_profiling(memory=True, device=args.device, max_depth=args.module_depth)
+    profiler.attach(model)
+    profiler.pop_window_peaks()
+    result = {"batch_size": batch_size, "seq_len": seq_len}
+    try:
+        for _ in range(args.steps):
+            with profiler.range("step"):
+                loss = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids, dtype=torch.bool),
+                             labels=labels, images=images).loss
+                with profiler.range("backward"):
+                    loss.backward()
+                with profiler.range("optimizer_step"):
+                    optimizer.step()
+                    optimizer.zero_grad(set_to_none=True)
+            profiler.step()
+    except torch.cuda.OutOfMemoryError as e:
+        result["oom"] = str(e).splitlines()[0]
+    # the profiler resets the allocator peak inside its ranges and keeps the overall peak itself
+    result["peak_gb"] = profiler.pop_window_peaks()[0] / GB
+    result["peak_rss_gb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 20
+    result.update(profiler.summary(top_modules=args.top_modules))
+    return result
+
+
+def main(args):
+    configs = [(b, s) for b in args.batch_sizes for s in args.seq_lens]
+    results = []
+    for batch_size, seq_len in configs:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_config, args, batch_size, seq_len).result()
+        status = "OOM" if "oom" in result else f"{result['peak_gb']:.3f} GB, RSS {result['peak_rss_gb']:.3f} GB"
+        print(f"batch {batch_size:>3}  seq {seq_len:>5}  peak {status}")
+        results.append(result)
+
+    kind = "tensor" if args.device == "cpu" else "allocated"
+    print(f"\nPeak {kind} GB (rows: batch size, columns: sequence length)")
+    print("batch " + "".join(f"{s:>10}" for s in args.seq_lens))
+    by_config = {(r["batch_size"], r["seq_len"]): r for r in results}
+    for b in args.batch_sizes:
+        cells = ["       OOM" if "oom" in by_config[b, s] else f"{by_config[b, s]['peak_gb']:>10.3f}"
+                 for s in args.seq_lens]
+        print(f"{b:>5} " + "".join(cells))
+
+    if args.output_file:
+        settings = {k: v for k, v in vars(args).items() if k != "output_file"}
+        with open(args.output_file, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2)
+        print(f"Saved to {args.output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, default=None, help="default: the tiny random-weight model")
+    parser.add_argument("--model-base", type=str, default=None)
+    parser.add_argument("--image-size", type=int, default=64, help="tiny model only")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16", "float16"])
+    parser.add_argument("--gradient-checkpointing", action="store_true")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--seq-lens", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--steps", type=int, default=2, help="training steps per configuration")
+    parser.add_argument("--module-depth", type=int, default=3)
+    parser.add_argument("--top-modules", type=int, default=15)
+    parser.add_argument("--output-file", type=str, default=None)
+    args = parser.parse_args()
+
+    main(args)
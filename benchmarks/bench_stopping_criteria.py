@@ -0,0 +1,113 @@
+"""
+Micro-benchmark for `KeywordsStoppingCriteria`: host time per decode step, compared with
+the original implementation (keyword tensors copied to the device and the last tokens
+decoded on every call).
+
+    python -m benchmarks.bench_stopping_criteria --tokenizer microsoft/phi-2 --device cuda
+
+Without `--tokenizer` a small byte-level BPE tokenizer is trained on the fly so the
+benchmark also runs offline.
+"""
+import argparse
+import json
+import time
+
+import torch
+from transformers import AutoTokenizer, StoppingCriteria
+
+from llava_phi.conversation import conv_templates, SeparatorStyle
+from llava_phi.mm_utils import KeywordsStoppingCriteria
+
+REPORT = ("The lungs are clear. No pleural effusion or pneumothorax. Heart size is normal. "
+          "Cardiomediastinal silhouette is within normal limits. No acute osseous abnormality. ")
+
+
+class LegacyKeywordsStoppingCriteria(StoppingCriteria):
+    """The per-call implementation this benchmark compares against."""
+
+    def __init__(self, keywords, tokenizer, input_ids):
+        self.keywords = keywords
+        self.keyword_ids = []
+        for keyword in keywords:
+            cur_keyword_ids = tokenizer(keyword).input_ids
+            if len(cur_keyword_ids) > 1 and cur_keyword_ids[0] == tokenizer.bos_token_id:
+                cur_keyword_ids = cur_keyword_ids[1:]
+            self.keyword_ids.append(torch.tensor(cur_keyword_ids))
+        self.tokenizer = tokenizer
+        self.start_len = input_ids.shape[1]
+
+    def __call__(self, output_ids, scores, **kwargs):
+        offset = min(output_ids.shape[1] - self.start_len, 3)
+        self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
+        for keyword_id in self.keyword_ids:
+            if output_ids[0, -keyword_id.shape[0]:].tolist() == keyword_id.tolist():
+                return True
+        outputs = self.tokenizer.batch_decode(output_ids[:, -offset:], skip_special_tokens=True)[0]
+        for keyword in self.keywords:
+            if keyword in outputs:
+                return True
+        return False
+
+
+def train_tokenizer(vocab_size=1000):
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["<|endoftext|>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator([REPORT] * 100, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>")
+
+
+def time_steps(criteria_cls, keywords, tokenizer, prompt_ids, generated_ids, device):
+    """Seconds per step, feeding the generated ids one at a time like `generate` does."""
+    output_ids = torch.cat([prompt_ids, generated_ids], dim=1).to(device)
+    criteria = criteria_cls(keywords, tokenizer, prompt_ids)
+    start = time.perf_counter()
+    for cur_len in range(prompt_ids.shape[1] + 1, output_ids.shape[1] + 1):
+        criteria(output_ids[:, :cur_len], None)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / generated_ids.shape[1]
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, use_fast=True) if args.tokenizer else train_tokenizer()
+    conv = conv_templates[args.conv_mode]
+    stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+    keywords = [stop_str] + args.extra_keywords
+    device = torch.device(args.device)
+
+    report_ids = tokenizer(REPORT * 20).input_ids[:args.num_tokens]
+    prompt_ids = torch.tensor([tokenizer(REPORT).input_ids])
+
+    results = {"keywords": keywords, "num_tokens": len(report_ids), "device": str(device)}
+    legacy = time_steps(LegacyKeywordsStoppingCriteria, keywords, tokenizer, prompt_ids,
+                        torch.tensor([report_ids]), device)
+    results["legacy_us_per_step"] = legacy * 1e6
+    for batch_size in args.batch_sizes:
+        generated_ids = torch.tensor([report_ids] * batch_size)
+        new = time_steps(KeywordsStoppingCriteria, keywords, tokenizer,
+                         prompt_ids.expand(batch_size, -1), generated_ids, device)
+        results[f"automaton_us_per_step_bs{batch_size}"] = new * 1e6
+    print(json.dumps(results, indent=2))
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", type=str, default=None)
+    parser.add_argument("--conv-mode", type=str, default="phi-2_v0")
+    parser.add_argument("--extra-keywords", type=str, nargs="*", default=[])
+    parser.add_argument("--num-tokens", type=int, default=512)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--output-file", type=str, default=None)
+    args = parser.parse_args()
+
+    main(args)
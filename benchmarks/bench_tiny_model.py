@@ -0,0 +1,195 @@
+"""
+CPU benchmark suite for the Dual-View SLaVA hot paths, on the random-weight model of
+`benchmarks.tiny_model`.  It needs no checkpoint, network or GPU:
+
+    python -m benchmarks.bench_tiny_model --output-file bench_tiny.json
+    python -m benchmarks.bench_tiny_model --compare bench_tiny.json   # after a change
+
+Timed, each over `--rounds` rounds after `--warmup` untimed ones:
+
+    tokenizer_image_token           one conversation prompt
+    collate_eval                    `LeftPadCollator` on a batch
+    collate_train                   `DataCollatorForSupervisedDataset` (skipped if train.py cannot be imported)
+    encode_images                   one study's frontal + lateral views
+    prepare_inputs_labels           `prepare_inputs_labels_for_multimodal` on a labelled batch
+    prefill                         forward over the prompts with images, filling the KV cache
+    decode_per_token                one greedy decode step with the cache, averaged over `--decode-tokens`
+
+Per benchmark, min / median / mean / max / stddev in milliseconds are written as JSON.
+With `--compare`, medians are checked against an earlier result file.  The exit status is
+1 if any median is slower than the baseline by more than `--tolerance`.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+
+import torch
+import transformers
+
+from llava_phi.constants import DEFAULT_IMAGE_TOKEN, IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from llava_phi.conversation import conv_templates
+from llava_phi.eval.eval_dataset import LeftPadCollator
+from llava_phi.mm_utils import tokenizer_image_token
+
+from benchmarks.bench_stopping_criteria import REPORT
+from benchmarks.tiny_model import build_tiny_model, tiny_image_processor, tiny_tokenizer
+
+
+def run_benchmark(fn, rounds, warmup, setup=None):
+    """Timing statistics of `fn(*setup())`; `setup` runs untimed before every call."""
+    times = []
+    for i in range(warmup + rounds):
+        call_args = setup() if setup else ()
+        start = time.perf_counter()
+        fn(*call_args)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            times.append(elapsed * 1000)
+    return {"rounds": rounds, "min_ms": min(times), "median_ms": statistics.median(times),
+            "mean_ms": statistics.fmean(times), "max_ms": max(times),
+            "stddev_ms": statistics.stdev(times) if len(times) > 1 else 0.0}
+
+
+def build_prompt(conv_mode, query):
+    conv = conv_templates[conv_mode].copy()
+    conv.append_message(conv.roles[0], DEFAULT_IMAGE_TOKEN + "\n" + query)
+    conv.append_message(conv.roles[1], None)
+    return conv.get_prompt()
+
+
+def make_batch(model, tokenizer, image_processor, args):
+    """Left-padded prompts of different lengths, their dual-view images and answer labels."""
+    prompts = [build_prompt(args.conv_mode, "Describe the findings. " * (1 + i % 3)) for i in range(args.batch_size)]
+    image_size = image_processor.crop_size["height"]
+    samples = [{"input_ids": tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt'),
+                "images": torch.randn(2, 3, image_size, image_size), "index": i} for i, prompt in enumerate(prompts)]
+    batch = LeftPadCollator(tokenizer.pad_token_id)(samples)
+    answer_ids = tokenizer(REPORT, return_tensors="pt").input_ids[0]
+    train_samples = [{"input_ids": torch.cat([s["input_ids"], answer_ids]),
+                      "labels": torch.cat([torch.full_like(s["input_ids"], IGNORE_INDEX), answer_ids]),
+                      "image": s["images"]} for s in samples]
+    return samples, batch, train_samples
+
+
+def decode_steps(model, batch, num_tokens):
+    """Greedy decode after an untimed prefill; returns seconds per token."""
+    attention_mask = batch["attention_mask"]
+    out = model(input_ids=batch["input_ids"], attention_mask=attention_mask, images=batch["images"], use_cache=True)
+    past_key_values = out.past_key_values
+    next_ids = out.logits[:, -1:].argmax(-1)
+    start = time.perf_counter()
+    for _ in range(num_tokens):
+        # the token-level mask grows by one per step, as in `generate`
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=1)
+        out = model(input_ids=next_ids, attention_mask=attention_mask, past_key_values=past_key_values,
+                    images=batch["images"], use_cache=True)
+        past_key_values = out.past_key_values
+        next_ids = out.logits[:, -1:].argmax(-1)
+    return (time.perf_counter() - start) / num_tokens
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["benchmarks"]
+    regressions = []
+    print(f"{'benchmark':<24} {'median ms':>12} {'baseline':>12} {'ratio':>8}")
+    for name, stats in results["benchmarks"].items():
+        if "median_ms" not in stats or "median_ms" not in baseline.get(name, {}):
+            continue
+        ratio = stats["median_ms"] / baseline[name]["median_ms"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<24} {stats['median_ms']:>12.3f} {baseline[name]['median_ms']:>12.3f} {ratio:>8.2f}{flag}")
+    return regressions
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = build_tiny_model(seed=args.seed, num_layers=args.num_layers, hidden_size=args.hidden_size,
+                             vision_layers=args.vision_layers, image_size=args.image_size)
+    tokenizer = tiny_tokenizer()
+    image_processor = tiny_image_processor(args.image_size)
+    samples, batch, train_samples = make_batch(model, tokenizer, image_processor, args)
+    prompt = build_prompt(args.conv_mode, "Describe the findings.")
+    labels = torch.nn.utils.rnn.pad_sequence([s["labels"] for s in train_samples], batch_first=True,
+                                             padding_value=IGNORE_INDEX)
+    train_ids = torch.nn.utils.rnn.pad_sequence([s["input_ids"] for s in train_samples], batch_first=True,
+                                                padding_value=tokenizer.pad_token_id)
+    train_images = torch.stack([s["image"] for s in train_samples])
+
+    bench = {}
+    timing = dict(rounds=args.rounds, warmup=args.warmup)
+    bench["tokenizer_image_token"] = run_benchmark(
+        lambda: tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt'), **timing)
+    bench["collate_eval"] = run_benchmark(lambda: LeftPadCollator(tokenizer.pad_token_id)(samples), **timing)
+    try:
+        from llava_phi.train.train import DataCollatorForSupervisedDataset
+        tokenizer.model_max_length = 2048
+        collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
+        bench["collate_train"] = run_benchmark(lambda: collator(train_samples), **timing)
+    except ImportError as e:
+        bench["collate_train"] = {"skipped": f"llava_phi.train.train not importable: {e}"}
+
+    with torch.inference_mode():
+        bench["encode_images"] = run_benchmark(lambda: model.encode_images(batch["images"][0]), **timing)
+        bench["prepare_inputs_labels"] = run_benchmark(
+            lambda: model.prepare_inputs_labels_for_multimodal(train_ids, train_ids.ne(tokenizer.pad_token_id),
+                                                               None, labels, train_images), **timing)
+        bench["prefill"] = run_benchmark(
+            lambda: model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"],
+                          images=batch["images"], use_cache=True), **timing)
+        per_token = [decode_steps(model, batch, args.decode_tokens) * 1000 for _ in range(args.warmup + args.rounds)]
+        per_token = per_token[args.warmup:]
+        bench["decode_per_token"] = {"rounds": args.rounds, "tokens_per_round": args.decode_tokens,
+                                     "min_ms": min(per_token), "median_ms": statistics.median(per_token),
+                                     "mean_ms": statistics.fmean(per_token), "max_ms": max(per_token),
+                                     "stddev_ms": statistics.stdev(per_token) if len(per_token) > 1 else 0.0}
+
+    results = {
+        "meta": {"python": platform.python_version(), "torch": torch.__version__,
+                 "transformers": transformers.__version__, "threads": torch.get_num_threads(),
+                 "machine": platform.machine(), "batch_size": args.batch_size, "seed": args.seed,
+                 "config": {"num_layers": args.num_layers, "hidden_size": args.hidden_size,
+                            "vision_layers": args.vision_layers, "image_size": args.image_size,
+                            "num_parameters": sum(p.numel() for p in model.parameters())}},
+        "benchmarks": bench,
+    }
+    for name, stats in bench.items():
+        if "median_ms" in stats:
+            print(f"{name:<24} median {stats['median_ms']:>10.3f} ms  (min {stats['min_ms']:.3f}, "
+                  f"stddev {stats['stddev_ms']:.3f})")
+        else:
+            print(f"{name:<24} {stats['skipped']}")
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved to {args.output_file}")
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conv-mode", type=str, default="phi-2_v0")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--decode-tokens", type=int, default=32)
+    parser.add_argument("--num-layers", type=int, default=2)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--vision-layers", type=int, default=2)
+    parser.add_argument("--image-size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads; fix it for comparable runs")
+    parser.add_argument("--output-file", type=str, default=None)
+    parser.add_argument("--compare", type=str, default=None, help="earlier --output-file to compare medians against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown ratio before flagging, e.g. 0.2")
+    args = parser.parse_args()
+
+    main(args)
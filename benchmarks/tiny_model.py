@@ -0,0 +1,66 @@
+"""
+A miniature, random-weight Dual-View SLaVA for offline CPU benchmarks.
+
+`build_tiny_model` keeps the real module graph:
+- `CLIPVisionTower`;
+- the adapter, fusion, cross-attention and projector of `LlavaMetaModel`;
+- a Phi decoder with `lm_head`.
+
+The sizes are scaled down (a few Phi layers, a small CLIP vision config).  The BiomedCLIP
+tower is replaced by `StubMedicalTower`, which returns the same `[B, 512]` image
+embedding.  `_init_medical_tower` therefore never reaches the hub, and the model builds
+without a checkpoint, a download or CUDA.
+"""
+import torch
+import torch.nn as nn
+from transformers import CLIPImageProcessor
+
+from llava_phi.model import LlavaPhiConfig, LlavaPhiForCausalLM, LlavaPhiVisionConfig, ProjectorConfig
+
+MEDICAL_EMBED_DIM = 512  # BiomedCLIP's image embedding width, the input of `med_feature_adapter`
+
+
+class StubMedicalTower(nn.Module):
+    """Patch embedding, mean pooling and a projection to the BiomedCLIP embedding width."""
+
+    def __init__(self, patch_size=16, width=64):
+        super().__init__()
+        self.patch_embed = nn.Conv2d(3, width, kernel_size=patch_size, stride=patch_size)
+        self.proj = nn.Linear(width, MEDICAL_EMBED_DIM)
+
+    def forward(self, images):
+        return self.proj(self.patch_embed(images).flatten(2).mean(-1))
+
+
+def tiny_config(num_layers=2, hidden_size=256, num_heads=4, vocab_size=1024, vision_layers=2, vision_hidden_size=128,
+                image_size=64, patch_size=16):
+    vision_tower = LlavaPhiVisionConfig(hidden_size=vision_hidden_size, intermediate_size=4 * vision_hidden_size,
+                                        num_hidden_layers=vision_layers, num_attention_heads=num_heads,
+                                        image_size=image_size, patch_size=patch_size)
+    projector = ProjectorConfig(mm_hidden_size=vision_hidden_size, hidden_size=hidden_size)
+    return LlavaPhiConfig(vision_config={"vision_tower": vision_tower.to_dict(), "mm_projector": projector.to_dict()},
+                          vocab_size=vocab_size, hidden_size=hidden_size, intermediate_size=4 * hidden_size,
+                          num_hidden_layers=num_layers, num_attention_heads=num_heads, max_position_embeddings=2048)
+
+
+def build_tiny_model(seed=0, **config_kwargs):
+    torch.manual_seed(seed)
+    config = tiny_config(**config_kwargs)
+    model = LlavaPhiForCausalLM(config)
+    vision_config = config.vision_config["vision_tower"]
+    model.get_model().medical_vision_tower = StubMedicalTower(patch_size=vision_config["patch_size"])
+    model.get_model()._medical_vision_tower_initialized = True
+    return model.eval()
+
+
+def tiny_image_processor(image_size=64):
+    return CLIPImageProcessor(size={"shortest_edge": image_size}, crop_size={"height": image_size, "width": image_size})
+
+
+def tiny_tokenizer():
+    """The byte-level BPE tokenizer trained on the fly by `bench_stopping_criteria`, with a pad token."""
+    from benchmarks.bench_stopping_criteria import train_tokenizer
+
+    tokenizer = train_tokenizer()
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
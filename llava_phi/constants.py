@@ -10,3 +10,5 @@ DEFAULT_IMAGE_TOKEN = "<image>"
 DEFAULT_IMAGE_PATCH_TOKEN = "<im_patch>"
 DEFAULT_IM_START_TOKEN = "<im_start>"
 DEFAULT_IM_END_TOKEN = "<im_end>"
+
+MEDICAL_VISION_TOWER = "hf-hub:microsoft/BiomedCLIP-PubMedBERT_256-vit_base_patch16_224"
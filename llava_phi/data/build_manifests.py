@@ -0,0 +1,319 @@
+"""
+Training manifests from the cleaned reports in one streaming pass.
+
+Replaces the four cells of `train_data_json_gen.ipynb`.  Reports are read one at a time
+(JSONL input is never loaded whole).  Each study is assigned to train or test by a hash of
+its `study_id`, so the split is reproducible and needs no global shuffle.  Every study is
+written straight to its split file and to the recognition, reasoning and report
+manifests of that split:
+
+    python -m llava_phi.data.build_manifests --input cleaned_reports_radgraph.jsonl \
+        --output-dir manifests
+
+    manifests/slava_llava_split_{train,test}.jsonl       frontal, lateral, *_input, findings, impression
+    manifests/slava_llava_recognition_{train,test}.jsonl
+    manifests/slava_llava_reasoning_{train,test}.jsonl
+    manifests/slava_llava_report_{train,test}.jsonl
+
+Prompts are drawn from a generator seeded with `study_id`, so a study gets the same
+prompts whatever else is in the corpus.  The manifests are not shuffled; the training
+sampler shuffles.  Next to each file, `<file>.idx` holds the byte offset of every line as
+little-endian uint64, and `ManifestReader` uses it for random access without loading the
+file, which is how `LazySupervisedDataset` reads `.jsonl` data paths.
+
+With `--image-ids` and `--exclude-leaked` from `dedup_images`, duplicate images are replaced
+by their canonical path and test studies sharing an image with train are left out.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import struct
+from collections import Counter
+
+import numpy as np
+
+from llava_phi.data.extract_reports import iter_reports
+
+IMAGE_TOKEN = "<image>"
+TASKS = ("recognition", "reasoning", "report")
+
+RECOGNITION_PROMPTS = [
+    "Enumerate all abnormal radiographic findings seen on the frontal and lateral chest X-rays, along with their precise anatomical locations.",
+    "List every visible pathology in the lungs, heart, pleura, and bones, as observed on both frontal and lateral views.",
+    "Describe only the radiographic abnormalities visible in these dual-view chest X-rays. Exclude normal structures.",
+    "Identify and localize any abnormal opacities, effusions, consolidations, or structural deviations present in the chest radiographs.",
+    "Specify all observed abnormalities in the dual chest views, including their type (e.g., mass, effusion, opacity) and anatomical location.",
+    "Report abnormal findings only from the provided frontal and lateral chest X-ray images. Do not describe normal appearances.",
+    "What pathological signs can be identified across both X-ray views? Be specific about laterality and anatomical regions.",
+    "Describe all clinically relevant radiographic findings, focusing on abnormalities in the lungs, mediastinum, and chest wall.",
+    "From the dual-view chest radiographs, list any deviations from normal radiographic anatomy or pathology that requires clinical attention.",
+    "Summarize all abnormal chest X-ray findings, organized by anatomical region (e.g., lungs, heart, pleura, bones)."
+]
+
+REASONING_INPUT_PROMPTS = [
+    "Based on the findings in the frontal and lateral chest X-rays, what is the most likely clinical diagnosis?",
+    "Interpret the radiographic abnormalities observed in both views and explain their clinical implications.",
+    "Given the dual-view chest radiographs, what is your diagnostic impression and reasoning behind it?",
+    "Using the observed abnormalities in these X-rays, infer the likely pathology and explain its clinical relevance.",
+    "What clinical condition best explains the abnormal findings visible in these frontal and lateral chest radiographs?"
+]
+
+REASONING_OVERSAMPLE_FACTOR = 3
+ENHANCED_PROMPT_TEMPLATES = [
+    "GIVEN THESE FINDINGS: {findings}\n{original_instruction}",
+    "THE RADIOLOGIST NOTED: {findings}\nBASED ON THIS, {original_instruction}",
+    "CLINICAL CONTEXT: {findings}\nPLEASE PROVIDE YOUR ANALYSIS: {original_instruction}",
+    "{original_instruction}\nRELEVANT FINDINGS INCLUDE: {findings}"
+]
+REASONING_PROMPTS = [
+    "<image> ANALYZE THE DUAL-VIEW CHEST RADIOGRAPHS AND DESCRIBE THE MOST CLINICALLY SIGNIFICANT FINDINGS.",
+    "<image> IDENTIFY AND PRIORITIZE THE TOP 3 RADIOGRAPHIC ABNORMALITIES THAT REQUIRE CLINICAL ATTENTION.",
+    "<image> COMPARE THE CURRENT STUDY WITH PRIOR IMAGING (IF AVAILABLE). WHAT INTERVAL CHANGES ARE MOST CONCERNING?",
+    "<image> WHAT RADIOGRAPHIC SIGNS SUGGEST DECOMPENSATION IN THIS PATIENT'S CONDITION?",
+    "<image> WHICH FINDINGS WOULD YOU IMMEDIATELY REPORT TO THE TREATING PHYSICIAN AND WHY?",
+    "<image> ASSESS THE POSITIONING AND PLACEMENT OF ALL TUBES, LINES, AND DEVICES.",
+    "<image> DESCRIBE ANY FINDINGS THAT SUGGEST ACUTE VERSUS CHRONIC PATHOLOGICAL PROCESSES.",
+    "<image> WHAT DIFFERENTIAL DIAGNOSES WOULD YOU CONSIDER BASED ON THESE RADIOGRAPHIC FINDINGS?",
+    "<image> EVALUATE THE CARDIOPULMONARY STATUS AND COMMENT ON ANY DECOMPENSATION SIGNS.",
+    "<image> IDENTIFY ANY FINDINGS THAT MAY REQUIRE IMMEDIATE INTERVENTION VERSUS FOLLOW-UP MONITORING."
+]
+
+REPORT_OVERSAMPLE_FACTOR = 4
+REPORT_INSTRUCTIONS = [
+    "<image> Describe the findings in these frontal and lateral chest X-rays in a structured radiology report format.",
+    "<image> Generate a complete radiology report for these CXRs including findings and impression.",
+    "<image> Interpret these chest X-rays and provide a professional radiology report.",
+    "<image> What abnormalities are visible in these CXRs? Provide a structured report.",
+    "<image> Analyze these frontal and lateral chest X-rays and summarize the key findings.",
+    "<image> Prepare a radiology report for these images with findings and clinical impression.",
+    "<image> Evaluate these CXRs and document your observations in standard report format.",
+    "<image> Provide a detailed interpretation of these chest X-rays with findings and conclusion.",
+    "<image> Write a radiology report for these images following clinical documentation standards.",
+    "<image> Identify and describe any pathological findings in these CXRs in report format."
+]
+
+
+def infer_view_hint(findings_text):
+    text_upper = findings_text.upper()
+    if "PA" in text_upper and "AP" in text_upper:
+        return "PA and AP chest X-ray views are shown."
+    elif "PA" in text_upper:
+        return "PA and lateral chest X-ray views are shown."
+    elif "AP" in text_upper:
+        return "AP and lateral chest X-ray views are shown."
+    else:
+        return "Frontal and lateral chest X-ray views are shown."
+
+
+def is_normal(impression):
+    # the notebook's bucketing rule, substring match included
+    impression = impression.lower()
+    return "no acute" in impression or "normal" in impression or "no evidence" in impression
+
+
+def assign_split(study_id, test_fraction, salt=""):
+    """"test" for a fixed `test_fraction` of study ids, decided by SHA-1 alone."""
+    digest = hashlib.sha1(f"{salt}{study_id}".encode("utf-8")).digest()
+    return "test" if int.from_bytes(digest[:8], "big") / 2 ** 64 < test_fraction else "train"
+
+
+def build_item(study_id, entry, rng):
+    """The `slava_llava_split_*` item for one report, or None when it lacks text or a view."""
+    findings = entry.get("findings", "").strip()
+    impression = entry.get("impression", "").strip()
+    image_paths = entry.get("image_paths", [])
+    if not findings or not impression or len(image_paths) < 2:
+        return None
+    view_hint = infer_view_hint(findings)
+    return {
+        "study_id": study_id,
+        "frontal": image_paths[0],
+        "lateral": image_paths[1],
+        "recognition_input": f"{IMAGE_TOKEN}{view_hint} {rng.choice(RECOGNITION_PROMPTS)}",
+        "reasoning_input": f"{IMAGE_TOKEN}{view_hint} {rng.choice(REASONING_INPUT_PROMPTS)}",
+        "findings": findings,
+        "impression": impression
+    }
+
+
+def _sample(item, instruction, response, category=None):
+    sample = {
+        "frontal": item["frontal"],
+        "lateral": item["lateral"],
+        "conversations": [
+            {"from": "human", "value": instruction},
+            {"from": "gpt", "value": response}
+        ]
+    }
+    if category:
+        sample["category"] = category
+    return sample
+
+
+def recognition_samples(item, rng):
+    return [_sample(item, item["recognition_input"], item["findings"])]
+
+
+def reasoning_samples(item, rng):
+    original_instruction = rng.choice(REASONING_PROMPTS)
+    prompts = [template.format(findings=item["findings"], original_instruction=original_instruction)
+               for template in ENHANCED_PROMPT_TEMPLATES]
+    if is_normal(item["impression"]):
+        return [_sample(item, prompts[0], item["impression"], "normal")]
+    samples = [_sample(item, prompts[0], item["impression"], "abnormal_original")]
+    for i, prompt in enumerate(prompts[:REASONING_OVERSAMPLE_FACTOR]):
+        samples.append(_sample(item, prompt, item["impression"], f"abnormal_enhanced_{i+1}"))
+    return samples
+
+
+def report_samples(item, rng):
+    report_text = f"FINDINGS: {item['findings']}IMPRESSION: {item['impression']}"
+    if is_normal(item["impression"]):
+        return [_sample(item, rng.choice(REPORT_INSTRUCTIONS), report_text, "normal")]
+    samples = [_sample(item, rng.choice(REPORT_INSTRUCTIONS), report_text, "abnormal_original")]
+    for i in range(REPORT_OVERSAMPLE_FACTOR):
+        samples.append(_sample(item, rng.choice(REPORT_INSTRUCTIONS), report_text, f"abnormal_enhanced_{i+1}"))
+    return samples
+
+
+TASK_BUILDERS = {"recognition": recognition_samples, "reasoning": reasoning_samples, "report": report_samples}
+
+
+class IndexedJsonlWriter:
+    """Appends JSON lines to `path` and their byte offsets to `path + ".idx"`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.index = open(path + ".idx", "wb")
+        self.count = 0
+
+    def write(self, record):
+        self.index.write(struct.pack("<Q", self.file.tell()))
+        self.file.write(json.dumps(record).encode("utf-8") + b"\n")
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+
+class ManifestReader:
+    """Random access to a JSONL manifest through its `.idx` offsets; only the offsets are held in memory."""
+
+    def __init__(self, path):
+        self.path = path
+        index_path = path + ".idx"
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+            self.offsets = np.memmap(index_path, dtype="<u8", mode="r") if os.path.getsize(index_path) else \
+                np.zeros(0, dtype="<u8")
+        else:
+            self.offsets = self._scan_offsets(path)
+        self._file = None
+        self._pid = None
+
+    @staticmethod
+    def _scan_offsets(path):
+        offsets, position = [], 0
+        with open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    offsets.append(position)
+                position += len(line)
+        return np.array(offsets, dtype="<u8")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        # dataloader workers are forked, so each process opens its own handle
+        if self._file is None or self._pid != os.getpid():
+            self._file = open(self.path, "rb")
+            self._pid = os.getpid()
+        self._file.seek(int(self.offsets[i]))
+        return json.loads(self._file.readline())
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        return state
+
+
+def main(args):
+    from llava_phi.data.dedup_images import load_image_ids, load_leaked_studies
+
+    canonical_paths = {}
+    if args.image_ids:
+        canonical_paths = {path: row["canonical_path"] for path, row in load_image_ids(args.image_ids).items()}
+    leaked = load_leaked_studies(args.exclude_leaked) if args.exclude_leaked else set()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    splits = ("train", "test")
+    writers = {}
+    for split in splits:
+        writers[split, "split"] = IndexedJsonlWriter(
+            os.path.join(args.output_dir, f"{args.prefix}split_{split}.jsonl"))
+        for task in args.tasks:
+            writers[split, task] = IndexedJsonlWriter(
+                os.path.join(args.output_dir, f"{args.prefix}{task}_{split}.jsonl"))
+
+    num_read = num_skipped = num_leaked = 0
+    categories = Counter()
+    try:
+        for study_id, entry in iter_reports(args.input):
+            num_read += 1
+            # string seeds are hashed deterministically, unlike hash(), so reruns draw the same prompts
+            rng = random.Random(f"{args.seed}:{study_id}")
+            item = build_item(study_id, entry, rng)
+            if item is None:
+                num_skipped += 1
+                continue
+            split = assign_split(study_id, args.test_fraction, args.split_salt)
+            if split == "test" and study_id in leaked:
+                num_leaked += 1
+                continue
+            for view in ("frontal", "lateral"):
+                item[view] = canonical_paths.get(item[view].strip("/"), item[view])
+            writers[split, "split"].write(item)
+            for task in args.tasks:
+                for sample in TASK_BUILDERS[task](item, rng):
+                    writers[split, task].write(sample)
+                    categories[split, task, sample.get("category", "all")] += 1
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    print(f"{num_read} reports read, {num_skipped} skipped without findings, impression or both views"
+          + (f", {num_leaked} leaked test studies excluded" if leaked else ""))
+    for (split, task), writer in writers.items():
+        counts = ", ".join(f"{category}: {count}" for (s, t, category), count in sorted(categories.items())
+                           if (s, t) == (split, task))
+        print(f"  {writer.path}: {writer.count} samples" + (f" ({counts})" if counts else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default="cleaned_reports_radgraph.json",
+                        help="cleaned reports as a JSON dict or JSONL (streamed)")
+    parser.add_argument("--output-dir", type=str, default=".")
+    parser.add_argument("--prefix", type=str, default="slava_llava_")
+    parser.add_argument("--tasks", type=str, nargs="+", default=list(TASKS), choices=TASKS)
+    parser.add_argument("--test-fraction", type=float, default=0.05)
+    parser.add_argument("--split-salt", type=str, default="",
+                        help="prepended to study_id before hashing; change it to draw a different split")
+    parser.add_argument("--seed", type=int, default=0, help="prompt selection seed")
+    parser.add_argument("--image-ids", type=str, default=None,
+                        help="image_ids.csv from dedup_images; samples point at each image's canonical path")
+    parser.add_argument("--exclude-leaked", type=str, default=None,
+                        help="leakage.jsonl from dedup_images; its studies are left out of the test split")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,147 @@
+"""
+RadGraph-based report cleaning from `Radgraph Based Report Cleaning.ipynb`, batched and cached.
+
+Only sentences that mention a RadGraph entity are kept.  The cleaning runs in two stages:
+- Annotate: every findings/impression text without a cached annotation goes to RadGraph,
+  in batches, across a process pool (one RadGraph per worker).  The raw annotations are
+  stored per report hash in a `ReferenceCache`, shared with `llava_phi.eval.metrics
+  --cache-dir`.
+- Filter: sentences are matched against one compiled pattern of the report's entity tokens.
+
+The filter rules (`--ignore-labels`, `--skip-marker`) apply at the second stage only, so
+changing them reruns the filter from the cache without RadGraph.
+
+    python -m llava_phi.data.clean_reports --input radgraph_processed_output.jsonl \
+        --output cleaned_reports_radgraph.json --num-workers 4
+"""
+import argparse
+import importlib.metadata
+import json
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from tqdm import tqdm
+
+from llava_phi.data.extract_reports import load_reports
+from llava_phi.eval.metrics import radgraph_annotations
+from llava_phi.eval.score_cache import ReferenceCache
+
+FIELDS = ("findings", "impression")
+
+
+def entity_pattern(annotation, ignore_labels=("O",)):
+    """A compiled alternation of the annotation's entity tokens, or None when there are none."""
+    tokens = {ent["tokens"].strip() for ent in annotation.get("entities", {}).values()
+              if ent["label"] not in ignore_labels}
+    if not tokens:
+        return None
+    return re.compile("|".join(re.escape(token) for token in sorted(tokens)))
+
+
+def clean_text(text, annotation, ignore_labels=("O",), skip_marker="_"):
+    if not text.strip():
+        return ""
+    pattern = entity_pattern(annotation, ignore_labels)
+    if pattern is None:
+        return ""
+    sentences = [s.strip() for s in text.replace('\n', ' ').split('.') if s.strip()]
+    kept_sentences = [s for s in sentences if not (skip_marker and skip_marker in s) and pattern.search(s)]
+    return '. '.join(kept_sentences) + '.' if kept_sentences else ""
+
+
+_radgraph = None
+
+
+def _init_radgraph(model_type, threads):
+    global _radgraph
+    from radgraph import RadGraph
+
+    if threads:
+        torch.set_num_threads(threads)
+    _radgraph = RadGraph(model_type=model_type, cuda=-1)
+
+
+def _annotate(texts, batch_size):
+    try:
+        return radgraph_annotations(_radgraph, texts, batch_size), None
+    except Exception as e:
+        return {}, f"Error annotating {len(texts)} texts: {e}"
+
+
+def annotate_texts(texts, cache, args):
+    """Annotations for `texts`, reading the cache first and adding whatever RadGraph had to compute."""
+    annotations, todo = {}, []
+    for text in dict.fromkeys(texts):
+        value = cache.get(text) if cache else None
+        if value is None:
+            todo.append(text)
+        else:
+            annotations[text] = value
+    print(f"{len(annotations)} texts cached, {len(todo)} to annotate with RadGraph")
+    if not todo:
+        return annotations
+
+    chunks = [todo[i:i + args.chunk_size] for i in range(0, len(todo), args.chunk_size)]
+    with ProcessPoolExecutor(max_workers=args.num_workers, initializer=_init_radgraph,
+                             initargs=(args.radgraph_model, args.threads_per_worker)) as pool:
+        results = pool.map(_annotate, chunks, [args.batch_size] * len(chunks))
+        for (new, error), chunk in tqdm(zip(results, chunks), total=len(chunks), desc="RadGraph"):
+            if error:
+                print(error)
+            annotations.update(new)
+            if cache:
+                # written per chunk, so an interrupted run keeps what it already paid for
+                cache.put(new)
+    return annotations
+
+
+def main(args):
+    data = load_reports(args.input)
+    texts = [entry.get(field, "") for entry in data.values() for field in FIELDS]
+    texts = [text for text in texts if text.strip()]
+
+    cache = None
+    if args.cache_dir:
+        version = f"radgraph-{importlib.metadata.version('radgraph')}-{args.radgraph_model}"
+        cache = ReferenceCache(args.cache_dir, "radgraph", version)
+    annotations = annotate_texts(texts, cache, args)
+
+    ignore_labels = tuple(args.ignore_labels)
+    for study_id, entry in data.items():
+        for field in FIELDS:
+            text = entry.get(field, "")
+            if text.strip() and text not in annotations:
+                print(f"Error processing entry {study_id}: no RadGraph annotation for {field}")
+                entry[field] = ""
+                continue
+            entry[field] = clean_text(text, annotations.get(text, {}), ignore_labels, args.skip_marker).strip()
+
+    with open(args.output, "w") as f:
+        if args.output.endswith(".jsonl"):
+            for study_id, entry in data.items():
+                f.write(json.dumps(dict(entry, study_id=study_id)) + "\n")
+        else:
+            json.dump(data, f, indent=2)
+    print(f"Saved {len(data)} cleaned reports to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default="radgraph_processed_output.json",
+                        help="radgraph_processed_output.json or the JSONL from extract_reports")
+    parser.add_argument("--output", type=str, default="cleaned_reports_radgraph.json")
+    parser.add_argument("--cache-dir", type=str, default="radgraph_cache",
+                        help="RadGraph annotations are kept here; reruns with new filter rules skip RadGraph")
+    parser.add_argument("--radgraph-model", type=str, default="radgraph-xl")
+    parser.add_argument("--num-workers", type=int, default=1, help="processes, each with its own RadGraph")
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=32, help="texts per RadGraph call")
+    parser.add_argument("--chunk-size", type=int, default=512, help="texts per worker task")
+    parser.add_argument("--ignore-labels", type=str, nargs="*", default=["O"],
+                        help="entity labels whose tokens do not keep a sentence")
+    parser.add_argument("--skip-marker", type=str, default="_",
+                        help="sentences containing this (MIMIC's ___ de-identification) are dropped")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,202 @@
+"""
+Content-addressed image ids for the collected MIMIC-CXR views, with train/test leakage flags.
+
+Every image referenced by the reports is decoded once and given two hashes:
+- `pixel_sha1`, the SHA-1 of the decoded pixels, equal for byte-different files that
+  decode to the same image;
+- `dhash`, a difference hash of the downscaled grayscale image, close in Hamming distance
+  for near-identical images (re-exports, slight rescales).
+
+Images with the same `pixel_sha1`, or with `dhash` values at most `--max-distance` bits
+apart, form a group.  The group's canonical image is its member with the smallest path,
+and every member is assigned the canonical image's `pixel_sha1` as its `image_id`:
+
+    python -m llava_phi.data.dedup_images --input cleaned_reports_radgraph.json \
+        --source-root Processed_MIMIC --output image_ids.csv --leakage-output leakage.jsonl
+
+Studies are split with `build_manifests.assign_split`, with the same `--test-fraction`
+and `--split-salt` as that command.  A test study is flagged as leaked when one of its
+images shares an `image_id` with a train study.  `preprocess_images --image-ids` then
+writes only the canonical images.  `build_manifests --image-ids` points every sample at
+its canonical image, so caches keyed on the image path hold each image once, and
+`--exclude-leaked` drops the flagged studies from the test split.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from llava_phi.data.build_manifests import assign_split
+from llava_phi.data.extract_reports import iter_reports
+
+TABLE_FIELDS = ["path", "image_id", "canonical_path", "pixel_sha1", "dhash", "group_size"]
+
+
+def dhash(gray, hash_size=16):
+    """hash_size**2-bit difference hash as a Python int: is each pixel brighter than its right neighbour."""
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hash_image(path, hash_size=16):
+    with open(path, "rb") as f:
+        img = cv2.imdecode(np.frombuffer(f.read(), np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise FileNotFoundError(f"Failed to load image: {path}")
+    pixel_sha1 = hashlib.sha1(f"{img.shape}".encode("utf-8") + img.tobytes()).hexdigest()
+    return pixel_sha1, dhash(img, hash_size)
+
+
+def _hash_chunk(paths, source_root, hash_size):
+    cv2.setNumThreads(1)
+    results = []
+    for rel_path in paths:
+        try:
+            results.append((rel_path, *hash_image(os.path.join(source_root, rel_path), hash_size), None))
+        except Exception as e:
+            results.append((rel_path, None, None, str(e)))
+    return results
+
+
+class _UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+
+
+def group_images(paths, pixel_sha1s, dhashes, max_distance, num_bits):
+    """Group index per image: same pixels, or dhashes within `max_distance` bits."""
+    groups = _UnionFind(len(paths))
+    first_by_sha1 = {}
+    for i, pixel_sha1 in enumerate(pixel_sha1s):
+        groups.union(first_by_sha1.setdefault(pixel_sha1, i), i)
+
+    # hashes within max_distance bits agree exactly on at least one of max_distance + 1 bands,
+    # so only images sharing a band value are compared
+    num_bands = max_distance + 1
+    band_bits = -(-num_bits // num_bands)
+    band_mask = (1 << band_bits) - 1
+    for band in range(num_bands):
+        buckets = defaultdict(list)
+        for i, value in enumerate(dhashes):
+            buckets[(value >> (band * band_bits)) & band_mask].append(i)
+        for members in buckets.values():
+            for a in range(len(members)):
+                for b in range(a + 1, len(members)):
+                    i, j = members[a], members[b]
+                    if groups.find(i) != groups.find(j) and \
+                            bin(dhashes[i] ^ dhashes[j]).count("1") <= max_distance:
+                        groups.union(i, j)
+    return [groups.find(i) for i in range(len(paths))]
+
+
+def load_image_ids(path):
+    """{path: row} from an `image_ids.csv` written by this module."""
+    with open(path, newline="") as f:
+        return {row["path"]: row for row in csv.DictReader(f)}
+
+
+def load_leaked_studies(path):
+    with open(path) as f:
+        return {json.loads(line)["study_id"] for line in f if line.strip()}
+
+
+def main(args):
+    studies = {}
+    for study_id, entry in iter_reports(args.input):
+        image_paths = [p.strip("/") for p in entry.get("image_paths", [])]
+        if len(image_paths) >= 2:
+            studies[study_id] = image_paths[:2]
+    paths = sorted({p for image_paths in studies.values() for p in image_paths})
+    print(f"{len(paths)} images in {len(studies)} studies")
+
+    chunks = [paths[i:i + args.chunk_size] for i in range(0, len(paths), args.chunk_size)]
+    hashed = {}
+    with ProcessPoolExecutor(max_workers=args.num_workers) as pool:
+        results = pool.map(_hash_chunk, chunks, [args.source_root] * len(chunks), [args.hash_size] * len(chunks))
+        for chunk_results in tqdm(results, total=len(chunks), desc="Hashing images"):
+            for rel_path, pixel_sha1, image_dhash, error in chunk_results:
+                if error:
+                    print(f"Failed to hash {rel_path}: {error}")
+                else:
+                    hashed[rel_path] = (pixel_sha1, image_dhash)
+
+    paths = [p for p in paths if p in hashed]
+    pixel_sha1s = [hashed[p][0] for p in paths]
+    dhashes = [hashed[p][1] for p in paths]
+    group_of = group_images(paths, pixel_sha1s, dhashes, args.max_distance, args.hash_size ** 2)
+    group_sizes = defaultdict(int)
+    for group in group_of:
+        group_sizes[group] += 1
+
+    # paths are sorted, so each group's root (its smallest index) is its smallest path
+    image_id_of = {}
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=TABLE_FIELDS)
+        writer.writeheader()
+        for i, rel_path in enumerate(paths):
+            root = group_of[i]
+            image_id_of[rel_path] = pixel_sha1s[root]
+            writer.writerow({"path": rel_path, "image_id": pixel_sha1s[root], "canonical_path": paths[root],
+                             "pixel_sha1": pixel_sha1s[i], "dhash": f"{dhashes[i]:0{args.hash_size ** 2 // 4}x}",
+                             "group_size": group_sizes[root]})
+    num_unique = len(group_sizes)
+    num_exact = len(paths) - len(set(pixel_sha1s))
+    print(f"{num_unique} unique images out of {len(paths)} ({num_exact} exact and "
+          f"{len(paths) - num_unique - num_exact} near duplicates); table: {args.output}")
+
+    train_studies = defaultdict(list)
+    test_studies = []
+    for study_id, image_paths in studies.items():
+        ids = [image_id_of.get(p) for p in image_paths]
+        if assign_split(study_id, args.test_fraction, args.split_salt) == "test":
+            test_studies.append((study_id, image_paths, ids))
+        else:
+            for image_id in ids:
+                train_studies[image_id].append(study_id)
+    num_leaked = 0
+    with open(args.leakage_output, "w") as f:
+        for study_id, image_paths, ids in test_studies:
+            leaks = [{"path": p, "image_id": image_id, "train_study_ids": train_studies[image_id][:10]}
+                     for p, image_id in zip(image_paths, ids) if image_id in train_studies]
+            if leaks:
+                num_leaked += 1
+                f.write(json.dumps({"study_id": study_id, "images": leaks}) + "\n")
+    print(f"{num_leaked} of {len(test_studies)} test studies share an image with train; flagged in {args.leakage_output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default="cleaned_reports_radgraph.json",
+                        help="reports with image_paths, as a JSON dict or JSONL")
+    parser.add_argument("--source-root", type=str, default="Processed_MIMIC")
+    parser.add_argument("--output", type=str, default="image_ids.csv")
+    parser.add_argument("--leakage-output", type=str, default="leakage.jsonl")
+    parser.add_argument("--hash-size", type=int, default=16, help="dhash grid side; the hash has hash_size**2 bits")
+    parser.add_argument("--max-distance", type=int, default=6,
+                        help="dhash bits two images may differ in and still be grouped; 0 keeps exact dhash matches only")
+    parser.add_argument("--test-fraction", type=float, default=0.05, help="as in build_manifests")
+    parser.add_argument("--split-salt", type=str, default="", help="as in build_manifests")
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=256, help="images per worker task")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,147 @@
+"""
+Stream FINDINGS/IMPRESSION sections out of `mimic-cxr-reports.zip`.
+
+Zip members are matched against the valid `(subject_id, study_id)` pairs using only the
+central directory, so reports of other studies are never decompressed.  The selected
+members are read by a process pool in which every worker opens its own handle on the
+zip.  Parsed studies are appended to a JSONL file as they arrive, and studies already
+in it are skipped on a rerun.
+
+    python -m llava_phi.data.extract_reports --zip-path mimic-cxr-reports.zip \
+        --valid-ids valid_pa_lateral_studies.csv --study-ids study_ids.csv \
+        --output radgraph_processed_output.jsonl
+
+Each line holds `study_id`, `subject_id`, `findings`, `impression` and `image_paths`,
+the fields of a `radgraph_processed_output.json` entry; `load_reports` reads either format.
+"""
+import argparse
+import csv
+import json
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+
+from llava_phi.eval.results_writer import ResultsWriter
+
+FINDINGS_RE = re.compile(r"(FINDINGS|OBSERVATION|DESCRIPTION):\s*(.*?)(IMPRESSION|CONCLUSION|DIAGNOSIS|$)",
+                         re.DOTALL | re.IGNORECASE)
+IMPRESSION_RE = re.compile(r"(IMPRESSION|CONCLUSION|DIAGNOSIS):\s*(.*)", re.DOTALL | re.IGNORECASE)
+
+
+def iter_reports(path):
+    """(study_id, entry) pairs; a JSONL file is streamed line by line, a JSON dict is loaded whole."""
+    with open(path) as f:
+        if not path.endswith(".jsonl"):
+            yield from json.load(f).items()
+            return
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                yield str(entry["study_id"]), entry
+
+
+def load_reports(path):
+    """{study_id: entry} from a `radgraph_processed_output.json` dict or a JSONL of entries."""
+    return dict(iter_reports(path))
+
+
+def load_valid_ids(csv_path):
+    valid_ids = set()
+    with open(csv_path, newline='') as f:
+        for row in csv.DictReader(f):
+            valid_ids.add((row["subject_id"].strip(), row["study_id"].strip()))
+    return valid_ids
+
+
+def member_ids(name):
+    """(subject_id, study_id) for `files/p10/p10000032/s50414267.txt`, else None."""
+    parts = name.split('/')
+    if len(parts) >= 4 and parts[-1].startswith('s') and name.endswith('.txt'):
+        return parts[-2][1:], parts[-1][1:-4]
+    return None
+
+
+def extract_findings_impression(text):
+    text = text.upper()
+    findings_match = FINDINGS_RE.search(text)
+    impression_match = IMPRESSION_RE.search(text)
+    findings = findings_match.group(2).strip() if findings_match else ""
+    impression = impression_match.group(2).strip() if impression_match else ""
+    return findings, impression
+
+
+_zip_file = None
+
+
+def _open_zip(zip_path):
+    # one handle per worker process; ZipFile objects must not be shared across processes
+    global _zip_file
+    _zip_file = zipfile.ZipFile(zip_path, 'r')
+
+
+def _read_members(members):
+    records, errors = [], []
+    for name, subject_id, study_id in members:
+        try:
+            with _zip_file.open(name) as f:
+                content = f.read().decode('utf-8')
+        except Exception as e:
+            errors.append(f"Error reading {name}: {e}")
+            continue
+        findings, impression = extract_findings_impression(content)
+        if not findings or not impression:
+            continue
+        records.append({"study_id": study_id,
+                        "subject_id": subject_id,
+                        "findings": findings.replace("\n", " ").strip(),
+                        "impression": impression.replace("\n", " ").strip(),
+                        "image_paths": [study_id + "/0.jpeg", study_id + "/1.jpeg"]})
+    return records, errors
+
+
+def main(args):
+    valid_ids = load_valid_ids(args.valid_ids)
+    if args.study_ids:
+        with open(args.study_ids, newline='') as f:
+            with_images = {row["study_id"].strip() for row in csv.DictReader(f)}
+        valid_ids = {(subject_id, study_id) for subject_id, study_id in valid_ids if study_id in with_images}
+
+    out_file = ResultsWriter(args.output, key_fields=("subject_id", "study_id"))
+    with zipfile.ZipFile(args.zip_path, 'r') as zip_ref:
+        members = []
+        for name in zip_ref.namelist():
+            ids = member_ids(name)
+            if ids in valid_ids and ids not in out_file:
+                members.append((name, *ids))
+    print(f"{len(members)} reports to extract for {len(valid_ids)} valid studies "
+          f"({len(out_file)} already in {args.output})")
+
+    chunks = [members[i:i + args.chunk_size] for i in range(0, len(members), args.chunk_size)]
+    num_written = 0
+    with ProcessPoolExecutor(max_workers=args.num_workers, initializer=_open_zip, initargs=(args.zip_path,)) as pool:
+        with out_file, tqdm(total=len(members), desc="Extracting reports") as progress:
+            for (records, errors), chunk in zip(pool.map(_read_members, chunks), chunks):
+                for error in errors:
+                    print(error)
+                for record in records:
+                    out_file.write(record)
+                num_written += len(records)
+                progress.update(len(chunk))
+    print(f"Wrote {num_written} studies with FINDINGS and IMPRESSION to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--zip-path", type=str, default="mimic-cxr-reports.zip")
+    parser.add_argument("--valid-ids", type=str, default="valid_pa_lateral_studies.csv",
+                        help="CSV with subject_id and study_id columns")
+    parser.add_argument("--study-ids", type=str, default=None,
+                        help="optional CSV of study_id with both processed views, e.g. study_ids.csv")
+    parser.add_argument("--output", type=str, default="radgraph_processed_output.jsonl")
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=256, help="reports per worker task")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,124 @@
+"""
+Frontal/lateral pairing over `mimic-cxr-2.0.0-metadata.csv`, vectorised.
+
+Replaces the row-by-row `map_view` / `infer_view_from_filename` passes and the per-study
+directory checks in `Data_preprocess.ipynb`:
+- ViewPosition is mapped once per distinct value through a categorical lookup.
+- The best frontal and lateral image of every study are chosen with one sort and groupby.
+  PA is preferred over AP over the other frontal views, and LATERAL over LL over the rest.
+- Image availability, if wanted, comes from a single walk of `--image-root`, not from
+  `exists()` calls per study.
+
+    python -m llava_phi.data.pair_views --metadata mimic-cxr-2.0.0-metadata.csv \
+        --output valid_pa_lateral_studies.csv
+
+The output has one row per study: subject_id, study_id, the chosen dicom ids and views,
+and the `frontal` / `lateral` paths (`<study_id>/0.jpeg`, `<study_id>/1.jpeg`) used
+downstream.  It can be passed to `extract_reports --valid-ids` directly.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+FRONTAL, LATERAL = 0, 1
+# preference order within each side, best first
+FRONTAL_VIEWS = ['PA', 'AP', 'AP AXIAL', 'PA LLD', 'AP LLD', 'AP RLD', 'PA RLD', 'LPO', 'RAO', 'LAO']
+LATERAL_VIEWS = ['LATERAL', 'LL', 'XTABLE LATERAL', 'SWIMMERS']
+VIEW_LABELS = {**{v: FRONTAL for v in FRONTAL_VIEWS}, **{v: LATERAL for v in LATERAL_VIEWS}}
+VIEW_RANKS = {**{v: i for i, v in enumerate(FRONTAL_VIEWS)}, **{v: i for i, v in enumerate(LATERAL_VIEWS)}}
+
+
+def _lookup(values, table, missing):
+    """`table[value.strip().upper()]` for every value, computed once per distinct value."""
+    categorical = pd.Categorical(values)
+    per_category = np.array([table.get(str(c).strip().upper(), missing) for c in categorical.categories] + [missing])
+    # code -1 (NaN) picks the trailing `missing`
+    return per_category[categorical.codes]
+
+
+def map_views(view_positions):
+    """0 for frontal, 1 for lateral, -1 for anything else or missing."""
+    return _lookup(view_positions, VIEW_LABELS, -1)
+
+
+def infer_views_from_filenames(filenames):
+    """Same rule as `infer_view_from_filename`: a frontal view name anywhere in the name, else a lateral one."""
+    names = pd.Series(filenames, dtype=object).str.upper()
+    frontal = names.str.contains("|".join(FRONTAL_VIEWS), regex=True)
+    lateral = names.str.contains("|".join(LATERAL_VIEWS), regex=True)
+    return np.where(frontal, FRONTAL, np.where(lateral, LATERAL, -1))
+
+
+def select_pairs(metadata):
+    """One row per study with both views, taking the best-ranked image of each side."""
+    df = metadata[["subject_id", "study_id", "dicom_id", "ViewPosition"]].copy()
+    df["view_label"] = map_views(df["ViewPosition"])
+    df = df[df["view_label"] >= 0]
+    df["view_rank"] = _lookup(df["ViewPosition"], VIEW_RANKS, len(FRONTAL_VIEWS))
+    df = df.sort_values(["study_id", "view_label", "view_rank", "dicom_id"], kind="stable")
+    best = df.groupby(["study_id", "view_label"], sort=False).head(1)
+
+    frontal = best[best["view_label"] == FRONTAL].set_index("study_id")
+    lateral = best[best["view_label"] == LATERAL].set_index("study_id")
+    pairs = frontal[["subject_id", "dicom_id", "ViewPosition"]].join(
+        lateral[["dicom_id", "ViewPosition"]], how="inner", lsuffix="_frontal", rsuffix="_lateral")
+    pairs = pairs.reset_index().rename(columns={
+        "dicom_id_frontal": "frontal_dicom_id", "dicom_id_lateral": "lateral_dicom_id",
+        "ViewPosition_frontal": "frontal_view", "ViewPosition_lateral": "lateral_view"})
+    pairs["frontal"] = pairs["study_id"] + "/0.jpeg"
+    pairs["lateral"] = pairs["study_id"] + "/1.jpeg"
+    return pairs[["subject_id", "study_id", "frontal_dicom_id", "lateral_dicom_id", "frontal_view", "lateral_view",
+                  "frontal", "lateral"]]
+
+
+def list_available_views(image_root):
+    """(study_id, view_label) for every image under `image_root/<study_id>/`, from one directory walk."""
+    study_ids, names = [], []
+    for entry in os.scandir(image_root):
+        if entry.is_dir():
+            for image in os.scandir(entry.path):
+                if image.name.lower().endswith(('.jpeg', '.jpg', '.png')):
+                    study_ids.append(entry.name)
+                    names.append(os.path.splitext(image.name)[0])
+    files = pd.DataFrame({"study_id": study_ids, "name": names})
+    # processed studies use 0.jpeg / 1.jpeg, collected ones the ViewPosition as file name
+    labels = pd.to_numeric(files["name"], errors="coerce")
+    inferred = infer_views_from_filenames(files["name"])
+    files["view_label"] = np.where(labels.isin([FRONTAL, LATERAL]), labels.fillna(-1), inferred).astype(int)
+    return files[files["view_label"] >= 0][["study_id", "view_label"]].drop_duplicates()
+
+
+def main(args):
+    start = time.perf_counter()
+    metadata = pd.read_csv(args.metadata, usecols=["dicom_id", "subject_id", "study_id", "ViewPosition"],
+                           dtype=str)
+    pairs = select_pairs(metadata)
+    print(f"{len(metadata)} images, {metadata['study_id'].nunique()} studies, "
+          f"{len(pairs)} with a frontal and a lateral view ({time.perf_counter() - start:.1f}s)")
+
+    if args.image_root:
+        available = list_available_views(args.image_root)
+        views_per_study = available.groupby("study_id")["view_label"].nunique()
+        complete = views_per_study[views_per_study == 2].index
+        pairs = pairs[pairs["study_id"].isin(complete)]
+        print(f"{len(pairs)} pairs have both images under {args.image_root}")
+
+    pairs.to_csv(args.output, index=False)
+    if args.study_ids_output:
+        pairs[["study_id"]].to_csv(args.study_ids_output, index=False)
+    print(f"Saved {len(pairs)} studies to {args.output} ({time.perf_counter() - start:.1f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metadata", type=str, default="mimic-cxr-2.0.0-metadata.csv")
+    parser.add_argument("--output", type=str, default="valid_pa_lateral_studies.csv")
+    parser.add_argument("--image-root", type=str, default=None,
+                        help="keep only studies with both views on disk, e.g. Processed_MIMIC")
+    parser.add_argument("--study-ids-output", type=str, default=None, help="also write study_ids.csv")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,209 @@
+"""
+Crop the black borders off the collected MIMIC-CXR views and write the training resolutions.
+
+Replaces the per-size passes in `Data_preprocess.ipynb`: every source image listed in
+`radgraph_processed_output.json` (or the JSONL from `extract_reports`) is decoded once,
+its border box found once, and all `--outputs` are written from that decode.  The default outputs are the 336 stretched
+and 224 padded sets.  Studies are spread over a process pool.
+
+    python -m llava_phi.data.preprocess_images --input-json radgraph_processed_output.json \
+        --source-root Processed_MIMIC --num-workers 16
+
+A manifest (`--manifest`, JSONL) records, for each source, its hash, the crop box and
+the output paths.  On a rerun, a source is skipped when its manifest entry covers the
+same outputs, they all exist and they are newer than the source.  With `--check-hash`,
+the source's SHA-1 must also match.
+"""
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from llava_phi.data.extract_reports import load_reports
+
+DEFAULT_OUTPUTS = ["MIMIC_Dataset336_stretched:336:stretch", "MIMIC_Dataset224_clean:224:pad"]
+
+
+def parse_output(spec):
+    """`root:size:mode`, mode being `stretch` or `pad`."""
+    root, size, mode = spec.rsplit(":", 2)
+    if mode not in ("stretch", "pad"):
+        raise argparse.ArgumentTypeError(f"unknown resize mode {mode!r} in {spec!r}")
+    return root, int(size), mode
+
+
+def crop_box(img, threshold=30):
+    """(x, y, w, h) of the pixels brighter than `threshold`, or None for an all-dark image."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    _, thresh = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY)
+    coords = cv2.findNonZero(thresh)
+    if coords is None:
+        return None
+    return cv2.boundingRect(coords)
+
+
+def crop_and_stretch(img, box, final_size=336):
+    """
+    Crop black borders and stretch to final_size x final_size.
+    """
+    if box is None:
+        return cv2.resize(img, (final_size, final_size))
+    x, y, w, h = box
+    cropped = img[y:y+h, x:x+w]
+    return cv2.resize(cropped, (final_size, final_size), interpolation=cv2.INTER_LANCZOS4)
+
+
+def crop_and_resize_with_padding(img, box, final_size=224):
+    """
+    Remove black borders and resize to square with padding (no stretching).
+    """
+    if box is None:
+        return cv2.resize(img, (final_size, final_size))
+    x, y, w, h = box
+    cropped = img[y:y+h, x:x+w]
+
+    scale = final_size / max(h, w)
+    new_w, new_h = int(w * scale), int(h * scale)
+    resized = cv2.resize(cropped, (new_w, new_h), interpolation=cv2.INTER_LANCZOS4)
+
+    top_pad = (final_size - new_h) // 2
+    bottom_pad = final_size - new_h - top_pad
+    left_pad = (final_size - new_w) // 2
+    right_pad = final_size - new_w - left_pad
+    return cv2.copyMakeBorder(resized, top_pad, bottom_pad, left_pad, right_pad,
+                              borderType=cv2.BORDER_CONSTANT, value=[0, 0, 0])
+
+
+RESIZE_MODES = {"stretch": crop_and_stretch, "pad": crop_and_resize_with_padding}
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def is_up_to_date(entry, output_paths, source_path, check_hash):
+    if entry is None or entry.get("outputs") != output_paths:
+        return False
+    source_mtime = os.path.getmtime(source_path)
+    for path in output_paths.values():
+        if not os.path.exists(path) or os.path.getmtime(path) < source_mtime:
+            return False
+    return not check_hash or entry.get("sha1") == file_hash(source_path)
+
+
+def process_image(rel_path, args, outputs, entry):
+    """Manifest entry for one source image, or None if it is already up to date."""
+    source_path = os.path.join(args.source_root, rel_path)
+    output_paths = {root: os.path.join(root, rel_path) for root, size, mode in outputs}
+    if not args.force and is_up_to_date(entry, output_paths, source_path, args.check_hash):
+        return None
+
+    with open(source_path, "rb") as f:
+        data = f.read()
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise FileNotFoundError(f"Failed to load image: {source_path}")
+    box = crop_box(img, args.threshold)
+    for (root, size, mode), path in zip(outputs, output_paths.values()):
+        processed = RESIZE_MODES[mode](img, box, final_size=size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write next to the target and rename, so an interrupted run never leaves a truncated image
+        tmp_path = "{}.tmp{}".format(*os.path.splitext(path))
+        if not cv2.imwrite(tmp_path, processed):
+            raise OSError(f"Failed to write {path}")
+        os.replace(tmp_path, path)
+    return {"source": rel_path, "sha1": hashlib.sha1(data).hexdigest(), "height": img.shape[0], "width": img.shape[1],
+            "bbox": list(box) if box is not None else None, "outputs": output_paths}
+
+
+def process_study(study, args, outputs, manifest):
+    cv2.setNumThreads(1)  # one image per process; don't oversubscribe the pool
+    results = []
+    for rel_path in study:
+        try:
+            results.append(("ok", rel_path, process_image(rel_path, args, outputs, manifest.get(rel_path))))
+        except Exception as e:
+            results.append(("error", rel_path, str(e)))
+    return results
+
+
+def load_manifest(path):
+    manifest = {}
+    if os.path.exists(path):
+        good_end = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                entry = json.loads(line)
+                manifest[entry["source"]] = entry  # later entries replace earlier ones
+                good_end += len(line)
+        # drop a line cut short by an interrupted run; that image is simply processed again
+        if good_end < os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(good_end)
+    return manifest
+
+
+def main(args):
+    outputs = [parse_output(spec) for spec in args.outputs]
+    data = load_reports(args.input_json)
+    studies = []
+    for info in data.values():
+        image_paths = info.get("image_paths", [])
+        if len(image_paths) != 2:
+            continue  # Skip non-dual-view entries
+        studies.append([rel_path.strip("/") for rel_path in image_paths])
+
+    if args.image_ids:
+        # duplicates are served from their canonical image, so only canonical images are written
+        from llava_phi.data.dedup_images import load_image_ids
+
+        image_ids = load_image_ids(args.image_ids)
+        studies = [[p for p in study if p not in image_ids or image_ids[p]["canonical_path"] == p]
+                   for study in studies]
+        studies = [study for study in studies if study]
+
+    manifest = load_manifest(args.manifest)
+    # each worker only needs the entries of its own study
+    study_manifests = [{p: manifest[p] for p in study if p in manifest} for study in studies]
+    num_written = num_skipped = num_failed = 0
+    with ProcessPoolExecutor(max_workers=args.num_workers) as pool, open(args.manifest, "a") as manifest_file:
+        results = pool.map(process_study, studies, [args] * len(studies), [outputs] * len(studies),
+                           study_manifests, chunksize=args.chunk_size)
+        for study_results in tqdm(results, total=len(studies), desc="Processing studies"):
+            for status, rel_path, payload in study_results:
+                if status == "error":
+                    num_failed += 1
+                    print(f"Failed to process {os.path.join(args.source_root, rel_path)}: {payload}")
+                elif payload is None:
+                    num_skipped += 1
+                else:
+                    num_written += 1
+                    manifest_file.write(json.dumps(payload) + "\n")
+    print(f"{num_written} images written, {num_skipped} up to date, {num_failed} failed; manifest: {args.manifest}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-json", type=str, default="radgraph_processed_output.json")
+    parser.add_argument("--source-root", type=str, default="Processed_MIMIC")
+    parser.add_argument("--outputs", type=str, nargs="+", default=DEFAULT_OUTPUTS,
+                        help="output_root:size:mode with mode stretch or pad")
+    parser.add_argument("--manifest", type=str, default="preprocess_manifest.jsonl")
+    parser.add_argument("--threshold", type=int, default=30, help="gray level below which a border is cropped")
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=16, help="studies sent to a worker at a time")
+    parser.add_argument("--check-hash", action="store_true", help="also compare source SHA-1s when skipping")
+    parser.add_argument("--force", action="store_true", help="rewrite every output")
+    parser.add_argument("--image-ids", type=str, default=None,
+                        help="image_ids.csv from dedup_images; non-canonical duplicates are skipped")
+    args = parser.parse_args()
+
+    main(args)
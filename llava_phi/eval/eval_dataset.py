@@ -0,0 +1,138 @@
+"""
+Eval data pipeline shared by the `model_vqa_*` entry points.
+
+`EvalDataset` tokenizes the prompt and decodes both views of a study in DataLoader
+workers, so image decoding overlaps with generation; `LeftPadCollator` left-pads prompts
+so a batch can be passed straight to `model.generate`.  `IndexQueueDataset` feeds the
+same pipeline from a queue of question indices shared between processes.  Questions are either dual-view
+(`frontal`, `lateral`, `recognition_input`) or single-image (`image`, `text`), in which
+case the one image is used for both views.
+"""
+import os
+import traceback
+
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader, IterableDataset
+
+from llava_phi.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
+from llava_phi.conversation import conv_templates
+from llava_phi.mm_utils import tokenizer_image_token, process_images
+
+
+def question_views(line):
+    if "frontal" in line:
+        return line["frontal"], line["lateral"]
+    return line["image"], line["image"]
+
+
+def question_text(line):
+    return line["recognition_input"] if "recognition_input" in line else line["text"]
+
+
+def question_key(line):
+    """Matches `ResultsWriter.key` of the answer written for `line`."""
+    return (*question_views(line), question_text(line))
+
+
+class EvalDataset(Dataset):
+    def __init__(self, questions, image_folder, tokenizer, image_processor, model_config, conv_mode):
+        self.questions = questions
+        self.image_folder = image_folder
+        self.tokenizer = tokenizer
+        self.image_processor = image_processor
+        self.model_config = model_config
+        self.conv_mode = conv_mode
+
+    def __len__(self):
+        return len(self.questions)
+
+    def build_prompt(self, line):
+        qs = question_text(line)
+        if DEFAULT_IMAGE_TOKEN not in qs:
+            if getattr(self.model_config, "mm_use_im_start_end", False):
+                qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + qs
+            else:
+                qs = DEFAULT_IMAGE_TOKEN + '\n' + qs
+        conv = conv_templates[self.conv_mode].copy()
+        conv.append_message(conv.roles[0], qs)
+        conv.append_message(conv.roles[1], None)
+        return conv.get_prompt()
+
+    def __getitem__(self, index):
+        line = self.questions[index]
+        views = [Image.open(os.path.join(self.image_folder, view)).convert('RGB') for view in question_views(line)]
+        images = process_images(views, self.image_processor, self.model_config)  # [2, C, H, W]
+        input_ids = tokenizer_image_token(self.build_prompt(line), self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt')
+        return {"input_ids": input_ids, "images": images, "index": index}
+
+
+class IndexQueueDataset(IterableDataset):
+    """
+    Items of `dataset` for the indices taken from `index_queue` until it yields None.  Every
+    DataLoader worker pulls from the queue and stops at its own None.  An item that fails to
+    load is reported as `("error", index, traceback)` on `error_queue` and skipped.
+    """
+
+    def __init__(self, dataset, index_queue, error_queue):
+        self.dataset = dataset
+        self.index_queue = index_queue
+        self.error_queue = error_queue
+
+    def __iter__(self):
+        while True:
+            index = self.index_queue.get()
+            if index is None:
+                return
+            try:
+                item = self.dataset[index]
+            except Exception:
+                self.error_queue.put(("error", index, traceback.format_exc()))
+                continue
+            yield item
+
+
+class LeftPadCollator:
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, batch):
+        max_len = max(item["input_ids"].shape[0] for item in batch)
+        input_ids = torch.full((len(batch), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+        for i, item in enumerate(batch):
+            length = item["input_ids"].shape[0]
+            input_ids[i, max_len - length:] = item["input_ids"]
+            attention_mask[i, max_len - length:] = 1
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "images": torch.stack([item["images"] for item in batch]),  # [B, 2, C, H, W]
+            "indices": [item["index"] for item in batch],
+        }
+
+
+def create_data_loader(questions, image_folder, tokenizer, image_processor, model_config, conv_mode,
+                       batch_size=1, num_workers=4, prefetch_factor=2, pin_memory=True,
+                       index_queue=None, error_queue=None, multiprocessing_context=None):
+    """With `index_queue`, the questions are read in the order their indices come off the queue."""
+    dataset = EvalDataset(questions, image_folder, tokenizer, image_processor, model_config, conv_mode)
+    if index_queue is not None:
+        dataset = IndexQueueDataset(dataset, index_queue, error_queue)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        collate_fn=LeftPadCollator(pad_token_id),
+        pin_memory=pin_memory and torch.cuda.is_available(),
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        multiprocessing_context=multiprocessing_context if num_workers > 0 else None)
+
+
+def add_data_loader_args(parser):
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--loader-workers", type=int, default=4, help="DataLoader workers decoding images")
+    parser.add_argument("--prefetch-factor", type=int, default=2)
+    parser.add_argument("--no-pin-memory", action="store_true")
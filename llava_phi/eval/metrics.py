@@ -0,0 +1,329 @@
+"""
+Report-generation metrics for prediction files.
+
+Reads the `Results_IU_Xray/` format (a JSON array of records with `reference` and
+`prediction`) or the JSONL written by the `model_vqa_*` scripts (`findings` and `text`).
+Lexical metrics are computed from a single tokenization per report, in a process pool.
+The model-based metrics are each loaded once and run in batches:
+- BERTScore
+- RadGraph F1 (simple, partial and complete)
+- CheXbert label accuracy and F1
+
+    python -m llava_phi.eval.metrics --predictions Results_IU_Xray/slava_llava_predict_IU.json \
+        --output-file scores.json
+
+BLEU, METEOR and ROUGE-L need `nltk` and `rouge-score` (plus the nltk `wordnet` corpus).
+BERTScore needs `bert_score`, RadGraph needs `radgraph` and CheXbert needs `f1chexbert`.
+With `--cache-dir`, reference-side results are kept between runs (see `score_cache.py`),
+so comparing checkpoints against the same references only scores the new predictions.
+"""
+import argparse
+import importlib.metadata
+import json
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from llava_phi.eval.score_cache import ReferenceCache
+
+LEXICAL_METRICS = ("bleu", "meteor", "rouge")
+MODEL_METRICS = ("bertscore", "radgraph", "chexbert")
+# same weights as the original notebook, so scores stay comparable with reported results
+BLEU_WEIGHTS = ((1, 0, 0, 0), (0.5, 0.5, 0, 0), (0.33, 0.33, 0.33, 0), (0.25, 0.25, 0.25, 0.25))
+CHEXBERT_5 = ["Cardiomegaly", "Edema", "Consolidation", "Atelectasis", "Pleural Effusion"]
+
+
+def load_samples(path):
+    """(reference, prediction) pairs from a JSON array or a JSONL file."""
+    with open(os.path.expanduser(path)) as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        records = json.loads(text)
+    else:
+        records = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    references, predictions = [], []
+    for record in records:
+        ref = record["reference"] if "reference" in record else record["findings"]
+        pred = record["prediction"] if "prediction" in record else record["text"]
+        if isinstance(ref, list) and isinstance(pred, list):
+            references.extend(ref)
+            predictions.extend(pred)
+        else:
+            references.append(ref)
+            predictions.append(pred)
+    assert len(references) == len(predictions), "Mismatch between references and predictions!"
+    return [r or "" for r in references], [p or "" for p in predictions]
+
+
+_rouge = None
+
+
+def _init_lexical_worker():
+    global _rouge
+    from rouge_score import rouge_scorer
+    _rouge = rouge_scorer.RougeScorer(['rougeL'], use_stemmer=True)
+
+
+def _lexical_scores(pairs, metrics):
+    """Scores for a chunk of lowercased (reference, prediction) pairs, plus seconds spent per metric."""
+    from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
+    from nltk.translate.meteor_score import meteor_score
+
+    smooth = SmoothingFunction().method1
+    scores = {name: [] for name in ("bleu1", "bleu2", "bleu3", "bleu4", "meteor", "rougeL")}
+    seconds = dict.fromkeys(metrics, 0.0)
+    for ref, pred in pairs:
+        ref_tokens, pred_tokens = ref.split(), pred.split()
+        if "bleu" in metrics:
+            start = time.perf_counter()
+            # n-gram counts are shared by all four weightings
+            bleu = sentence_bleu([ref_tokens], pred_tokens, weights=BLEU_WEIGHTS, smoothing_function=smooth)
+            for n, value in enumerate(bleu, start=1):
+                scores[f"bleu{n}"].append(value)
+            seconds["bleu"] += time.perf_counter() - start
+        if "meteor" in metrics:
+            start = time.perf_counter()
+            scores["meteor"].append(meteor_score([ref_tokens], pred_tokens))
+            seconds["meteor"] += time.perf_counter() - start
+        if "rouge" in metrics:
+            start = time.perf_counter()
+            scores["rougeL"].append(_rouge.score(ref, pred)['rougeL'].fmeasure)
+            seconds["rouge"] += time.perf_counter() - start
+    return {name: values for name, values in scores.items() if values}, seconds
+
+
+def lexical_metrics(references, predictions, metrics, num_workers=None, chunk_size=256):
+    pairs = [(r.strip().lower(), p.strip().lower()) for r, p in zip(references, predictions)]
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    scores, seconds = {}, dict.fromkeys(metrics, 0.0)
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_lexical_worker) as pool:
+        # map keeps chunk order, so per-sample scores line up with the input
+        for chunk_scores, chunk_seconds in pool.map(_lexical_scores, chunks, [metrics] * len(chunks)):
+            for name, values in chunk_scores.items():
+                scores.setdefault(name, []).extend(values)
+            for name, value in chunk_seconds.items():
+                seconds[name] += value
+    return {name: float(np.mean(values)) for name, values in scores.items()}, seconds
+
+
+def bertscore_metrics(references, predictions, batch_size=64, device=None, cache_dir=None):
+    """
+    Same scores as `BERTScorer(lang="en").score`, but token embeddings are computed once per
+    unique report and, with `cache_dir`, reference embeddings are reused across runs.
+    """
+    import torch
+    from bert_score import BERTScorer
+    from bert_score.utils import get_bert_embedding, greedy_cos_idf
+    from torch.nn.utils.rnn import pad_sequence
+
+    scorer = BERTScorer(lang="en", device=device)
+    refs = [r.strip().lower() for r in references]
+    hyps = [p.strip().lower() for p in predictions]
+    idf_dict = defaultdict(lambda: 1.0)
+    idf_dict[scorer._tokenizer.sep_token_id] = 0
+    idf_dict[scorer._tokenizer.cls_token_id] = 0
+
+    cache = ReferenceCache(cache_dir, "bertscore", scorer.hash) if cache_dir else None
+    stats = cache.get_tensors(set(refs), ("embedding", "idf")) if cache else {}
+    # longest first, as bert_score batches them
+    todo = sorted(set(refs + hyps) - set(stats), key=lambda x: len(x.split(" ")), reverse=True)
+    for start in range(0, len(todo), batch_size):
+        sen_batch = todo[start:start + batch_size]
+        embs, masks, padded_idf = get_bert_embedding(sen_batch, scorer._model, scorer._tokenizer, idf_dict,
+                                                     device=scorer.device)
+        embs, masks, padded_idf = embs.cpu(), masks.cpu(), padded_idf.cpu()
+        for i, sen in enumerate(sen_batch):
+            sequence_len = masks[i].sum().item()
+            stats[sen] = [embs[i, :sequence_len].clone(), padded_idf[i, :sequence_len].clone()]
+    if cache:
+        new_refs = set(refs).intersection(todo)
+        cache.put_tensors({sen: {"embedding": stats[sen][0], "idf": stats[sen][1]} for sen in new_refs})
+
+    def pad_batch_stats(sen_batch):
+        emb, idf = zip(*[stats[sen] for sen in sen_batch])
+        lens = torch.tensor([e.size(0) for e in emb])
+        emb_pad = pad_sequence([e.to(scorer.device) for e in emb], batch_first=True, padding_value=2.0)
+        idf_pad = pad_sequence([i.to(scorer.device) for i in idf], batch_first=True)
+        pad_mask = (torch.arange(int(lens.max())).expand(len(lens), -1) < lens.unsqueeze(1)).to(scorer.device)
+        return emb_pad, pad_mask, idf_pad
+
+    preds = []
+    with torch.no_grad():
+        for start in range(0, len(refs), batch_size):
+            P, R, F1 = greedy_cos_idf(*pad_batch_stats(refs[start:start + batch_size]),
+                                      *pad_batch_stats(hyps[start:start + batch_size]), False)
+            preds.append(torch.stack((P, R, F1), dim=-1).cpu())
+    precision, recall, f1 = torch.cat(preds).unbind(-1)
+    return {"bertscore_precision": precision.mean().item(), "bertscore_recall": recall.mean().item(),
+            "bertscore_f1": f1.mean().item()}
+
+
+def radgraph_annotations(radgraph, reports, batch_size=64):
+    """RadGraph annotations for each unique report; `radgraph` is a `radgraph.RadGraph`."""
+    unique = list(dict.fromkeys(reports))
+    annotations = {}
+    for i in range(0, len(unique), batch_size):
+        batch = unique[i:i + batch_size]
+        inference_dict = radgraph(batch)
+        annotations.update({report: inference_dict[str(j)] for j, report in enumerate(batch)})
+    return annotations
+
+
+def radgraph_metrics(references, predictions, batch_size=64, model_type="radgraph-xl", device=None,
+                     cache_dir=None):
+    import torch
+    from radgraph import RadGraph
+    from radgraph.rewards import compute_reward
+
+    non_empty = [i for i in range(len(references)) if references[i] and predictions[i]]
+    refs = set(references[i] for i in non_empty)
+    cache = None
+    if cache_dir:
+        cache = ReferenceCache(cache_dir, "radgraph", f"radgraph-{importlib.metadata.version('radgraph')}-{model_type}")
+    annotations = {}
+    for report in refs if cache else ():
+        value = cache.get(report)
+        if value is not None:
+            annotations[report] = value
+    # references and predictions go through one pass and repeated reports are annotated once
+    todo = [r for r in [predictions[i] for i in non_empty] + [references[i] for i in non_empty]
+            if r not in annotations]
+    if todo:
+        device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        radgraph = RadGraph(model_type=model_type, cuda=(device.index or 0) if device.type == "cuda" else -1)
+        new = radgraph_annotations(radgraph, todo, batch_size)
+        annotations.update(new)
+        if cache:
+            cache.put({report: value for report, value in new.items() if report in refs})
+
+    rewards = [(0., 0., 0.)] * len(references)
+    for i in non_empty:
+        rewards[i] = compute_reward(annotations[predictions[i]], annotations[references[i]], "all")
+    simple, partial, complete = (float(np.mean(values)) for values in zip(*rewards))
+    return {"radgraph_simple": simple, "radgraph_partial": partial, "radgraph_complete": complete}
+
+
+def chexbert_labels(chexbert, reports, batch_size=64, cache=None):
+    """
+    Binary labels for the 14 CheXbert observations ("rrg" mode), scoring `batch_size` reports
+    per forward.  With `cache`, cached reports are not scored and new ones are added.
+    """
+    import pandas as pd
+    import torch
+    from f1chexbert.f1chexbert import generate_attention_masks, tokenize
+
+    unique = list(dict.fromkeys(r.strip() for r in reports))
+    labels = {}
+    for report in unique if cache else ():
+        value = cache.get(report)
+        if value is not None:
+            labels[report] = value
+    unique = [r for r in unique if r not in labels]
+    encoded = tokenize(pd.Series(unique, dtype=object), chexbert.tokenizer)
+    # length-sorted batches keep padding small
+    order = sorted(range(len(unique)), key=lambda i: len(encoded[i]))
+    new = {}
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            index = order[start:start + batch_size]
+            lengths = [len(encoded[i]) for i in index]
+            batch = torch.full((len(index), max(lengths)), chexbert.tokenizer.pad_token_id, dtype=torch.long)
+            for row, i in enumerate(index):
+                batch[row, :lengths[row]] = torch.tensor(encoded[i])
+            attn_mask = generate_attention_masks(batch, lengths, chexbert.device)
+            out = chexbert.model(batch.to(chexbert.device), attn_mask)
+            classes = torch.stack([head.argmax(dim=1) for head in out], dim=1).cpu()
+            # present (1) and uncertain (3) count as positive, blank (0) and absent (2) as negative
+            positive = ((classes == 1) | (classes == 3)).int().tolist()
+            new.update({unique[i]: positive[row] for row, i in enumerate(index)})
+    if cache:
+        cache.put(new)
+    labels.update(new)
+    return [labels[r.strip()] for r in reports]
+
+
+def chexbert_metrics(references, predictions, batch_size=64, device=None, cache_dir=None):
+    from f1chexbert import F1CheXbert
+    from sklearn.metrics import accuracy_score, classification_report
+
+    chexbert = F1CheXbert(device=device)
+    cache = None
+    if cache_dir:
+        cache = ReferenceCache(cache_dir, "chexbert", f"f1chexbert-{importlib.metadata.version('f1chexbert')}-rrg")
+    refs = np.array(chexbert_labels(chexbert, references, batch_size, cache))
+    hyps = np.array(chexbert_labels(chexbert, predictions, batch_size))
+    index_5 = [chexbert.target_names.index(name) for name in CHEXBERT_5]
+    report = classification_report(refs, hyps, target_names=chexbert.target_names, output_dict=True,
+                                   zero_division=0)
+    report_5 = classification_report(refs[:, index_5], hyps[:, index_5], target_names=CHEXBERT_5,
+                                     output_dict=True, zero_division=0)
+    return {"chexbert_accuracy_5": float(accuracy_score(refs[:, index_5], hyps[:, index_5])),
+            "chexbert_micro_f1_14": report["micro avg"]["f1-score"],
+            "chexbert_macro_f1_14": report["macro avg"]["f1-score"],
+            "chexbert_micro_f1_5": report_5["micro avg"]["f1-score"],
+            "chexbert_macro_f1_5": report_5["macro avg"]["f1-score"]}
+
+
+def evaluate(references, predictions, metrics, args):
+    results, timing = {}, {}
+    lexical = [m for m in LEXICAL_METRICS if m in metrics]
+    if lexical:
+        start = time.perf_counter()
+        scores, seconds = lexical_metrics(references, predictions, lexical, args.num_workers, args.chunk_size)
+        results.update(scores)
+        timing.update({f"{name}_cpu": value for name, value in seconds.items()})
+        timing["lexical_wall"] = time.perf_counter() - start
+    if "bertscore" in metrics:
+        start = time.perf_counter()
+        results.update(bertscore_metrics(references, predictions, args.bertscore_batch_size, args.device,
+                                         args.cache_dir))
+        timing["bertscore"] = time.perf_counter() - start
+    if "radgraph" in metrics:
+        start = time.perf_counter()
+        results.update(radgraph_metrics(references, predictions, args.radgraph_batch_size,
+                                        args.radgraph_model, args.device, args.cache_dir))
+        timing["radgraph"] = time.perf_counter() - start
+    if "chexbert" in metrics:
+        start = time.perf_counter()
+        results.update(chexbert_metrics(references, predictions, args.chexbert_batch_size, args.device,
+                                        args.cache_dir))
+        timing["chexbert"] = time.perf_counter() - start
+    return results, timing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--predictions", type=str, required=True,
+                        help="JSON array with reference/prediction, or JSONL answers with findings/text")
+    parser.add_argument("--metrics", type=str, nargs="+", default=list(LEXICAL_METRICS + MODEL_METRICS),
+                        choices=LEXICAL_METRICS + MODEL_METRICS)
+    parser.add_argument("--num-workers", type=int, default=None, help="processes for the lexical metrics")
+    parser.add_argument("--chunk-size", type=int, default=256, help="pairs per lexical task")
+    parser.add_argument("--bertscore-batch-size", type=int, default=64)
+    parser.add_argument("--radgraph-batch-size", type=int, default=64, help="reports per RadGraph call")
+    parser.add_argument("--radgraph-model", type=str, default="radgraph-xl")
+    parser.add_argument("--chexbert-batch-size", type=int, default=64)
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help="keep reference-side BERTScore/RadGraph/CheXbert results here and reuse them next run")
+    parser.add_argument("--output-file", type=str, default=None)
+    args = parser.parse_args()
+
+    references, predictions = load_samples(args.predictions)
+    print(f"Loaded {len(references)} reference-prediction pairs from {args.predictions}")
+    results, timing = evaluate(references, predictions, args.metrics, args)
+
+    print("\n==== Evaluation Results ====")
+    for name, value in results.items():
+        print(f"{name}: {value:.4f}")
+    print("\n==== Timing (s) ====")
+    for name, value in timing.items():
+        print(f"{name}: {value:.2f}")
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump({"predictions": args.predictions, "num_samples": len(references), "metrics": results,
+                       "timing_s": timing}, f, indent=2)
@@ -5,14 +5,13 @@ import json
 from tqdm import tqdm
 import shortuuid
 
-from llava_phi.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 from llava_phi.conversation import conv_templates, SeparatorStyle
 from llava_phi.model.builder import load_pretrained_model
 from llava_phi.utils import disable_torch_init
-from llava_phi.mm_utils import tokenizer_image_token, process_images, get_model_name_from_path
-from torch.utils.data import Dataset, DataLoader
+from llava_phi.mm_utils import get_model_name_from_path
+from llava_phi.eval.eval_dataset import add_data_loader_args, create_data_loader
+from llava_phi.eval.results_writer import ResultsWriter
 
-from PIL import Image
 import math
 
 
@@ -27,47 +26,6 @@ def get_chunk(lst, n, k):
     return chunks[k]
 
 
-# Custom dataset class
-class CustomDataset(Dataset):
-    def __init__(self, questions, image_folder, tokenizer, image_processor, model_config):
-        self.questions = questions
-        self.image_folder = image_folder
-        self.tokenizer = tokenizer
-        self.image_processor = image_processor
-        self.model_config = model_config
-
-    def __getitem__(self, index):
-        line = self.questions[index]
-        image_file = line["image"]
-        qs = line["text"]
-        if self.model_config.mm_use_im_start_end:
-            qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + qs
-        else:
-            qs = DEFAULT_IMAGE_TOKEN + '\n' + qs
-
-        conv = conv_templates[args.conv_mode].copy()
-        conv.append_message(conv.roles[0], qs)
-        conv.append_message(conv.roles[1], None)
-        prompt = conv.get_prompt()
-        image = Image.open(os.path.join(self.image_folder, image_file)).convert('RGB')
-        image_tensor = process_images([image], self.image_processor, self.model_config)[0]
-
-        input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt')
-
-        return input_ids, image_tensor
-
-    def __len__(self):
-        return len(self.questions)
-
-
-# DataLoader
-def create_data_loader(questions, image_folder, tokenizer, image_processor, model_config, batch_size=1, num_workers=4):
-    assert batch_size == 1, "batch_size must be 1"
-    dataset = CustomDataset(questions, image_folder, tokenizer, image_processor, model_config)
-    data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False)
-    return data_loader
-
-
 def eval_model(args):
     # Model
     disable_torch_init()
@@ -77,53 +35,55 @@ def eval_model(args):
     
     questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")]
     questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
-    answers_file = os.path.expanduser(args.answers_file)
-    os.makedirs(os.path.dirname(answers_file), exist_ok=True)
-    ans_file = open(answers_file, "w")
-
-    data_loader = create_data_loader(questions, args.image_folder, tokenizer, image_processor, model.config)
-
-    for (input_ids, image_tensor), line in tqdm(zip(data_loader, questions), total=len(questions)):
-        idx = line["question_id"]
-        cur_prompt = line["text"]
-        
-        stop_str = conv_templates[args.conv_mode].sep if conv_templates[args.conv_mode].sep_style != SeparatorStyle.TWO else conv_templates[args.conv_mode].sep2
-        input_ids = input_ids.to(device='cuda', non_blocking=True)
-        
-        with torch.inference_mode():
-            output_ids = model.generate(
-                input_ids,
-                images=image_tensor.to(device='cuda', non_blocking=True),
-                do_sample=True if args.temperature > 0 else False,
-                temperature=args.temperature,
-                top_p=args.top_p,
-                # no_repeat_ngram_size=3,
-                num_beams=args.num_beams,
-                max_new_tokens=128,
-                eos_token_id=tokenizer.eos_token_id,  # End of sequence token
-                pad_token_id=tokenizer.eos_token_id,  # Pad token
-                use_cache=True
-            )
-
-        input_token_len = input_ids.shape[1]
-        n_diff_input_output = (input_ids != output_ids[:, :input_token_len]).sum().item()
-        
-        if n_diff_input_output > 0:
-            print(f'[Warning] {n_diff_input_output} output_ids are not the same as the input_ids')
-        outputs = tokenizer.batch_decode(output_ids[:, input_token_len:], skip_special_tokens=True)[0]
-        outputs = outputs.strip()
-        if outputs.endswith(stop_str):
-            outputs = outputs[:-len(stop_str)]
-        outputs = outputs.strip()
-
-        ans_id = shortuuid.uuid()
-        ans_file.write(json.dumps({"question_id": idx,
-                                   "prompt": cur_prompt,
-                                   "text": outputs,
-                                   "answer_id": ans_id,
-                                   "model_id": model_name,
-                                   "metadata": {}}) + "\n")
-        # ans_file.flush()
+    ans_file = ResultsWriter(args.answers_file, key_fields=("question_id", "prompt"))
+    questions = [line for line in questions if (line["question_id"], line["text"]) not in ans_file]
+
+    data_loader = create_data_loader(questions, args.image_folder, tokenizer, image_processor, model.config,
+                                     args.conv_mode, batch_size=args.batch_size, num_workers=args.loader_workers,
+                                     prefetch_factor=args.prefetch_factor, pin_memory=not args.no_pin_memory)
+    stop_str = conv_templates[args.conv_mode].sep if conv_templates[args.conv_mode].sep_style != SeparatorStyle.TWO else conv_templates[args.conv_mode].sep2
+
+    with tqdm(total=len(questions)) as progress:
+        for batch in data_loader:
+            input_ids = batch["input_ids"].to(model.device, non_blocking=True)
+
+            with torch.inference_mode():
+                output_ids = model.generate(
+                    input_ids,
+                    attention_mask=batch["attention_mask"].to(model.device, non_blocking=True),
+                    images=batch["images"].to(model.device, dtype=model.dtype, non_blocking=True),
+                    do_sample=True if args.temperature > 0 else False,
+                    temperature=args.temperature,
+                    top_p=args.top_p,
+                    # no_repeat_ngram_size=3,
+                    num_beams=args.num_beams,
+                    max_new_tokens=args.max_new_tokens,
+                    eos_token_id=tokenizer.eos_token_id,  # End of sequence token
+                    pad_token_id=tokenizer.eos_token_id,  # Pad token
+                    use_cache=True
+                )
+
+            input_token_len = input_ids.shape[1]
+            n_diff_input_output = (input_ids != output_ids[:, :input_token_len]).sum().item()
+
+            if n_diff_input_output > 0:
+                print(f'[Warning] {n_diff_input_output} output_ids are not the same as the input_ids')
+            outputs = tokenizer.batch_decode(output_ids[:, input_token_len:], skip_special_tokens=True)
+            for index, text in zip(batch["indices"], outputs):
+                line = questions[index]
+                text = text.strip()
+                if text.endswith(stop_str):
+                    text = text[:-len(stop_str)]
+                text = text.strip()
+
+                ans_id = shortuuid.uuid()
+                ans_file.write({"question_id": line["question_id"],
+                                "prompt": line["text"],
+                                "text": text,
+                                "answer_id": ans_id,
+                                "model_id": model_name,
+                                "metadata": {}})
+            progress.update(len(batch["indices"]))
     ans_file.close()
 
 if __name__ == "__main__":
@@ -139,6 +99,8 @@ if __name__ == "__main__":
     parser.add_argument("--temperature", type=float, default=0.2)
     parser.add_argument("--top_p", type=float, default=None)
     parser.add_argument("--num_beams", type=int, default=1)
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    add_data_loader_args(parser)
     args = parser.parse_args()
 
     eval_model(args)
@@ -0,0 +1,174 @@
+"""
+Run `model_vqa_slava_cxr` over a question file with several worker processes.
+
+Each worker loads its own model copy (round-robin over `--devices`) and pulls question
+indices from a shared queue, so a slow study never holds up a whole static chunk.  The
+indices go through the shared eval DataLoader (`--loader-workers`, `--prefetch-factor`,
+`--batch-size`), so the next batch is decoded while the current one generates.  Answers
+are streamed back to the parent and written in question order; questions already in
+`--answers-file` are skipped, so an interrupted run can simply be restarted.  A resumed run
+appends after the earlier answers, so the file is rewritten in question order at the end.
+
+    python -m llava_phi.eval.model_vqa_parallel --model-path checkpoints/dual-view-slava-merged \
+        --question-file test.jsonl --image-folder images --answers-file answers.jsonl \
+        --conv-mode v0 --num-workers 4 --devices cuda:0 cuda:1
+"""
+import argparse
+import json
+import os
+import queue
+import time
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+from llava_phi.eval.eval_dataset import add_data_loader_args, create_data_loader, question_key
+from llava_phi.eval.model_vqa_slava_cxr import add_generation_args, generate_answers, load_ngram_index
+from llava_phi.eval.results_writer import KEY_FIELDS, ResultsWriter
+from llava_phi.mm_utils import get_model_name_from_path
+from llava_phi.model.builder import load_pretrained_model
+from llava_phi.utils import disable_torch_init
+
+
+def worker_loop(worker_idx, device, args, questions, task_queue, result_queue):
+    if args.threads_per_worker:
+        torch.set_num_threads(args.threads_per_worker)
+    try:
+        disable_torch_init()
+        model_path = os.path.expanduser(args.model_path)
+        model_name = get_model_name_from_path(model_path)
+        tokenizer, model, image_processor, _ = load_pretrained_model(
+            model_path, args.model_base, model_name, device_map=device, device=device)
+        ngram_index = load_ngram_index(args)
+        # --ngram-index drafts one study at a time
+        batch_size = 1 if ngram_index is not None else args.batch_size
+        # a spawned process defaults to spawning its own children, which would re-import torch in every
+        # loader worker; the loader workers only decode images, so forking them is safe
+        loader_context = "fork" if "fork" in mp.get_all_start_methods() else None
+        data_loader = create_data_loader(questions, args.image_folder, tokenizer, image_processor, model.config,
+                                         args.conv_mode, batch_size=batch_size, num_workers=args.loader_workers,
+                                         prefetch_factor=args.prefetch_factor, pin_memory=not args.no_pin_memory,
+                                         index_queue=task_queue, error_queue=result_queue,
+                                         multiprocessing_context=loader_context)
+    except Exception:
+        result_queue.put(("fatal", worker_idx, traceback.format_exc()))
+        return
+
+    for batch in data_loader:
+        try:
+            answers = generate_answers(batch, questions, model, tokenizer, model_name, args, ngram_index)
+        except Exception:
+            error = traceback.format_exc()
+            for index in batch["indices"]:
+                result_queue.put(("error", index, error))
+            continue
+        for index, answer in zip(batch["indices"], answers):
+            result_queue.put(("ok", index, answer))
+
+
+def sort_answers(path, questions):
+    """Rewrites `path` in question order with one read and one atomic rename; unknown answers go last."""
+    order = {}
+    for index, line in enumerate(questions):
+        order.setdefault(question_key(line), index)
+
+    def position(line):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return len(questions)
+        return order.get(tuple(record.get(field) for field in KEY_FIELDS), len(questions))
+
+    with open(path, "r") as f:
+        lines = f.readlines()
+    sorted_lines = sorted(lines, key=position)  # stable, so duplicates keep their order
+    if sorted_lines == lines:
+        return
+    with open(path + ".tmp", "w") as f:
+        f.writelines(sorted_lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def eval_model(args):
+    questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r") if q.strip()]
+    ans_file = ResultsWriter(args.answers_file)
+    todo = [index for index, line in enumerate(questions) if question_key(line) not in ans_file]
+    if len(todo) < len(questions):
+        print(f"Resuming {args.answers_file}: {len(questions) - len(todo)} questions already answered")
+    if not todo:
+        ans_file.close()
+        sort_answers(ans_file.path, questions)
+        return
+
+    ctx = mp.get_context("spawn")
+    task_queue, result_queue = ctx.Queue(), ctx.Queue()
+    for index in todo:
+        task_queue.put(index)
+    # one end marker per DataLoader worker of every model worker (the model worker itself with 0)
+    for _ in range(args.num_workers * max(args.loader_workers, 1)):
+        task_queue.put(None)
+
+    devices = args.devices or ["cuda" if torch.cuda.is_available() else "cpu"]
+    workers = []
+    for worker_idx in range(args.num_workers):
+        device = devices[worker_idx % len(devices)]
+        p = ctx.Process(target=worker_loop, args=(worker_idx, device, args, questions, task_queue, result_queue))
+        p.start()
+        workers.append(p)
+
+    # answers arrive out of order; hold them until every earlier question is settled
+    pending, position, num_failed = {}, 0, 0
+    start = time.time()
+    with ans_file, tqdm(total=len(todo)) as progress:
+        while position < len(todo):
+            try:
+                status, index, payload = result_queue.get(timeout=5)
+            except queue.Empty:
+                if not any(p.is_alive() for p in workers):
+                    print(f"[WARNING] all workers exited with {len(todo) - position} questions left")
+                    break
+                continue
+            if status == "fatal":
+                print(f"[WARNING] worker {index} failed to start:\n{payload}")
+                continue
+            if status == "error":
+                num_failed += 1
+                print(f"[WARNING] question {index} failed:\n{payload}")
+                payload = None
+            pending[index] = payload
+            progress.update(1)
+            while position < len(todo) and todo[position] in pending:
+                answer = pending.pop(todo[position])
+                if answer is not None:
+                    ans_file.write(answer)
+                position += 1
+        # questions lost with a crashed worker leave gaps; keep everything that did finish
+        for index in sorted(pending):
+            if pending[index] is not None:
+                ans_file.write(pending[index])
+
+    for p in workers:
+        p.join()
+    sort_answers(ans_file.path, questions)
+    elapsed = time.time() - start
+    print(f"{position - num_failed} answers, {num_failed} failed, {elapsed:.1f}s "
+          f"({position / max(elapsed, 1e-6):.2f} questions/s with {args.num_workers} workers)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_generation_args(parser)
+    add_data_loader_args(parser)
+    parser.add_argument("--num-workers", type=int, default=1, help="model processes")
+    parser.add_argument("--devices", type=str, nargs="+", default=None,
+                        help="devices assigned to workers round-robin, e.g. cuda:0 cuda:1 (default: cuda or cpu)")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="torch intra-op threads per worker, useful for CPU runs")
+    args = parser.parse_args()
+    print(args)
+
+    eval_model(args)
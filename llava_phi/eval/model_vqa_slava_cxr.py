@@ -5,15 +5,20 @@ import json
 from tqdm import tqdm
 import shortuuid
 
-from llava_phi.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 from llava_phi.conversation import conv_templates, SeparatorStyle
 from llava_phi.model.builder import load_pretrained_model
 from llava_phi.utils import disable_torch_init
-from llava_phi.mm_utils import tokenizer_image_token, get_model_name_from_path, KeywordsStoppingCriteria
+from llava_phi.mm_utils import get_model_name_from_path, KeywordsStoppingCriteria
+from llava_phi.ngram_index import NgramIndex, draft_generate
+from llava_phi.eval.eval_dataset import add_data_loader_args, create_data_loader, question_key, question_text, \
+    question_views
+from llava_phi.eval.results_writer import ResultsWriter
+from llava_phi.profiling import enable_profiling
 
-from PIL import Image
 import math
 
+NO_REPEAT_NGRAM_SIZE = 3
+
 
 def split_list(lst, n):
     """Split a list into n (roughly) equal-sized chunks"""
@@ -26,95 +31,139 @@ def get_chunk(lst, n, k):
     return chunks[k]
 
 
-def eval_model(args):
-    # Model
-    disable_torch_init()
-    model_path = os.path.expanduser(args.model_path)
-    model_name = get_model_name_from_path(model_path)
-    tokenizer, model, image_processor, context_len = load_pretrained_model(model_path, args.model_base, model_name)
-
-    #print(model)
-    questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")]
-    questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
-    answers_file = os.path.expanduser(args.answers_file)
-    dir_path = os.path.dirname(args.answers_file)
-    if dir_path:  # only create directory if it's not empty
-        os.makedirs(dir_path, exist_ok=True)
-    ans_file = open(answers_file, "w")
-    questions=questions[:100]
-    for line in tqdm(questions):
-        idx = line["frontal"].split("/")[0]
-        image_file = line["frontal"]
-        qs = line["recognition_input"]
-        findings =line["findings"]
-        cur_prompt = qs
-        # if model.config.mm_use_im_start_end:
-        #     qs = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + qs
-        # else:
-        #     qs = DEFAULT_IMAGE_TOKEN + '\n' + qs
-
-        conv = conv_templates[args.conv_mode].copy()
-        conv.append_message(conv.roles[0], qs)
-        conv.append_message(conv.roles[1], None)
-        prompt = conv.get_prompt()
-        input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).cuda()
-
-        image = Image.open(os.path.join(args.image_folder, image_file))
-        image_tensor = image_processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
-
-        stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
-        keywords = [stop_str]
-        stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, input_ids)
-
+def generate_answers(batch, questions, model, tokenizer, model_name, args, ngram_index=None):
+    """Generate for one batch from `create_data_loader` and return the answer records."""
+    conv = conv_templates[args.conv_mode]
+    stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+    input_ids = batch["input_ids"].to(model.device, non_blocking=True)
+    attention_mask = batch["attention_mask"].to(model.device, non_blocking=True)
+    images = batch["images"].to(model.device, dtype=model.dtype, non_blocking=True)
+    stopping_criteria = KeywordsStoppingCriteria([stop_str], tokenizer, input_ids)
+
+    if ngram_index is not None and input_ids.shape[0] == 1:
+        output_ids, _ = draft_generate(
+            model,
+            input_ids,
+            images=images,
+            index=ngram_index,
+            max_new_tokens=args.max_new_tokens,
+            eos_token_id=tokenizer.eos_token_id,
+            stopping_criteria=stopping_criteria,
+            no_repeat_ngram_size=NO_REPEAT_NGRAM_SIZE)
+    else:
         with torch.inference_mode():
             output_ids = model.generate(
                 input_ids,
-                images=image_tensor.unsqueeze(0).cuda(),
+                attention_mask=attention_mask,
+                images=images,
                 do_sample=True if args.temperature > 0 else False,
                 top_p=args.top_p,
                 num_beams=args.num_beams,
-                no_repeat_ngram_size=3,
+                no_repeat_ngram_size=NO_REPEAT_NGRAM_SIZE,
                 eos_token_id=tokenizer.eos_token_id,  # End of sequence token
                 pad_token_id=tokenizer.eos_token_id,  # Pad token
                 max_new_tokens=args.max_new_tokens,
+                stopping_criteria=[stopping_criteria],
                 use_cache=True)
 
-        input_token_len = input_ids.shape[1]
-        #print(output_ids[:, input_token_len:])
-        n_diff_input_output = (input_ids != output_ids[:, :input_token_len]).sum().item()
-        if n_diff_input_output > 0:
-            print(f'[Warning] {n_diff_input_output} output_ids are not the same as the input_ids')
-        outputs = tokenizer.batch_decode(output_ids[:, input_token_len:], skip_special_tokens=True)[0]
-        outputs = outputs.strip()
-        if outputs.endswith(stop_str):
-            outputs = outputs[:-len(stop_str)]
-        outputs = outputs.strip()
-
-        ans_id = shortuuid.uuid()
-        ans_file.write(json.dumps({"question_id": idx,
-                                   "image_id": image_file,
-                                   "prompt": cur_prompt,
-                                   "text": outputs,
-                                   "findings": findings,
-                                   "model_id": model_name,
-                                   "metadata": {}}) + "\n")
-        ans_file.flush()
+    input_token_len = input_ids.shape[1]
+    n_diff_input_output = (input_ids != output_ids[:, :input_token_len]).sum().item()
+    if n_diff_input_output > 0:
+        print(f'[Warning] {n_diff_input_output} output_ids are not the same as the input_ids')
+    outputs = tokenizer.batch_decode(output_ids[:, input_token_len:], skip_special_tokens=True)
+
+    answers = []
+    for index, text in zip(batch["indices"], outputs):
+        line = questions[index]
+        text = text.strip()
+        if stop_str in text:
+            text = text[:text.index(stop_str)]
+        frontal, lateral = question_views(line)
+        answers.append({"question_id": frontal.split("/")[0],
+                        "image_id": frontal,
+                        "frontal": frontal,
+                        "lateral": lateral,
+                        "prompt": question_text(line),
+                        "text": text.strip(),
+                        "findings": line.get("findings"),
+                        "model_id": model_name,
+                        "metadata": {}})
+    return answers
+
+
+def load_ngram_index(args):
+    ngram_index = NgramIndex(args.ngram_index) if args.ngram_index else None
+    if ngram_index is not None and (args.temperature > 0 or args.num_beams > 1):
+        print('[WARNING] --ngram-index only applies to greedy decoding, falling back to model.generate')
+        ngram_index = None
+    return ngram_index
+
+
+def eval_model(args):
+    # Model
+    disable_torch_init()
+    model_path = os.path.expanduser(args.model_path)
+    model_name = get_model_name_from_path(model_path)
+    tokenizer, model, image_processor, context_len = load_pretrained_model(model_path, args.model_base, model_name)
+
+    #print(model)
+    questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")]
+    questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
+    ans_file = ResultsWriter(args.answers_file)
+    if len(ans_file):
+        questions = [line for line in questions if question_key(line) not in ans_file]
+        print(f"Resuming {args.answers_file}: {len(ans_file)} answers found, {len(questions)} questions left")
+    ngram_index = load_ngram_index(args)
+    if ngram_index is not None and args.batch_size > 1:
+        print('[WARNING] --ngram-index drafts one study at a time, using --batch-size 1')
+        args.batch_size = 1
+
+    data_loader = create_data_loader(questions, args.image_folder, tokenizer, image_processor, model.config,
+                                     args.conv_mode, batch_size=args.batch_size, num_workers=args.loader_workers,
+                                     prefetch_factor=args.prefetch_factor, pin_memory=not args.no_pin_memory)
+    profiler = None
+    if getattr(args, "profile_output", None):
+        profiler = enable_profiling(memory=args.profile_memory)
+        if args.profile_memory:
+            profiler.attach(model)
+    with tqdm(total=len(questions)) as progress:
+        for batch in data_loader:
+            for answer in generate_answers(batch, questions, model, tokenizer, model_name, args, ngram_index):
+                ans_file.write(answer)
+            progress.update(len(batch["indices"]))
+            if profiler is not None:
+                profiler.step()
     ans_file.close()
+    if profiler is not None:
+        profiler.save(args.profile_output)
+        profiler.print_summary()
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+
+def add_generation_args(parser):
     parser.add_argument("--model-path", type=str, default="facebook/opt-350m")
     parser.add_argument("--model-base", type=str, default=None)
     parser.add_argument("--image-folder", type=str, default="")
     parser.add_argument("--question-file", type=str, default="tables/question.jsonl")
     parser.add_argument("--answers-file", type=str, default="answer.jsonl")
     parser.add_argument("--conv-mode", type=str, default="llava_v1")
-    parser.add_argument("--num-chunks", type=int, default=1)
-    parser.add_argument("--chunk-idx", type=int, default=0)
     parser.add_argument("--temperature", type=float, default=0.)
     parser.add_argument("--top_p", type=float, default=None)
     parser.add_argument("--num_beams", type=int, default=1)
     parser.add_argument("--max_new_tokens", type=int, default=512)
+    parser.add_argument("--ngram-index", type=str, default=None,
+                        help="n-gram index built by llava_phi/ngram_index.py; drafts tokens for greedy decoding")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_generation_args(parser)
+    add_data_loader_args(parser)
+    parser.add_argument("--num-chunks", type=int, default=1)
+    parser.add_argument("--chunk-idx", type=int, default=0)
+    parser.add_argument("--profile-output", type=str, default=None,
+                        help="time the forward stages per batch and write them to this JSON file")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="with --profile-output, record per-stage and per-module memory instead of times")
     args = parser.parse_args()
     print(args)
 
@@ -0,0 +1,80 @@
+"""
+Append-only JSONL results shared by the eval entry points.
+
+Finished keys (by default `(frontal, lateral, prompt)`) are indexed once when the file is
+opened, so a restarted run skips them without rereading or rewriting anything else.
+Records are flushed in batches and fsynced periodically; a line cut short by a crash is
+dropped on the next open.
+"""
+import json
+import os
+import time
+
+KEY_FIELDS = ("frontal", "lateral", "prompt")
+
+
+class ResultsWriter:
+    def __init__(self, path, key_fields=KEY_FIELDS, flush_every=16, fsync_interval=30.0):
+        self.path = os.path.expanduser(path)
+        self.key_fields = tuple(key_fields)
+        self.flush_every = flush_every
+        self.fsync_interval = fsync_interval
+        self.completed = set()
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            self._index_existing()
+        self.file = open(self.path, "a", buffering=1024 * 1024)
+        self.num_unflushed = 0
+        self.last_fsync = time.time()
+
+    def key(self, record):
+        return tuple(record.get(field) for field in self.key_fields)
+
+    def _index_existing(self):
+        good_end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    self.completed.add(self.key(json.loads(line)))
+                except ValueError:
+                    print(f"[WARNING] skipping unreadable line in {self.path}")
+                good_end += len(line)
+        if good_end < os.path.getsize(self.path):
+            print(f"[WARNING] dropping a partially written last line from {self.path}")
+            with open(self.path, "r+b") as f:
+                f.truncate(good_end)
+
+    def __contains__(self, key):
+        return key in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.completed.add(self.key(record))
+        self.num_unflushed += 1
+        if self.num_unflushed >= self.flush_every:
+            self.flush(fsync=time.time() - self.last_fsync >= self.fsync_interval)
+
+    def flush(self, fsync=True):
+        self.file.flush()
+        self.num_unflushed = 0
+        if fsync:
+            os.fsync(self.file.fileno())
+            self.last_fsync = time.time()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
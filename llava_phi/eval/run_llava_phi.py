@@ -6,6 +6,7 @@ from llava_phi.conversation import conv_templates, SeparatorStyle
 from llava_phi.model.builder import load_pretrained_model
 from llava_phi.utils import disable_torch_init
 from llava_phi.mm_utils import tokenizer_image_token, get_model_name_from_path
+from llava_phi.streaming import stream_generate
 
 from PIL import Image
 
@@ -51,13 +52,34 @@ def eval_model(args):
     conv.append_message(conv.roles[1], None)
     prompt = conv.get_prompt()
 
-    image = load_image(args.image_file)
-    image_tensor = image_processor.preprocess(image, return_tensors='pt')['pixel_values'].cuda()
+    images = [load_image(args.image_file)]
+    if args.lateral_file is not None:
+        images.append(load_image(args.lateral_file))
+    image_tensor = image_processor.preprocess(images, return_tensors='pt')['pixel_values'].cuda()
+    if args.lateral_file is not None:
+        image_tensor = image_tensor.unsqueeze(0)  # [1, 2, C, H, W]
 
     input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).cuda()
 
     stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
 
+    if args.stream:
+        for chunk in stream_generate(
+                model,
+                tokenizer,
+                input_ids,
+                stop_strs=[stop_str],
+                images=image_tensor,
+                do_sample=True,
+                temperature=0.2,
+                max_new_tokens=1024,
+                eos_token_id=tokenizer.eos_token_id,
+                pad_token_id=tokenizer.eos_token_id,
+                use_cache=True):
+            print(chunk, end="", flush=True)
+        print()
+        return
+
     with torch.inference_mode():
         output_ids = model.generate(
             input_ids,
@@ -86,8 +108,10 @@ if __name__ == "__main__":
     parser.add_argument("--model-path", type=str, default="facebook/opt-350m")
     parser.add_argument("--model-base", type=str, default=None)
     parser.add_argument("--image-file", type=str, required=True)
+    parser.add_argument("--lateral-file", type=str, default=None)
     parser.add_argument("--query", type=str, required=True)
     parser.add_argument("--conv-mode", type=str, default=None)
+    parser.add_argument("--stream", action="store_true", help="print the report as tokens are generated")
     args = parser.parse_args()
 
     eval_model(args)
@@ -0,0 +1,95 @@
+"""
+Persistent reference-side cache for the model-based metrics in `llava_phi.eval.metrics`.
+
+References rarely change between checkpoints, so their BERTScore token embeddings,
+RadGraph annotations and CheXbert labels are kept on disk.  Entries are keyed by the
+SHA-1 of the report text, under a directory named after the scorer and a hash of its
+version string.  A new model, library version or setting therefore starts a fresh cache
+instead of reusing stale entries.  JSON values are appended to `entries.jsonl`; tensors
+go to one safetensors file per `put_tensors` call.
+"""
+import glob
+import hashlib
+import json
+import os
+
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+def report_hash(report):
+    return hashlib.sha1(report.encode("utf-8")).hexdigest()
+
+
+class ReferenceCache:
+    def __init__(self, cache_dir, scorer, version):
+        self.dir = os.path.join(os.path.expanduser(cache_dir), scorer,
+                                hashlib.sha1(version.encode("utf-8")).hexdigest()[:16])
+        os.makedirs(self.dir, exist_ok=True)
+        with open(os.path.join(self.dir, "version.txt"), "w") as f:
+            f.write(version + "\n")
+
+        self.entries_path = os.path.join(self.dir, "entries.jsonl")
+        self.entries = {}
+        if os.path.exists(self.entries_path):
+            good_end = 0
+            with open(self.entries_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    entry = json.loads(line)
+                    self.entries[entry["hash"]] = entry["value"]
+                    good_end += len(line)
+            # a line cut short by an interrupted run is dropped and recomputed
+            if good_end < os.path.getsize(self.entries_path):
+                with open(self.entries_path, "r+b") as f:
+                    f.truncate(good_end)
+
+        self.tensor_files = {}
+        for path in sorted(glob.glob(os.path.join(self.dir, "tensors-*.safetensors"))):
+            with safe_open(path, framework="pt") as f:
+                for name in f.keys():
+                    self.tensor_files[name] = path
+
+    def get(self, report):
+        return self.entries.get(report_hash(report))
+
+    def put(self, values):
+        """`values` maps report text to a JSON-serializable value."""
+        with open(self.entries_path, "a") as f:
+            for report, value in values.items():
+                key = report_hash(report)
+                self.entries[key] = value
+                f.write(json.dumps({"hash": key, "value": value}) + "\n")
+
+    def get_tensors(self, reports, names):
+        """{report: [tensor per name]} for the cached `reports`, opening each file once; misses are left out."""
+        wanted = {}
+        for report in reports:
+            key = report_hash(report)
+            paths = [self.tensor_files.get(f"{key}.{name}") for name in names]
+            if None not in paths:
+                wanted[report] = (key, paths)
+        by_file = {}
+        for report, (key, paths) in wanted.items():
+            for name, path in zip(names, paths):
+                by_file.setdefault(path, []).append((report, name, f"{key}.{name}"))
+        found = {report: {} for report in wanted}
+        for path, items in by_file.items():
+            with safe_open(path, framework="pt") as f:
+                for report, name, tensor_name in items:
+                    found[report][name] = f.get_tensor(tensor_name)
+        return {report: [tensors[name] for name in names] for report, tensors in found.items()}
+
+    def put_tensors(self, values):
+        """`values` maps report text to a dict of name -> CPU tensor."""
+        if not values:
+            return
+        state_dict = {f"{report_hash(report)}.{name}": tensor.contiguous()
+                      for report, tensors in values.items() for name, tensor in tensors.items()}
+        num_files = len(glob.glob(os.path.join(self.dir, "tensors-*.safetensors")))
+        path = os.path.join(self.dir, f"tensors-{num_files:05d}.safetensors")
+        tmp_path = path + ".tmp"
+        save_file(state_dict, tmp_path)
+        os.replace(tmp_path, path)
+        self.tensor_files.update({name: path for name in state_dict})
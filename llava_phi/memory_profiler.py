@@ -0,0 +1,277 @@
+"""
+Memory accounting for training and generation, installed with
+`llava_phi.profiling.enable_profiling(memory=True)`.
+
+`MemoryProfiler` has the same interface as `StageProfiler` and uses the same `stage(name)`
+ranges: vision towers, fusion, splice, backbone, `lm_head` (the logits), loss and, from
+`StageProfilerCallback`, the optimizer step.  At both ends of every range, it records:
+- allocated and reserved bytes;
+- the peak reached inside the range;
+- the process RSS.
+
+`attach(model)` adds forward hooks on the named modules of `LlavaPhiForCausalLM` up to
+`max_depth`.  Each module is charged the peak it raised above the allocation at its entry,
+and the bytes of the tensors it returned.
+
+On CUDA the numbers come from the caching allocator.  Nested ranges and modules keep their
+own peaks, because the peak counter is folded into a stack before every reset.  The
+counter is also folded into a window peak, and `pop_window_peaks()` hands that to
+`ThroughputCallback`, whose logging window would otherwise only see the peak since the
+last reset.  On CPU, `CpuAllocationTracker` stands in for the allocator counters while any
+range is open.  It counts the bytes of every storage an op creates until that storage is
+freed, temporaries included, and keeps a resettable peak.  Stages and modules then get
+allocated and peak bytes through the same peak stack, next to the process RSS.  CPU bytes
+only cover tensors created inside profiled ranges; parameters and inputs are not counted.
+With `record_history`, CUDA allocation stacks are also recorded and `save_snapshot()`
+writes them for https://pytorch.org/memory_viz.
+"""
+import contextlib
+import json
+import os
+import weakref
+from collections import defaultdict
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+GB = 2 ** 30
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss():
+    """Resident set size of this process in bytes (Linux), else the peak RSS from getrusage."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def tensor_bytes(output):
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, (list, tuple)):
+        return sum(tensor_bytes(o) for o in output)
+    if isinstance(output, dict):
+        return sum(tensor_bytes(o) for o in output.values())
+    if hasattr(output, "to_tuple"):  # ModelOutput
+        return sum(tensor_bytes(o) for o in output.to_tuple())
+    return 0
+
+
+class CpuAllocationTracker(TorchDispatchMode):
+    """Live and peak bytes of the CPU storages created by the ops run under this mode."""
+
+    def __init__(self):
+        super().__init__()
+        self.live = 0
+        self.peak = 0
+        self._tracked = set()  # data_ptr of every counted storage that is still alive
+
+    def reset_peak(self):
+        self.peak = self.live
+
+    def _free(self, data_ptr, nbytes):
+        self._tracked.discard(data_ptr)
+        self.live -= nbytes
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = None
+        for tensor in tree_flatten(out)[0]:
+            if not isinstance(tensor, torch.Tensor) or tensor.device.type != "cpu" or tensor.layout != torch.strided:
+                continue
+            storage = tensor.untyped_storage()
+            data_ptr, nbytes = storage.data_ptr(), storage.nbytes()
+            if not nbytes or data_ptr in self._tracked:
+                continue
+            if inputs is None:
+                inputs = {t.untyped_storage().data_ptr() for t in tree_flatten((args, kwargs))[0]
+                          if isinstance(t, torch.Tensor) and t.layout == torch.strided}
+            if data_ptr in inputs:  # a view or in-place result of a tensor made elsewhere
+                continue
+            self._tracked.add(data_ptr)
+            self.live += nbytes
+            self.peak = max(self.peak, self.live)
+            weakref.finalize(storage, self._free, data_ptr, nbytes)
+        return out
+
+
+class MemoryProfiler:
+    def __init__(self, device=None, record_history=False, max_depth=3):
+        self.cuda = torch.cuda.is_available() if device is None else torch.device(device).type == "cuda"
+        self.max_depth = max_depth
+        self.record_history = record_history and self.cuda
+        if self.record_history:
+            torch.cuda.memory._record_memory_history(max_entries=200000)
+        self._peaks = []  # running peak of every open range / module, innermost last
+        self.cpu_tracker = None if self.cuda else CpuAllocationTracker()
+        self._window_peaks = [0, 0]  # allocated, reserved since the last `pop_window_peaks`
+        self.current = {}
+        self.history = defaultdict(list)  # stage -> per-step record
+        self.modules = defaultdict(lambda: {"calls": 0, "peak_increase_bytes": 0, "output_bytes": 0,
+                                            "rss_increase_bytes": 0})
+        self.num_steps = 0
+        self.logged_steps = 0
+        self._hooks = []
+
+    # allocator peak, folded so an inner reset never loses an outer range's or the window's peak
+    def _reset_peak(self):
+        if not self.cuda:
+            peak = self.cpu_tracker.peak
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            self._window_peaks[0] = max(self._window_peaks[0], peak)
+            self.cpu_tracker.reset_peak()
+            return
+        peak = torch.cuda.max_memory_allocated()
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        self._window_peaks = [max(self._window_peaks[0], peak),
+                              max(self._window_peaks[1], torch.cuda.max_memory_reserved())]
+        torch.cuda.reset_peak_memory_stats()
+
+    def _max_allocated(self):
+        return torch.cuda.max_memory_allocated() if self.cuda else self.cpu_tracker.peak
+
+    def _open(self):
+        if not self.cuda and not self._peaks:
+            self.cpu_tracker.__enter__()  # counts allocations while any range is open
+        self._reset_peak()
+        self._peaks.append(0)
+
+    def _close(self):
+        peak = max(self._peaks.pop(), self._max_allocated())
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        elif not self.cuda:
+            self.cpu_tracker.__exit__(None, None, None)
+        return peak
+
+    def pop_window_peaks(self):
+        """Peak allocated and reserved bytes since the previous call; reserved is 0 on CPU."""
+        self._reset_peak()
+        peaks, self._window_peaks = tuple(self._window_peaks), [0, 0]
+        return peaks
+
+    def _allocated(self):
+        return torch.cuda.memory_allocated() if self.cuda else self.cpu_tracker.live
+
+    @contextlib.contextmanager
+    def range(self, name):
+        allocated, rss = self._allocated(), current_rss()
+        self._open()
+        try:
+            yield
+        finally:
+            peak = self._close()
+            record = self.current.setdefault(name, {"calls": 0, "allocated_before": allocated, "peak": 0,
+                                                    "rss_before": rss, "rss_peak": 0})
+            record["calls"] += 1
+            record["peak"] = max(record["peak"], peak)
+            record["allocated_after"] = self._allocated()
+            record["rss_after"] = current_rss()
+            record["rss_peak"] = max(record["rss_peak"], record["rss_after"])
+            if self.cuda:
+                record["reserved_after"] = torch.cuda.memory_reserved()
+
+    def add(self, name, seconds):
+        """Timings from dataloader workers are not memory; accepted for `StageProfiler` compatibility."""
+
+    def attach(self, model):
+        """Forward hooks on every module named at most `max_depth` levels deep."""
+        for name, module in model.named_modules():
+            if not name or name.count(".") >= self.max_depth:
+                continue
+            self._hooks.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self._hooks.append(module.register_forward_hook(self._post_hook(name)))
+        return self
+
+    def detach(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            module._memory_profiler_entry = (self._allocated(), current_rss())
+            self._open()
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, output):
+            peak = self._close()
+            allocated, rss = getattr(module, "_memory_profiler_entry", (0, 0))
+            stats = self.modules[name]
+            stats["calls"] += 1
+            stats["peak_increase_bytes"] = max(stats["peak_increase_bytes"], peak - allocated)
+            stats["output_bytes"] = max(stats["output_bytes"], tensor_bytes(output))
+            stats["rss_increase_bytes"] = max(stats["rss_increase_bytes"], current_rss() - rss)
+        return hook
+
+    def step(self):
+        for name in set(self.history) | set(self.current):
+            self.history[name].extend([None] * (self.num_steps - len(self.history[name])))
+            self.history[name].append(self.current.get(name))
+        self.current = {}
+        self.num_steps += 1
+
+    def log_metrics(self):
+        """Largest per-stage peak since the previous call, in GB."""
+        logs = {}
+        for name, records in self.history.items():
+            recent = [r["peak"] for r in records[self.logged_steps:] if r]
+            if recent:
+                logs[f"memory/{name}_peak_gb"] = round(max(recent) / GB, 4)
+        self.logged_steps = self.num_steps
+        return logs
+
+    def summary(self, top_modules=30):
+        stages = {}
+        for name, records in self.history.items():
+            records = [r for r in records if r]
+            stages[name] = {
+                "steps": len(records),
+                "max_peak_gb": max(r["peak"] for r in records) / GB,
+                "max_allocated_after_gb": max(r["allocated_after"] for r in records) / GB,
+                "max_allocated_increase_gb": max(r["allocated_after"] - r["allocated_before"] for r in records) / GB,
+            }
+            if self.cuda:
+                stages[name]["max_reserved_after_gb"] = max(r["reserved_after"] for r in records) / GB
+            stages[name].update({
+                "max_rss_gb": max(r["rss_peak"] for r in records) / GB,
+                "max_rss_increase_gb": max(r["rss_after"] - r["rss_before"] for r in records) / GB,
+            })
+        modules = sorted(self.modules.items(), key=lambda kv: -kv[1]["peak_increase_bytes"])[:top_modules]
+        modules = {name: dict(stats) for name, stats in modules}
+        summary = {"device": "cuda" if self.cuda else "cpu", "steps": self.num_steps, "stages": stages,
+                   "modules": modules}
+        if self.cuda:
+            stats = torch.cuda.memory_stats()
+            summary["allocator"] = {key: stats.get(key, 0) for key in
+                                    ("allocated_bytes.all.peak", "reserved_bytes.all.peak",
+                                     "num_alloc_retries", "num_ooms")}
+        return summary
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        if self.record_history:
+            self.save_snapshot(os.path.splitext(path)[0] + "_snapshot.pickle")
+
+    def save_snapshot(self, path):
+        torch.cuda.memory._dump_snapshot(path)
+        print(f"Allocator snapshot saved to {path}")
+
+    def print_summary(self):
+        summary = self.summary(top_modules=10)
+        print(f"Memory over {summary['steps']} steps on {summary['device']} (GB):")
+        for name, stats in sorted(summary["stages"].items(), key=lambda kv: -kv[1]["max_peak_gb"]):
+            print(f"  {name:<16} peak {stats['max_peak_gb']:>8.3f}  "
+                  f"+alloc {stats['max_allocated_increase_gb']:>8.3f}  rss {stats['max_rss_gb']:>8.3f}")
+        print("Top modules:")
+        for name, stats in summary["modules"].items():
+            print(f"  {name:<48} peak +{stats['peak_increase_bytes'] / GB:>8.3f}  "
+                  f"output {stats['output_bytes'] / GB:>8.3f}  rss +{stats['rss_increase_bytes'] / GB:>8.3f}")
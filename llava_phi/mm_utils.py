@@ -71,6 +71,15 @@ def get_model_name_from_path(model_path):
 
 
 class KeywordsStoppingCriteria(StoppingCriteria):
+    """
+    Stops a row once any keyword appears in its generated text.
+
+    Keyword token sequences are matched with an Aho-Corasick automaton run over the ids
+    generated since the last call, so no keyword tensors are moved or compared.  Because a
+    keyword can also be generated with a different tokenization, the recent tokens are
+    decoded as a fallback, but only when a new token could end a keyword.
+    """
+
     def __init__(self, keywords, tokenizer, input_ids):
         self.keywords = keywords
         self.keyword_ids = []
@@ -78,19 +87,90 @@ class KeywordsStoppingCriteria(StoppingCriteria):
             cur_keyword_ids = tokenizer(keyword).input_ids
             if len(cur_keyword_ids) > 1 and cur_keyword_ids[0] == tokenizer.bos_token_id:
                 cur_keyword_ids = cur_keyword_ids[1:]
-            self.keyword_ids.append(torch.tensor(cur_keyword_ids))
+            self.keyword_ids.append(cur_keyword_ids)
         self.tokenizer = tokenizer
         self.start_len = input_ids.shape[1]
-
-    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        assert output_ids.shape[0] == 1, "Only support batch size 1 (yet)"  # TODO
-        offset = min(output_ids.shape[1] - self.start_len, 3)
-        self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
-        for keyword_id in self.keyword_ids:
-            if output_ids[0, -keyword_id.shape[0]:] == keyword_id:
-                return True
-        outputs = self.tokenizer.batch_decode(output_ids[:, -offset:], skip_special_tokens=True)[0]
-        for keyword in self.keywords:
-            if keyword in outputs:
-                return True
-        return False
+        self.seen_len = self.start_len
+        self._may_end_keyword = {}
+        if not self.keyword_ids:  # nothing to match: never stops
+            return
+        self.max_keyword_len = max(len(keyword) for keyword in keywords)
+        self._build_automaton()
+        # the automaton state only depends on this many trailing ids, so it is rebuilt from
+        # them on every call and stays correct when beam search reorders the rows
+        self.context_len = max(len(keyword_ids) for keyword_ids in self.keyword_ids) - 1
+
+    def _build_automaton(self):
+        self.goto, self.fail, self.accept = [{}], [0], [False]
+        for keyword_ids in self.keyword_ids:
+            state = 0
+            for token_id in keyword_ids:
+                if token_id not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.accept.append(False)
+                    self.goto[state][token_id] = len(self.goto) - 1
+                state = self.goto[state][token_id]
+            self.accept[state] = True
+        frontier = list(self.goto[0].values())
+        while frontier:
+            next_frontier = []
+            for state in frontier:
+                for token_id, child in self.goto[state].items():
+                    if state:
+                        self.fail[child] = self._advance(self.fail[state], token_id)
+                    self.accept[child] = self.accept[child] or self.accept[self.fail[child]]
+                    next_frontier.append(child)
+            frontier = next_frontier
+
+    def _advance(self, state, token_id):
+        while state and token_id not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(token_id, 0)
+
+    def may_end_keyword(self, token_id):
+        """Whether the text of `token_id` could complete a keyword; cached per id."""
+        if token_id not in self._may_end_keyword:
+            text = self.tokenizer.decode([token_id], skip_special_tokens=True)
+            result = "\ufffd" in text
+            for candidate in {text, text.lstrip()}:
+                for keyword in self.keywords:
+                    if result or not candidate:
+                        break
+                    result = keyword in candidate or any(
+                        keyword.endswith(candidate[:p]) for p in range(1, min(len(candidate), len(keyword)) + 1))
+            self._may_end_keyword[token_id] = result
+        return self._may_end_keyword[token_id]
+
+    def _text_match(self, row_ids):
+        outputs = self.tokenizer.decode(row_ids, skip_special_tokens=True)
+        return any(keyword in outputs for keyword in self.keywords)
+
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if not self.keyword_ids:
+            return torch.zeros(output_ids.shape[0], dtype=torch.bool, device=output_ids.device)
+        cur_len = output_ids.shape[1]
+        if cur_len <= self.seen_len:  # reused for a new generation
+            self.seen_len = self.start_len
+        num_new = cur_len - self.seen_len
+        self.seen_len = cur_len
+        window_start = max(self.start_len, cur_len - num_new - self.context_len)
+        num_context = cur_len - num_new - window_start
+        stopped = []
+        for row, row_ids in enumerate(output_ids[:, window_start:].tolist()):
+            state, check_from, is_done = 0, None, False
+            for i, token_id in enumerate(row_ids):
+                state = self._advance(state, token_id)
+                if i < num_context:
+                    continue
+                if self.accept[state]:
+                    is_done = True
+                    break
+                if check_from is None and self.may_end_keyword(token_id):
+                    check_from = window_start + i
+            if not is_done and check_from is not None:
+                # a keyword ending at or after `check_from` spans at most max_keyword_len tokens
+                text_start = max(self.start_len, check_from - self.max_keyword_len)
+                is_done = self._text_match(output_ids[row, text_start:].tolist())
+            stopped.append(is_done)
+        return torch.tensor(stopped, dtype=torch.bool, device=output_ids.device)
@@ -0,0 +1,84 @@
+"""
+Activation checkpointing and CPU offload for the CLIP tower and the fusion head.
+
+`--gradient_checkpointing True` goes through `PreTrainedModel.gradient_checkpointing_enable`.
+That recomputes every layer of every encoder that supports it, or none.  With
+`--freeze_vision_tower False`, CLIP runs for `2 x B` images per step, and its layers plus
+the fusion head (cross-attention, gate, projector) keep their activations.
+`configure_activation_checkpointing` sets a separate policy for these two regions:
+
+    vision_every   recompute CLIP encoder layers 0, k, 2k, ... in backward (1 = all, 0 = none)
+    fusion         recompute `_fuse_views` in backward
+    offload        regions ("vision_tower", "fusion") whose activations that are still saved
+                   are kept in (pinned) host memory rather than on the device
+
+Layers that are recomputed save almost nothing, so with `offload` only the other layers
+move to host memory.  The CLIP part is installed through the per-layer checkpoint flag and
+function of `GradientCheckpointingLayer` where the installed transformers has it, else through
+the encoder-level hook of older `CLIPEncoder`s.  The policy is kept on `LlavaMetaModel` and
+re-applied after `gradient_checkpointing_enable/disable`.  The Phi backbone keeps following
+`--gradient_checkpointing`.  Recomputation uses the non-reentrant `torch.utils.checkpoint`,
+so frozen towers and inputs without grad need no special handling.
+"""
+import contextlib
+import functools
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+OFFLOAD_REGIONS = ("vision_tower", "fusion")
+
+
+def offload_to_cpu():
+    return torch.autograd.graph.save_on_cpu(pin_memory=torch.cuda.is_available())
+
+
+def configure_activation_checkpointing(model, vision_every=0, fusion=False, offload=()):
+    """`model` is `LlavaPhiForCausalLM` (or a PEFT wrapper of it)."""
+    unknown = set(offload) - set(OFFLOAD_REGIONS)
+    if unknown:
+        raise ValueError(f"Unknown offload regions {sorted(unknown)}; choose from {OFFLOAD_REGIONS}")
+    llava_model = model.get_model()
+    llava_model.activation_policy = {"vision_every": vision_every, "fusion": fusion, "offload": tuple(offload)}
+    apply_vision_policy(llava_model)
+    return llava_model.activation_policy
+
+
+def apply_vision_policy(llava_model):
+    policy = getattr(llava_model, "activation_policy", None)
+    if policy is None:
+        return
+    encoder = llava_model.get_vision_tower().vision_model.encoder
+    every = policy["vision_every"]
+    offload = "vision_tower" in policy["offload"]
+    if all(hasattr(layer, "gradient_checkpointing") for layer in encoder.layers):
+        # newer transformers: each layer is a `GradientCheckpointingLayer` that checks its own
+        # flag and hands its call to its own `_gradient_checkpointing_func`
+        encoder.gradient_checkpointing = False
+        for i, layer in enumerate(encoder.layers):
+            recompute = bool(every) and i % every == 0
+            layer.gradient_checkpointing = recompute or offload
+            layer._gradient_checkpointing_func = functools.partial(_run_layer, recompute, offload)
+        return
+    # older versions: `CLIPEncoder` hands each bound `layer.__call__` to its `_gradient_checkpointing_func`
+    recomputed = {id(layer) for i, layer in enumerate(encoder.layers) if every and i % every == 0}
+    encoder.gradient_checkpointing = bool(recomputed) or offload
+    encoder._gradient_checkpointing_func = lambda layer_call, *args: _run_layer(
+        id(layer_call.__self__) in recomputed, offload, layer_call, *args)
+
+
+def _run_layer(recompute, offload, layer_call, *args):
+    if recompute:
+        return checkpoint(layer_call, *args, use_reentrant=False)
+    with offload_to_cpu() if offload else contextlib.nullcontext():
+        return layer_call(*args)
+
+
+def run_fusion(llava_model, fuse, *args):
+    policy = getattr(llava_model, "activation_policy", None)
+    if policy is None or not (llava_model.training and torch.is_grad_enabled()):
+        return fuse(*args)
+    if policy["fusion"]:
+        return checkpoint(fuse, *args, use_reentrant=False)
+    with offload_to_cpu() if "fusion" in policy["offload"] else contextlib.nullcontext():
+        return fuse(*args)
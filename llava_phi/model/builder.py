@@ -6,9 +6,20 @@ from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig, BitsAn
 import torch
 from llava_phi.model import *
 from llava_phi.constants import DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
+from llava_phi.model.delta_checkpoint import is_delta_checkpoint, load_delta_model
+from llava_phi.model.merged_checkpoint import is_merged_checkpoint, load_merged_model
 
 
 def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="cuda", device="cuda"):
+    if is_merged_checkpoint(model_path) and not (load_8bit or load_4bit):
+        # exported by llava_phi.model.merged_checkpoint: LoRA already merged, BiomedCLIP included
+        print('Loading merged Dual-View SLaVA checkpoint...')
+        return load_merged_model(model_path, device=device)
+    if is_delta_checkpoint(model_path) and not (load_8bit or load_4bit):
+        # trainable parameters from a frozen-backbone run, overlaid on the base they reference
+        print('Loading Dual-View SLaVA delta checkpoint...')
+        return load_delta_model(model_path, model_base, device=device)
+
     kwargs = {"device_map": device_map}
     if load_8bit:
         kwargs['load_in_8bit'] = True
@@ -79,7 +90,7 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
                 model_path, 
                 config=config, 
                 use_safetensors=True, 
-                **kwargs).to("cuda")
+                **kwargs).to(device)
     else:
         # Load language model
         if model_base is not None:
@@ -116,6 +127,6 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
         context_len = model.config.max_sequence_length
     else:
         context_len = 2048
-    model.to(device="cuda")
+    model.to(device=device)
     print(kwargs)
     return tokenizer, model, image_processor, context_len
@@ -0,0 +1,137 @@
+"""
+Delta checkpoints for frozen-backbone stages.
+
+With `--freeze_backbone True` the optimizer only updates the parameters with
+`requires_grad`: the fusion head, the projector, LoRA and, with `--freeze_vision_tower
+False`, CLIP.  Saving the whole 2.7B model every `save_steps` rewrites frozen weights that
+never change.  A delta directory holds three things:
+- `delta_model.safetensors`: the trainable parameters and the dual-view modules of
+  `LlavaMetaModel` (the base has none, so they are always stored);
+- `delta_config.json`: the base checkpoint it applies to, with a fingerprint of that
+  checkpoint's files;
+- the usual `config.json`, plus the optimizer, scheduler and trainer state when it is a
+  Trainer checkpoint.
+
+`overlay_delta` loads a delta over a model built from the base, which is how
+`LLaVAPhiTrainer` resumes.  `load_delta_model` does the same for inference from
+`load_pretrained_model`.
+"""
+import hashlib
+import json
+import os
+
+from safetensors.torch import load_file, save_file
+
+DELTA_CONFIG_NAME = "delta_config.json"
+DELTA_WEIGHTS_NAME = "delta_model.safetensors"
+DELTA_FORMAT = "dual-view-slava-delta"
+# added on top of llavaPhi by the dual-view fusion; a base checkpoint does not carry them
+DUAL_VIEW_MODULES = ("med_feature_adapter", "fusion_weight", "cross_attention", "norm", "fuse_gate",
+                     "mm_projector", "segment_embedding", "pos_embed")
+
+
+def is_delta_checkpoint(model_path):
+    return os.path.exists(os.path.join(model_path, DELTA_CONFIG_NAME))
+
+
+def is_dual_view_parameter(name):
+    """`model.<module>...` for a module in `DUAL_VIEW_MODULES`, also under a PEFT `base_model.model.` prefix."""
+    parts = name.split(".")
+    return any(parts[i] == "model" and parts[i + 1] in DUAL_VIEW_MODULES for i in range(len(parts) - 1))
+
+
+def delta_state_dict(model):
+    """Trainable parameters and the dual-view modules; every parameter if nothing is frozen."""
+    return {name: p for name, p in model.named_parameters() if p.requires_grad or is_dual_view_parameter(name)}
+
+
+def base_fingerprint(base_path):
+    """sha1 over the config and the names and sizes of the weight files of a local base checkpoint."""
+    if not os.path.isdir(base_path):
+        return None  # a hub id; the revision is not pinned
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(base_path)):
+        path = os.path.join(base_path, name)
+        if name == "config.json":
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        elif name.endswith((".safetensors", ".bin")):
+            digest.update(f"{name}:{os.path.getsize(path)}".encode())
+    return digest.hexdigest()
+
+
+def write_delta_config(output_dir, model, names):
+    config = getattr(model, "config", None)
+    base_model = getattr(config, "_name_or_path", None)
+    delta_config = {
+        "format": DELTA_FORMAT,
+        "base_model": base_model,
+        "base_fingerprint": base_fingerprint(base_model) if base_model else None,
+        "peft": hasattr(model, "peft_config"),
+        "parameters": sorted(names),
+    }
+    with open(os.path.join(output_dir, DELTA_CONFIG_NAME), "w") as f:
+        json.dump(delta_config, f, indent=2)
+    if delta_config["peft"]:
+        # LoRA keys only make sense with the adapter layout they were trained with
+        model.peft_config["default"].save_pretrained(output_dir)
+
+
+def save_delta(model, output_dir):
+    """Synchronous save; `LLaVAPhiTrainer` writes the weights on its checkpoint thread instead."""
+    os.makedirs(output_dir, exist_ok=True)
+    state_dict = {name: p.detach().cpu().contiguous() for name, p in delta_state_dict(model).items()}
+    save_file(state_dict, os.path.join(output_dir, DELTA_WEIGHTS_NAME), metadata={"format": "pt"})
+    write_delta_config(output_dir, model, state_dict)
+    model.config.save_pretrained(output_dir)
+
+
+def load_delta_config(delta_path):
+    with open(os.path.join(delta_path, DELTA_CONFIG_NAME)) as f:
+        delta_config = json.load(f)
+    if delta_config.get("format") != DELTA_FORMAT:
+        raise ValueError(f"{delta_path} is not a Dual-View SLaVA delta checkpoint")
+    return delta_config
+
+
+def overlay_delta(model, delta_path, base_path=None):
+    """Loads the delta weights into `model`, which must already hold the base weights."""
+    delta_config = load_delta_config(delta_path)
+    base_path = base_path or delta_config["base_model"]
+    expected = delta_config.get("base_fingerprint")
+    if expected and base_path and base_fingerprint(base_path) not in (None, expected):
+        raise ValueError(f"{delta_path} was saved against a different base checkpoint than {base_path}")
+    state_dict = load_file(os.path.join(delta_path, DELTA_WEIGHTS_NAME), device="cpu")
+    result = model.load_state_dict(state_dict, strict=False)
+    if result.unexpected_keys:
+        raise ValueError(f"Delta parameters not in the model: {result.unexpected_keys[:10]}")
+    return model
+
+
+def load_delta_model(model_path, model_base=None, device="cuda", dtype=None):
+    """The base checkpoint with the delta overlaid; LoRA deltas are merged."""
+    from transformers import AutoTokenizer, CLIPImageProcessor
+
+    from llava_phi.model.language_model.configuration_llava_phi import LlavaPhiConfig
+    from llava_phi.model.language_model.llava_phi import LlavaPhiForCausalLM
+
+    delta_config = load_delta_config(model_path)
+    base_path = model_base or delta_config["base_model"]
+    config = LlavaPhiConfig.from_pretrained(model_path)
+    model = LlavaPhiForCausalLM.from_pretrained(base_path, config=config, low_cpu_mem_usage=True)
+    if delta_config["peft"]:
+        from peft import LoraConfig, get_peft_model
+
+        model = get_peft_model(model, LoraConfig.from_pretrained(model_path))
+    overlay_delta(model, model_path, base_path)
+    if delta_config["peft"]:
+        model = model.merge_and_unload()
+    model.to(device=device, dtype=dtype or model.dtype)
+    model.eval()
+
+    tokenizer_path = model_path if os.path.exists(os.path.join(model_path, "tokenizer_config.json")) else base_path
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=True)
+    image_processor_path = model_path if os.path.exists(os.path.join(model_path, "preprocessor_config.json")) else base_path
+    image_processor = CLIPImageProcessor.from_pretrained(image_processor_path)
+    context_len = getattr(model.config, "max_sequence_length", 2048)
+    return tokenizer, model, image_processor, context_len
@@ -12,6 +12,8 @@ from transformers.modeling_outputs import CausalLMOutputWithPast
 from ..llava_arch import LlavaMetaModel, LlavaMetaForCausalLM
 from transformers.utils import logging
 from .configuration_llava_phi import LlavaPhiConfig
+from llava_phi.profiling import stage
+from llava_phi.model.activation_checkpointing import apply_vision_policy
 
 logger = logging.get_logger(__name__)
 
@@ -37,10 +39,16 @@ class LlavaPhiForCausalLM(PhiPreTrainedModel, LlavaMetaForCausalLM, GenerationMi
     def get_model(self):
         return self.model
 
+    def _set_gradient_checkpointing(self, *args, **kwargs):
+        super()._set_gradient_checkpointing(*args, **kwargs)
+        # with a `configure_activation_checkpointing` policy, the CLIP tower follows it, not the backbone flag
+        apply_vision_policy(self.model)
+
     def forward(
             self,
             input_ids: torch.LongTensor = None,
             attention_mask: Optional[torch.Tensor] = None,
+            position_ids: Optional[torch.LongTensor] = None,
             past_key_values: Optional[List[torch.FloatTensor]] = None,
             inputs_embeds: Optional[torch.FloatTensor] = None,
             labels: Optional[torch.LongTensor] = None,
@@ -58,37 +66,45 @@ class LlavaPhiForCausalLM(PhiPreTrainedModel, LlavaMetaForCausalLM, GenerationMi
 
         input_ids, attention_mask, past_key_values, inputs_embeds, labels = self.prepare_inputs_labels_for_multimodal(
             input_ids, attention_mask, past_key_values, labels, images)
+        if position_ids is None and attention_mask is not None and not attention_mask.all():
+            # left-padded batch: count positions from each row's first real token
+            position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+            position_ids = position_ids[:, -(inputs_embeds if inputs_embeds is not None else input_ids).shape[1]:]
         # print(f"Images shape: {images.shape}")
         # decoder outputs consists of (dec_features, layer_state, dec_hidden, dec_attn)
-        outputs = self.model(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            past_key_values=past_key_values,
-            inputs_embeds=inputs_embeds,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict
-        )
+        with stage("backbone"):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                inputs_embeds=inputs_embeds,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict
+            )
 
         hidden_states = outputs[0]
-        logits = self.lm_head(hidden_states)
+        with stage("lm_head"):
+            logits = self.lm_head(hidden_states)
 
         loss = None
         if labels is not None:
-            # Shift so that tokens < n predict n
-            shift_logits = logits[..., :-1, :].contiguous()
-            shift_labels = labels[..., 1:].contiguous()
-            # Flatten the tokens
-            loss_fct = CrossEntropyLoss()
-            shift_logits = shift_logits.view(-1, self.config.vocab_size)
-            shift_labels = shift_labels.view(-1)
-            # Enable model/pipeline parallelism
-            shift_labels = shift_labels.to(shift_logits.device)
-            loss = loss_fct(shift_logits, shift_labels)
-            # print("Shift logits:", shift_logits.shape)
-            # print("Shift labels:", shift_labels.shape)
-            # print("Loss:", loss.item())
+            with stage("loss"):
+                # Shift so that tokens < n predict n
+                shift_logits = logits[..., :-1, :].contiguous()
+                shift_labels = labels[..., 1:].contiguous()
+                # Flatten the tokens
+                loss_fct = CrossEntropyLoss()
+                shift_logits = shift_logits.view(-1, self.config.vocab_size)
+                shift_labels = shift_labels.view(-1)
+                # Enable model/pipeline parallelism
+                shift_labels = shift_labels.to(shift_logits.device)
+                loss = loss_fct(shift_logits, shift_labels)
+                # print("Shift logits:", shift_logits.shape)
+                # print("Shift labels:", shift_labels.shape)
+                # print("Loss:", loss.item())
         if not return_dict:
             output = (logits,) + outputs[1:]
             return (loss,) + output if loss is not None else output
@@ -21,7 +21,10 @@ from transformers import AutoModel
 from .multimodal_encoder.clip_encoder import CLIPVisionTower
 from .multimodal_projector.builder import build_vision_projector
 from .language_model.configuration_llava_phi import LlavaPhiConfig, LlavaPhiVisionConfig, ProjectorConfig
-from llava_phi.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
+from llava_phi.profiling import stage
+from llava_phi.model.activation_checkpointing import run_fusion
+from llava_phi.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN, \
+    MEDICAL_VISION_TOWER
 
 
 class LlavaMetaModel:
@@ -83,9 +86,7 @@ class LlavaMetaModel:
         if not self._medical_vision_tower_initialized:
             from open_clip import create_model_from_pretrained
             
-            model, _ = create_model_from_pretrained(
-                "hf-hub:microsoft/BiomedCLIP-PubMedBERT_256-vit_base_patch16_224"
-            )
+            model, _ = create_model_from_pretrained(MEDICAL_VISION_TOWER)
             self.medical_vision_tower = model.visual
             
     
@@ -122,18 +123,24 @@ class LlavaMetaForCausalLM(ABC):
             model._init_medical_tower(device=images.device)
         
        
-        frontal_clip = model.vision_tower(images[0].unsqueeze(0))[0][0]
-        lateral_clip = model.vision_tower(images[1].unsqueeze(0))[0][0]
+        with stage("clip_tower"):
+            frontal_clip = model.vision_tower(images[0].unsqueeze(0))[0][0]
+            lateral_clip = model.vision_tower(images[1].unsqueeze(0))[0][0]
         
         
         with torch.no_grad():
-            frontal_med = model.medical_vision_tower(images[0].unsqueeze(0))
-            lateral_med = model.medical_vision_tower(images[1].unsqueeze(0))
+            with stage("medical_tower"):
+                frontal_med = model.medical_vision_tower(images[0].unsqueeze(0))
+                lateral_med = model.medical_vision_tower(images[1].unsqueeze(0))
             # print("frontal_med shape:", frontal_med.shape)
-            frontal_med = model.med_feature_adapter(frontal_med[0]) 
-            lateral_med = model.med_feature_adapter(lateral_med[0])
+            with stage("fusion"):
+                frontal_med = model.med_feature_adapter(frontal_med[0]) 
+                lateral_med = model.med_feature_adapter(lateral_med[0])
         
-       
+        with stage("fusion"):
+            return run_fusion(model, self._fuse_views, model, frontal_clip, lateral_clip, frontal_med, lateral_med)
+
+    def _fuse_views(self, model, frontal_clip, lateral_clip, frontal_med, lateral_med):
         weight = model.fusion_sigmoid(model.fusion_weight)
         frontal = weight * frontal_clip + (1-weight) * frontal_med
         lateral = weight * lateral_clip + (1-weight) * lateral_med
@@ -174,7 +181,10 @@ class LlavaMetaForCausalLM(ABC):
         vision_tower = self.get_vision_tower()
         if vision_tower is None or images is None or input_ids.shape[1] == 1:
             if past_key_values is not None and vision_tower is not None and images is not None and input_ids.shape[1] == 1:
-                attention_mask = torch.ones((attention_mask.shape[0], past_key_values[-1][-1].shape[-2] + 1), dtype=attention_mask.dtype, device=attention_mask.device)
+                # the cache is longer than the token-level mask by the spliced image features;
+                # keep the (left) padding of the mask and mark the extra positions as valid
+                target_len = past_key_values[-1][-1].shape[-2] + 1
+                attention_mask = torch.cat((attention_mask, attention_mask.new_ones((attention_mask.shape[0], target_len - attention_mask.shape[1]))), dim=1)
             return input_ids, attention_mask, past_key_values, None, labels
 
         if images.ndim == 5:
@@ -189,6 +199,10 @@ class LlavaMetaForCausalLM(ABC):
         else:
             image_features = self.encode_images(images)
 
+        with stage("splice"):
+            return self._splice_image_features(input_ids, attention_mask, past_key_values, labels, image_features)
+
+    def _splice_image_features(self, input_ids, attention_mask, past_key_values, labels, image_features):
         new_input_embeds = []
         new_labels = [] if labels is not None else None
         cur_image_idx = 0
@@ -280,8 +294,17 @@ class LlavaMetaForCausalLM(ABC):
                 new_labels  = torch.stack(new_labels, dim=0)
 
             if attention_mask is not None:
-                new_attn_mask_pad_left = torch.full((attention_mask.shape[0], new_input_embeds.shape[1] - input_ids.shape[1]), True, dtype=attention_mask.dtype, device=attention_mask.device)
-                attention_mask = torch.cat((new_attn_mask_pad_left, attention_mask), dim=1)
+                # expand the mask where the image features were spliced in, so left-padded
+                # prompts keep their padding masked out
+                new_attention_mask = []
+                for cur_input_ids, cur_attention_mask in zip(input_ids, attention_mask):
+                    for image_token_start in reversed(torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0].tolist()):
+                        cur_attention_mask = torch.cat((
+                            cur_attention_mask[:image_token_start],
+                            cur_attention_mask.new_ones(image_features.shape[1]),
+                            cur_attention_mask[image_token_start + 1:]))
+                    new_attention_mask.append(cur_attention_mask)
+                attention_mask = torch.stack(new_attention_mask, dim=0)
                 assert attention_mask.shape == new_input_embeds.shape[:2]
 
         return None, attention_mask, past_key_values, new_input_embeds, new_labels
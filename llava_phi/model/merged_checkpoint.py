@@ -0,0 +1,176 @@
+"""
+Merged Dual-View SLaVA checkpoints.
+
+`load_pretrained_model` rebuilds a LoRA model on every start: base weights, the pickled
+`non_lora_trainables.bin`, PeftModel wrapping, `merge_and_unload` and a BiomedCLIP download
+on the first forward.  `export_merged_model` does all of that once and writes the merged weights,
+including the fusion head and the BiomedCLIP image tower, as safetensors shards next to the
+tokenizer and image processor.  `load_merged_model` reads such a directory back by memory
+mapping the shards, in parallel, straight onto the target device and dtype.
+
+    python -m llava_phi.model.merged_checkpoint --model-path checkpoints/dual-view-slava-lora \
+        --model-base checkpoints/llavaPhi-v0-3b-pretrain --output-dir checkpoints/dual-view-slava-merged
+"""
+import argparse
+import contextlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import torch
+from accelerate import init_empty_weights
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers import AutoTokenizer, CLIPImageProcessor
+
+from llava_phi.constants import MEDICAL_VISION_TOWER
+from llava_phi.model.language_model.configuration_llava_phi import LlavaPhiConfig
+from llava_phi.model.language_model.llava_phi import LlavaPhiForCausalLM
+
+WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+
+
+def is_merged_checkpoint(model_path):
+    config_file = os.path.join(model_path, "config.json")
+    if not os.path.exists(os.path.join(model_path, WEIGHTS_INDEX_NAME)) or not os.path.exists(config_file):
+        return False
+    with open(config_file) as f:
+        return "medical_vision_tower_cfg" in json.load(f)
+
+
+def build_medical_vision_tower(model_cfg):
+    """
+    The BiomedCLIP image tower from its open_clip config, without fetching weights.
+    `create_model` would also build the PubMedBERT text tower and fetch its config, so this
+    uses open_clip's private builder; `requirements.txt` pins the version it exists in.
+    """
+    from open_clip.model import _build_vision_tower
+
+    vision_cfg = dict(model_cfg["vision_cfg"], timm_model_pretrained=False)
+    tower = _build_vision_tower(model_cfg["embed_dim"], vision_cfg, quick_gelu=model_cfg.get("quick_gelu", False))
+    tower.requires_grad_(False)
+    return tower
+
+
+def get_medical_vision_tower_cfg():
+    from open_clip.factory import HF_HUB_PREFIX, _get_hf_config
+
+    return _get_hf_config(MEDICAL_VISION_TOWER[len(HF_HUB_PREFIX):])["model_cfg"]
+
+
+def _shard_state_dict(state_dict, max_shard_size):
+    shards, current, current_size = [], {}, 0
+    for name, tensor in state_dict.items():
+        size = tensor.numel() * tensor.element_size()
+        if current and current_size + size > max_shard_size:
+            shards.append(current)
+            current, current_size = {}, 0
+        current[name] = tensor
+        current_size += size
+    if current:
+        shards.append(current)
+    return shards
+
+
+def export_merged_model(model, tokenizer, image_processor, output_dir, medical_vision_tower_cfg,
+                        dtype=torch.float32, max_shard_size=2 * 1024 ** 3):
+    os.makedirs(output_dir, exist_ok=True)
+    model.get_model()._init_medical_tower(device=model.device)
+
+    seen, state_dict = set(), {}
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().to(device="cpu", dtype=dtype if tensor.is_floating_point() else tensor.dtype)
+        # safetensors refuses tensors that share storage
+        if tensor.data_ptr() in seen:
+            tensor = tensor.clone()
+        seen.add(tensor.data_ptr())
+        state_dict[name] = tensor.contiguous()
+
+    shards = _shard_state_dict(state_dict, max_shard_size)
+    weight_map = {}
+    for i, shard in enumerate(shards):
+        shard_file = f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+        save_file(shard, os.path.join(output_dir, shard_file), metadata={"format": "pt"})
+        weight_map.update({name: shard_file for name in shard})
+    total_size = sum(t.numel() * t.element_size() for t in state_dict.values())
+    with open(os.path.join(output_dir, WEIGHTS_INDEX_NAME), "w") as f:
+        json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, f, indent=2)
+
+    config = model.config
+    config.medical_vision_tower_cfg = medical_vision_tower_cfg
+    config.torch_dtype = dtype
+    config.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    image_processor.save_pretrained(output_dir)
+    print(f"Saved {len(state_dict)} tensors ({total_size / 1024 ** 3:.2f} GiB) in {len(shards)} shards to {output_dir}")
+
+
+def _read_shard(shard_path, device, dtype):
+    state_dict = {}
+    with safe_open(shard_path, framework="pt", device=str(device)) as f:
+        for name in f.keys():
+            tensor = f.get_tensor(name)
+            state_dict[name] = tensor.to(dtype) if tensor.is_floating_point() else tensor
+    return state_dict
+
+
+def load_merged_model(model_path, device="cuda", dtype=None, lazy=True, num_threads=4):
+    """
+    With `lazy`, parameters are created on the meta device and each shard is read on a
+    worker thread and assigned in place, so no random init runs and peak memory stays near
+    one copy of the weights.  `lazy=False` builds the model normally and copies into it.
+    """
+    config = LlavaPhiConfig.from_pretrained(model_path)
+    dtype = dtype or config.torch_dtype or torch.float32
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+    image_processor = CLIPImageProcessor.from_pretrained(model_path)
+
+    with init_empty_weights() if lazy else contextlib.nullcontext():
+        model = LlavaPhiForCausalLM(config)
+        llava_model = model.get_model()
+        llava_model.medical_vision_tower = build_medical_vision_tower(config.medical_vision_tower_cfg)
+        llava_model._medical_vision_tower_initialized = True
+    if not lazy:
+        model.to(device=device, dtype=dtype)
+
+    with open(os.path.join(model_path, WEIGHTS_INDEX_NAME)) as f:
+        shard_files = sorted(set(json.load(f)["weight_map"].values()))
+    missing = set(model.state_dict())
+    with ThreadPoolExecutor(max_workers=num_threads if lazy else 1) as pool:
+        futures = [pool.submit(_read_shard, os.path.join(model_path, shard_file), device, dtype)
+                   for shard_file in shard_files]
+        for future in as_completed(futures):
+            state_dict = future.result()
+            model.load_state_dict(state_dict, strict=False, assign=lazy)
+            missing -= set(state_dict)
+            del state_dict
+    if missing:
+        raise ValueError(f"Merged checkpoint {model_path} is missing weights: {sorted(missing)[:10]}")
+    # buffers (rotary frequencies, position ids) were built normally; move them too
+    model.to(device=device, dtype=dtype)
+    model.eval()
+
+    context_len = getattr(config, "max_sequence_length", 2048)
+    return tokenizer, model, image_processor, context_len
+
+
+if __name__ == "__main__":
+    from llava_phi.mm_utils import get_model_name_from_path
+    from llava_phi.model.builder import load_pretrained_model
+    from llava_phi.utils import disable_torch_init
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--model-base", type=str, default=None)
+    parser.add_argument("--model-name", type=str, default=None)
+    parser.add_argument("--output-dir", type=str, required=True)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float16", "bfloat16", "float32"])
+    parser.add_argument("--max-shard-size-gb", type=float, default=2.0)
+    args = parser.parse_args()
+
+    disable_torch_init()
+    model_name = args.model_name or get_model_name_from_path(args.model_path)
+    tokenizer, model, image_processor, _ = load_pretrained_model(
+        args.model_path, args.model_base, model_name, device_map="cpu", device="cpu")
+    export_merged_model(model, tokenizer, image_processor, args.output_dir, get_medical_vision_tower_cfg(),
+                        dtype=getattr(torch, args.dtype), max_shard_size=int(args.max_shard_size_gb * 1024 ** 3))
@@ -0,0 +1,326 @@
+"""
+Report-phrase n-gram index used to draft continuations during greedy decoding.
+
+Findings and impressions are written from a small vocabulary of stock sentences, so the
+next few tokens of a report can usually be guessed from the last few.  `build_index`
+mines the `conversations` of the training manifests (`slava_llava_*.json`) into flat
+numpy tables, `NgramIndex.lookup` proposes a draft for the current suffix and
+`draft_generate` verifies drafts with a single forward pass each (prompt-lookup decoding).
+
+Layout of an index directory:
+    tokens.npy        uint16/int32 token stream, sentences separated by `SEP`
+    keys_{n}.npy      sorted uint64 hashes of every kept n-token context
+    pos_{n}.npy       uint32 offset in `tokens` of the most frequent continuation
+    meta.json         orders, tokenizer and size information
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+HASH_BASE = 1000003
+HASH_MASK = (1 << 64) - 1
+
+
+def _hash_windows(tokens, n):
+    """Polynomial hash of every n-token window; entry `p` covers tokens[p - n:p]."""
+    values = tokens.astype(np.uint64)
+    h = np.zeros(len(tokens) - n + 1, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for j in range(n):
+            h = h * np.uint64(HASH_BASE) + values[j:len(tokens) - n + 1 + j]
+    return h
+
+
+def _hash_suffix(suffix):
+    h = 0
+    for token in suffix:
+        h = (h * HASH_BASE + int(token)) & HASH_MASK
+    return h
+
+
+def iter_manifest_texts(data_paths, roles=("gpt",)):
+    for data_path in data_paths:
+        with open(data_path, "r") as f:
+            if data_path.endswith(".jsonl"):
+                records = (json.loads(line) for line in f if line.strip())
+            else:
+                records = json.load(f)
+            for record in records:
+                for sentence in record.get("conversations", []):
+                    if sentence.get("from") in roles:
+                        yield sentence["value"]
+
+
+def split_sentences(text):
+    # Reports are reused sentence by sentence, so the sentence is the unit we dedupe on.
+    # The leading space keeps BPE tokens identical to the mid-report tokenization.
+    for sentence in re.split(r"(?<=\.)\s+", text.replace("\n", " ")):
+        sentence = sentence.strip()
+        if sentence:
+            yield " " + sentence
+
+
+def build_index(data_paths, tokenizer, output_dir, orders=(1, 2, 3, 4), min_count=2,
+                roles=("gpt",), batch_size=1024):
+    sentences = {}
+    for text in iter_manifest_texts(data_paths, roles=roles):
+        for sentence in split_sentences(text):
+            sentences[sentence] = sentences.get(sentence, 0) + 1
+    unique_sentences = list(sentences)
+
+    token_ids = []
+    for i in range(0, len(unique_sentences), batch_size):
+        token_ids.extend(tokenizer(unique_sentences[i:i + batch_size]).input_ids)
+
+    vocab_size = len(tokenizer)
+    dtype = np.uint16 if vocab_size < np.iinfo(np.uint16).max else np.int32
+    sep = np.iinfo(dtype).max
+    lengths = np.array([len(ids) + 1 for ids in token_ids], dtype=np.int64)
+    tokens = np.full(int(lengths.sum()) + 1, sep, dtype=dtype)
+    # every token carries the number of times its sentence occurs in the manifests
+    weights = np.zeros(len(tokens), dtype=np.int64)
+    starts = np.concatenate([[1], 1 + np.cumsum(lengths)[:-1]])
+    for start, ids, sentence in zip(starts, token_ids, unique_sentences):
+        tokens[start:start + len(ids)] = ids
+        weights[start:start + len(ids)] = sentences[sentence]
+
+    is_sep = tokens == sep
+    sep_cum = np.concatenate([[0], np.cumsum(is_sep)])
+
+    os.makedirs(output_dir, exist_ok=True)
+    stats = {}
+    for n in orders:
+        # continuation offsets whose context and first continuation token stay inside a sentence
+        positions = np.arange(n, len(tokens), dtype=np.int64)
+        valid = sep_cum[positions + 1] - sep_cum[positions - n] == 0
+        positions = positions[valid]
+        keys = _hash_windows(tokens, n)[positions - n]
+        next_tokens = tokens[positions].astype(np.int64)
+        if len(positions) == 0:
+            np.save(os.path.join(output_dir, f"keys_{n}.npy"), np.zeros(0, dtype=np.uint64))
+            np.save(os.path.join(output_dir, f"pos_{n}.npy"), np.zeros(0, dtype=np.uint32))
+            stats[n] = 0
+            continue
+
+        order = np.lexsort((next_tokens, keys))
+        keys, next_tokens, positions = keys[order], next_tokens[order], positions[order]
+        pair_start = np.ones(len(keys), dtype=bool)
+        pair_start[1:] = (keys[1:] != keys[:-1]) | (next_tokens[1:] != next_tokens[:-1])
+        pair_idx = np.flatnonzero(pair_start)
+        pair_count = np.add.reduceat(weights[positions], pair_idx)
+
+        pair_keys = keys[pair_idx]
+        key_total = np.zeros(len(pair_idx), dtype=np.int64)
+        key_start = np.ones(len(pair_idx), dtype=bool)
+        key_start[1:] = pair_keys[1:] != pair_keys[:-1]
+        key_id = np.cumsum(key_start) - 1
+        np.add.at(key_total, key_id, pair_count)
+
+        # most frequent continuation per context, ties broken by the lower token id
+        best = np.lexsort((-pair_count, key_id))
+        best = best[np.concatenate([[True], key_id[best][1:] != key_id[best][:-1]])]
+        keep = key_total[key_id[best]] >= min_count
+        best = best[keep]
+
+        np.save(os.path.join(output_dir, f"keys_{n}.npy"), pair_keys[best])
+        np.save(os.path.join(output_dir, f"pos_{n}.npy"), positions[pair_idx[best]].astype(np.uint32))
+        stats[n] = int(keep.sum())
+
+    np.save(os.path.join(output_dir, "tokens.npy"), tokens)
+    meta = {
+        "orders": list(orders),
+        "min_count": min_count,
+        "sep": int(sep),
+        "num_sentences": len(unique_sentences),
+        "num_sentence_occurrences": int(sum(sentences.values())),
+        "num_tokens": int(len(tokens)),
+        "num_keys": stats,
+        "tokenizer": getattr(tokenizer, "name_or_path", None),
+        "vocab_size": vocab_size,
+    }
+    with open(os.path.join(output_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class NgramIndex:
+    def __init__(self, index_dir, mmap=True):
+        with open(os.path.join(index_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        self.sep = self.meta["sep"]
+        self.orders = sorted(self.meta["orders"], reverse=True)
+        self.tokens = np.load(os.path.join(index_dir, "tokens.npy"), mmap_mode=mmap_mode)
+        self.keys = {}
+        self.positions = {}
+        for n in self.orders:
+            self.keys[n] = np.load(os.path.join(index_dir, f"keys_{n}.npy"), mmap_mode=mmap_mode)
+            self.positions[n] = np.load(os.path.join(index_dir, f"pos_{n}.npy"), mmap_mode=mmap_mode)
+
+    @property
+    def nbytes(self):
+        arrays = [self.tokens] + list(self.keys.values()) + list(self.positions.values())
+        return sum(a.nbytes for a in arrays)
+
+    def lookup(self, suffix, max_draft_tokens=8):
+        """Return the likeliest continuation of `suffix` (a list of token ids), longest context first."""
+        suffix = list(suffix)
+        for n in self.orders:
+            if len(suffix) < n:
+                continue
+            context = suffix[-n:]
+            keys = self.keys[n]
+            h = np.uint64(_hash_suffix(context))
+            i = int(np.searchsorted(keys, h))
+            if i >= len(keys) or keys[i] != h:
+                continue
+            pos = int(self.positions[n][i])
+            if self.tokens[pos - n:pos].tolist() != context:
+                continue  # hash collision
+            draft = self.tokens[pos:pos + max_draft_tokens].tolist()
+            if self.sep in draft:
+                draft = draft[:draft.index(self.sep)]
+            if draft:
+                return draft
+        return []
+
+
+def _crop_past_key_values(past_key_values, length):
+    if hasattr(past_key_values, "crop"):
+        past_key_values.crop(length)
+        return past_key_values
+    return tuple(tuple(t[:, :, :length] for t in layer) for layer in past_key_values)
+
+
+class _RepeatBan:
+    """`no_repeat_ngram_size` for one sequence: bans the tokens that would repeat one of its n-grams."""
+
+    def __init__(self, token_ids, n):
+        self.n = n
+        self.token_ids = []
+        self.followers = {}
+        self.extend(token_ids)
+
+    def extend(self, tokens):
+        if not self.n:
+            return
+        for token in tokens:
+            self.token_ids.append(token)
+            if len(self.token_ids) >= self.n:
+                self.followers.setdefault(tuple(self.token_ids[-self.n:-1]), set()).add(token)
+
+    def argmax(self, logits):
+        banned = self.followers.get(tuple(self.token_ids[-(self.n - 1):]), ()) if self.n else ()
+        if banned:
+            logits = logits.clone()
+            logits[list(banned)] = float("-inf")
+        return int(logits.argmax())
+
+
+def draft_generate(model, input_ids, images, index, max_new_tokens=512, max_draft_tokens=8,
+                   eos_token_id=None, stopping_criteria=None, no_repeat_ngram_size=0):
+    """
+    Greedy decoding that verifies n-gram drafts in one forward pass each.
+
+    Produces the same tokens as `model.generate(..., do_sample=False, num_beams=1,
+    no_repeat_ngram_size=no_repeat_ngram_size)` for a single study, with fewer LM forwards
+    whenever the index predicts the continuation.  The n-gram ban is applied to the logits of
+    every verified position, over the prompt and the tokens accepted before it.
+    Returns `(output_ids, stats)` where `output_ids` includes the prompt like `generate`.
+    """
+    import torch
+
+    assert input_ids.shape[0] == 1, "draft_generate only supports batch size 1"
+    with torch.inference_mode():
+        out = model(input_ids=input_ids, images=images, use_cache=True, return_dict=True)
+        past_key_values = out.past_key_values
+        ban = _RepeatBan(input_ids[0].tolist(), no_repeat_ngram_size)
+        next_token = ban.argmax(out.logits[0, -1])
+        ban.extend([next_token])
+        cache_len = out.logits.shape[1]
+        prompt_tail = input_ids[0, -max(index.orders):].tolist()
+        generated = [next_token]
+        forwards, drafted, accepted = 1, 0, 0
+
+        while len(generated) < max_new_tokens and next_token != eos_token_id:
+            context = (prompt_tail + generated)[-max(index.orders):]
+            draft = index.lookup(context, max_draft_tokens=min(max_draft_tokens, max_new_tokens - len(generated)))
+            step_ids = torch.tensor([[next_token] + draft], dtype=input_ids.dtype, device=input_ids.device)
+            # images=None: the image features already live in the cache from the prefill
+            out = model(input_ids=step_ids, past_key_values=past_key_values, use_cache=True, return_dict=True)
+            forwards += 1
+
+            # position i predicts the token after draft[:i]; accepted tokens extend the ban in order
+            n_ok = 0
+            predicted = ban.argmax(out.logits[0, 0])
+            while n_ok < len(draft) and predicted == draft[n_ok] and draft[n_ok] != eos_token_id:
+                ban.extend([predicted])
+                n_ok += 1
+                predicted = ban.argmax(out.logits[0, n_ok])
+            ban.extend([predicted])
+            drafted += len(draft)
+            accepted += n_ok
+
+            new_tokens = draft[:n_ok] + [predicted]
+            cache_len += 1 + n_ok
+            past_key_values = _crop_past_key_values(out.past_key_values, cache_len)
+            generated.extend(new_tokens)
+            next_token = generated[-1]
+            if eos_token_id is not None and eos_token_id in new_tokens:
+                generated = generated[:generated.index(eos_token_id) + 1]
+                break
+            if stopping_criteria is not None:
+                output_ids = torch.cat([input_ids, torch.tensor([generated], device=input_ids.device)], dim=1)
+                if stopping_criteria(output_ids, None):
+                    break
+
+    generated = generated[:max_new_tokens]
+    output_ids = torch.cat([input_ids, torch.tensor([generated], dtype=input_ids.dtype, device=input_ids.device)], dim=1)
+    stats = {"new_tokens": len(generated), "forwards": forwards, "drafted": drafted, "accepted": accepted}
+    return output_ids, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("--data-path", type=str, nargs="+", required=True)
+    build_parser.add_argument("--tokenizer", type=str, required=True)
+    build_parser.add_argument("--output-dir", type=str, required=True)
+    build_parser.add_argument("--orders", type=int, nargs="+", default=[1, 2, 3, 4])
+    build_parser.add_argument("--min-count", type=int, default=2)
+    build_parser.add_argument("--include-human", action="store_true")
+
+    query_parser = subparsers.add_parser("query")
+    query_parser.add_argument("--index-dir", type=str, required=True)
+    query_parser.add_argument("--tokenizer", type=str, required=True)
+    query_parser.add_argument("--text", type=str, required=True)
+    query_parser.add_argument("--max-draft-tokens", type=int, default=8)
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    if args.command == "build":
+        roles = ("gpt", "human") if args.include_human else ("gpt",)
+        start = time.perf_counter()
+        meta = build_index(args.data_path, tokenizer, args.output_dir, orders=tuple(args.orders),
+                           min_count=args.min_count, roles=roles)
+        print(json.dumps(meta, indent=2))
+        print(f"Built index in {time.perf_counter() - start:.1f}s")
+    else:
+        start = time.perf_counter()
+        index = NgramIndex(args.index_dir)
+        load_time = time.perf_counter() - start
+        draft = index.lookup(tokenizer(args.text).input_ids, max_draft_tokens=args.max_draft_tokens)
+        print(f"Loaded {index.nbytes / 2**20:.2f} MB in {load_time * 1000:.1f} ms")
+        print(repr(tokenizer.decode(draft)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Opt-in per-stage timing for the dual-view forward.
+
+The model and dataset wrap their stages in `stage(name)`:
+
+    image_decode   LazySupervisedDataset image loading and preprocessing
+    clip_tower     CLIPVisionTower on the frontal and lateral views
+    medical_tower  BiomedCLIP visual tower
+    fusion         adapter, weighted fusion, cross-attention, gate and mm_projector
+    splice         embedding the prompt and splicing the image features in
+    backbone       Phi-2 decoder
+    lm_head
+    loss
+
+While profiling is off, `stage` returns a shared no-op context manager and nothing is
+timed, synchronized or recorded.  `enable_profiling()` installs a `StageProfiler`.  From
+then on each stage is also a `torch.profiler.record_function` range, so it shows up by
+name in a torch profiler trace, and its wall time is added to the current step.  With
+`cuda_sync`, CUDA is synchronized at both ends of a range, so the time is that of the
+stage's kernels rather than of their launch.  `StageProfiler.step()` closes a step.
+`summary()` reports per-stage percentiles and a log-spaced histogram of the per-step
+times, and `save()` writes that summary as JSON.
+
+`enable_profiling(memory=True)` installs a `llava_phi.memory_profiler.MemoryProfiler`
+instead.  It uses the same ranges, but records allocator, peak and RSS snapshots rather
+than times.
+"""
+import contextlib
+import json
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+_NULL_RANGE = contextlib.nullcontext()
+_profiler = None
+
+# histogram bin edges in milliseconds, 10us to 100s
+HISTOGRAM_EDGES_MS = np.logspace(-2, 5, 36)
+
+
+class StageProfiler:
+    def __init__(self, cuda_sync=None, record_functions=True):
+        self.cuda_sync = torch.cuda.is_available() if cuda_sync is None else cuda_sync
+        self.record_functions = record_functions
+        self.current = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.history = defaultdict(list)  # stage -> per-step seconds
+        self.num_steps = 0
+        self.logged_steps = 0
+        self._step_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def range(self, name):
+        with torch.profiler.record_function(name) if self.record_functions else _NULL_RANGE:
+            if self.cuda_sync:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                if self.cuda_sync:
+                    torch.cuda.synchronize()
+                self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        """Time measured elsewhere, e.g. image decode in a dataloader worker."""
+        self.current[name] += seconds
+        self.calls[name] += 1
+
+    def step(self):
+        """Close the current step; stages it did not run count as 0 for it."""
+        now = time.perf_counter()
+        self.current["step"] = now - self._step_start
+        self._step_start = now
+        for name in set(self.history) | set(self.current):
+            self.history[name].extend([0.0] * (self.num_steps - len(self.history[name])))
+            self.history[name].append(self.current.get(name, 0.0))
+        self.current = defaultdict(float)
+        self.num_steps += 1
+
+    def log_metrics(self):
+        """Mean per-step milliseconds of each stage since the previous call, for `Trainer.log`."""
+        logs = {}
+        for name, times in self.history.items():
+            recent = times[self.logged_steps:]
+            if recent:
+                logs[f"profile/{name}_ms"] = round(1000 * float(np.mean(recent)), 3)
+        self.logged_steps = self.num_steps
+        return logs
+
+    def summary(self):
+        stages = {}
+        for name, times in self.history.items():
+            ms = 1000 * np.asarray(times)
+            counts, _ = np.histogram(ms, bins=HISTOGRAM_EDGES_MS)
+            stages[name] = {
+                "calls": self.calls.get(name, len(times)),
+                "total_s": round(float(ms.sum()) / 1000, 4),
+                "mean_ms": round(float(ms.mean()), 3),
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p90_ms": round(float(np.percentile(ms, 90)), 3),
+                "p99_ms": round(float(np.percentile(ms, 99)), 3),
+                "max_ms": round(float(ms.max()), 3),
+                "histogram": {"edges_ms": [round(float(e), 4) for e in HISTOGRAM_EDGES_MS],
+                              "counts": counts.tolist()},
+            }
+        return {"steps": self.num_steps, "cuda_sync": self.cuda_sync, "stages": stages}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"Stage timings over {summary['steps']} steps (ms per step):")
+        for name, stats in sorted(summary["stages"].items(), key=lambda kv: -kv[1]["total_s"]):
+            print(f"  {name:<14} mean {stats['mean_ms']:>10.3f}  p50 {stats['p50_ms']:>10.3f}  "
+                  f"p90 {stats['p90_ms']:>10.3f}  max {stats['max_ms']:>10.3f}")
+
+
+def enable_profiling(cuda_sync=None, record_functions=True, memory=False, **memory_kwargs):
+    global _profiler
+    if memory:
+        from llava_phi.memory_profiler import MemoryProfiler
+        _profiler = MemoryProfiler(**memory_kwargs)
+    else:
+        _profiler = StageProfiler(cuda_sync=cuda_sync, record_functions=record_functions)
+    return _profiler
+
+
+def disable_profiling():
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def get_profiler():
+    """The active `StageProfiler`, or None when profiling is off."""
+    return _profiler
+
+
+def stage(name):
+    if _profiler is None:
+        return _NULL_RANGE
+    return _profiler.range(name)
@@ -0,0 +1,249 @@
+"""
+Continuous batching for Dual-View SLaVA report generation.
+
+Every study is prefilled on its own (the dual-view image splice makes prompt lengths
+differ), then joins the running decode batch.  The batched KV cache is kept right-aligned:
+rows that joined with a shorter prompt are left-padded and masked out, and each row keeps
+its own rotary positions, so a finished study can leave and a new one can join between
+any two decode steps.
+"""
+import queue
+import threading
+import time
+
+import torch
+import torch.nn.functional as F
+
+from llava_phi.streaming import IncrementalDetokenizer, StopStringMatcher
+
+
+class GenerationRequest:
+    def __init__(self, input_ids, images, max_new_tokens=512, temperature=0.0, top_p=None,
+                 stop_str=None):
+        self.input_ids = input_ids
+        self.images = images
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop_str = stop_str
+
+        self.output_ids = []
+        self.detokenizer = None
+        self.stop_matcher = None
+        self.cancelled = False
+        self.finish_reason = None
+        self.error = None
+        self.done = threading.Event()
+        self.submit_time = time.time()
+        self.first_token_time = None
+        self.finish_time = None
+
+    @property
+    def latency(self):
+        return self.finish_time - self.submit_time if self.finish_time else None
+
+
+def _to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple(tuple(layer) for layer in past_key_values)
+
+
+def _from_legacy_cache(past_key_values):
+    try:
+        from transformers import DynamicCache
+    except ImportError:  # older transformers take the tuple format directly
+        return past_key_values
+    return DynamicCache.from_legacy_cache(past_key_values)
+
+
+def _pad_cache_left(past_key_values, n):
+    if n == 0:
+        return past_key_values
+    return tuple(tuple(F.pad(t, (0, 0, n, 0)) for t in layer) for layer in past_key_values)
+
+
+class ContinuousBatchScheduler:
+    def __init__(self, model, tokenizer, max_batch_size=8, max_prefills_per_step=1):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_prefills_per_step = max_prefills_per_step
+
+        self.pending = queue.Queue()
+        self.requests = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.lengths = None
+        self.next_tokens = None
+
+        self.num_steps = 0
+        self.num_generated_tokens = 0
+        self.num_finished = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def device(self):
+        return self.model.device
+
+    @property
+    def queue_length(self):
+        return self.pending.qsize() + len(self.requests)
+
+    def submit(self, request):
+        self.pending.put(request)
+        return request
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            if not self.requests and self.pending.empty():
+                time.sleep(0.005)
+                continue
+            self.step()
+
+    @torch.inference_mode()
+    def step(self):
+        admitted = 0
+        while (len(self.requests) < self.max_batch_size and admitted < self.max_prefills_per_step
+               and not self.pending.empty()):
+            request = self.pending.get()
+            admitted += 1
+            try:
+                self._prefill(request)
+            except Exception as e:
+                request.error = str(e)
+                self._finish(request, "error")
+
+        if self.requests:
+            self._decode()
+
+    def _sample(self, logits, requests):
+        tokens = logits.argmax(dim=-1)
+        for i, request in enumerate(requests):
+            if request.temperature is None or request.temperature <= 0:
+                continue
+            probs = torch.softmax(logits[i].float() / request.temperature, dim=-1)
+            if request.top_p is not None and request.top_p < 1.0:
+                sorted_probs, sorted_idx = torch.sort(probs, descending=True)
+                cutoff = torch.cumsum(sorted_probs, dim=-1) - sorted_probs > request.top_p
+                sorted_probs[cutoff] = 0
+                probs = torch.zeros_like(probs).scatter_(0, sorted_idx, sorted_probs)
+            tokens[i] = torch.multinomial(probs, 1)[0]
+        return tokens
+
+    def _append_token(self, request, token):
+        if request.first_token_time is None:
+            request.first_token_time = time.time()
+        request.output_ids.append(token)
+        self.num_generated_tokens += 1
+        if request.cancelled:
+            return "abort"
+        if token == self.tokenizer.eos_token_id:
+            return "stop"
+        if request.stop_matcher is not None:
+            # only the new token is detokenized, and the matcher carries partial matches across steps
+            request.stop_matcher.feed(request.detokenizer.add_tokens([token]))
+            if request.stop_matcher.stopped:
+                return "stop"
+        if len(request.output_ids) >= request.max_new_tokens:
+            return "length"
+        return None
+
+    def _finish(self, request, reason):
+        request.finish_reason = reason
+        request.finish_time = time.time()
+        self.num_finished += 1
+        request.done.set()
+
+    def _prefill(self, request):
+        if request.stop_str:
+            request.detokenizer = IncrementalDetokenizer(self.tokenizer)
+            request.stop_matcher = StopStringMatcher([request.stop_str])
+        input_ids = request.input_ids.unsqueeze(0).to(self.device)
+        images = request.images.unsqueeze(0).to(self.device, dtype=self.model.dtype)
+        out = self.model(input_ids=input_ids, images=images, use_cache=True, return_dict=True)
+        token = int(self._sample(out.logits[:, -1], [request])[0])
+        reason = self._append_token(request, token)
+        if reason is not None:
+            self._finish(request, reason)
+            return
+
+        past_key_values = _to_legacy_cache(out.past_key_values)
+        length = out.logits.shape[1]
+        mask = torch.ones(1, length, dtype=torch.long, device=self.device)
+        if self.past_key_values is None:
+            self.past_key_values, self.attention_mask = past_key_values, mask
+            self.lengths = torch.tensor([length], device=self.device)
+            self.next_tokens = torch.tensor([token], device=self.device)
+        else:
+            width = self.attention_mask.shape[1]
+            self.past_key_values = _pad_cache_left(self.past_key_values, max(length - width, 0))
+            self.attention_mask = F.pad(self.attention_mask, (max(length - width, 0), 0))
+            past_key_values = _pad_cache_left(past_key_values, max(width - length, 0))
+            mask = F.pad(mask, (max(width - length, 0), 0))
+            self.past_key_values = tuple(
+                tuple(torch.cat([batched, new], dim=0) for batched, new in zip(batched_layer, new_layer))
+                for batched_layer, new_layer in zip(self.past_key_values, past_key_values))
+            self.attention_mask = torch.cat([self.attention_mask, mask], dim=0)
+            self.lengths = torch.cat([self.lengths, self.lengths.new_tensor([length])])
+            self.next_tokens = torch.cat([self.next_tokens, self.next_tokens.new_tensor([token])])
+        self.requests.append(request)
+
+    def _decode(self):
+        attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        out = self.model(
+            input_ids=self.next_tokens.unsqueeze(1),
+            attention_mask=attention_mask,
+            position_ids=self.lengths.unsqueeze(1),
+            past_key_values=_from_legacy_cache(self.past_key_values),
+            use_cache=True,
+            return_dict=True)
+        self.num_steps += 1
+        self.past_key_values = _to_legacy_cache(out.past_key_values)
+        self.attention_mask = attention_mask
+        self.lengths = self.lengths + 1
+        self.next_tokens = self._sample(out.logits[:, -1], self.requests)
+
+        keep = []
+        for i, (request, token) in enumerate(zip(self.requests, self.next_tokens.tolist())):
+            reason = self._append_token(request, token)
+            if reason is None:
+                keep.append(i)
+            else:
+                self._finish(request, reason)
+        if len(keep) < len(self.requests):
+            self._evict(keep)
+
+    def _evict(self, keep):
+        if not keep:
+            self.requests = []
+            self.past_key_values = self.attention_mask = self.lengths = self.next_tokens = None
+            return
+        index = torch.tensor(keep, device=self.device)
+        self.requests = [self.requests[i] for i in keep]
+        self.attention_mask = self.attention_mask[index]
+        self.lengths = self.lengths[index]
+        self.next_tokens = self.next_tokens[index]
+        # drop the leading columns that only padded out the rows that just left
+        start = int(self.attention_mask.any(dim=0).int().argmax())
+        self.attention_mask = self.attention_mask[:, start:]
+        self.past_key_values = tuple(tuple(t[index, :, start:] for t in layer) for layer in self.past_key_values)
+
+    def get_status(self):
+        return {
+            "queue_length": self.queue_length,
+            "batch_size": len(self.requests),
+            "num_steps": self.num_steps,
+            "num_generated_tokens": self.num_generated_tokens,
+            "num_finished": self.num_finished,
+        }
@@ -0,0 +1,131 @@
+"""
+Synthetic load for a model worker or the controller.
+
+Sends `--num-requests` dual-view studies with Poisson arrivals at `--request-rate` per
+second and reports throughput plus p50/p99 latency and time to first token.
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from llava_phi.constants import DEFAULT_IMAGE_TOKEN
+from llava_phi.conversation import conv_templates
+
+
+def encode_image(image_file):
+    with open(image_file, "rb") as f:
+        return base64.b64encode(f.read()).decode()
+
+
+def build_prompt(query, conv_mode):
+    conv = conv_templates[conv_mode].copy()
+    conv.append_message(conv.roles[0], DEFAULT_IMAGE_TOKEN + "\n" + query)
+    conv.append_message(conv.roles[1], None)
+    return conv.get_prompt()
+
+
+def load_studies(args):
+    if args.question_file:
+        with open(args.question_file, "r") as f:
+            if args.question_file.endswith(".jsonl"):
+                questions = [json.loads(line) for line in f if line.strip()]
+            else:
+                questions = json.load(f)
+        studies = [(q["frontal"], q["lateral"]) for q in questions[:args.num_studies]]
+        studies = [(f"{args.image_folder}/{frontal}", f"{args.image_folder}/{lateral}") for frontal, lateral in studies]
+    else:
+        studies = [(args.frontal, args.lateral)]
+    return [(encode_image(frontal), encode_image(lateral)) for frontal, lateral in studies]
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float("nan")
+
+
+def main(args):
+    if args.worker_address:
+        worker_addr = args.worker_address
+    else:
+        ret = requests.post(args.controller_address + "/get_worker_address", json={"model": args.model_name})
+        worker_addr = ret.json()["address"]
+    print(f"worker_addr: {worker_addr}")
+
+    studies = load_studies(args)
+    prompt = build_prompt(args.query, args.conv_mode)
+    results = []
+    lock = threading.Lock()
+
+    def send(images):
+        start = time.time()
+        response = requests.post(worker_addr + "/worker_generate", json={
+            "model": args.model_name,
+            "prompt": prompt,
+            "images": list(images),
+            "temperature": args.temperature,
+            "max_new_tokens": args.max_new_tokens,
+            "stop": args.stop,
+        }, timeout=3600).json()
+        response["client_latency"] = time.time() - start
+        with lock:
+            results.append(response)
+
+    rng = random.Random(args.seed)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.max_concurrency) as pool:
+        for i in range(args.num_requests):
+            pool.submit(send, studies[i % len(studies)])
+            if args.request_rate > 0:
+                time.sleep(rng.expovariate(args.request_rate))
+    elapsed = time.time() - start
+
+    ok = [r for r in results if r.get("error_code", 1) == 0]
+    latencies = [r["client_latency"] for r in ok]
+    ttft = [r["time_to_first_token"] for r in ok]
+    num_tokens = sum(r["num_output_tokens"] for r in ok)
+    summary = {
+        "num_requests": args.num_requests,
+        "num_ok": len(ok),
+        "elapsed_s": elapsed,
+        "requests_per_s": len(ok) / elapsed,
+        "output_tokens_per_s": num_tokens / elapsed,
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p99_s": percentile(latencies, 99),
+        "ttft_p50_s": percentile(ttft, 50),
+        "ttft_p99_s": percentile(ttft, 99),
+    }
+    print(json.dumps(summary, indent=2))
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump({"args": vars(args), "summary": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--controller-address", type=str, default="http://localhost:21001")
+    parser.add_argument("--worker-address", type=str)
+    parser.add_argument("--model-name", type=str, default="dual-view-slava")
+    parser.add_argument("--frontal", type=str)
+    parser.add_argument("--lateral", type=str)
+    parser.add_argument("--question-file", type=str, default=None)
+    parser.add_argument("--image-folder", type=str, default="")
+    parser.add_argument("--num-studies", type=int, default=64)
+    parser.add_argument("--query", type=str, default="Generate a radiology report for these chest X-rays.")
+    parser.add_argument("--conv-mode", type=str, default="v0")
+    parser.add_argument("--num-requests", type=int, default=64)
+    parser.add_argument("--request-rate", type=float, default=2.0, help="Poisson arrivals per second, 0 = all at once")
+    parser.add_argument("--max-concurrency", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--stop", type=str, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-file", type=str, default=None)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,238 @@
+"""
+A model worker executes the model.
+
+Requests carry a conversation prompt with one `<image>` placeholder plus the frontal and
+lateral views as base64 strings.  All requests share one `ContinuousBatchScheduler`, so a
+new study joins the running decode batch as soon as it is prefilled.
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+import uuid
+
+import requests
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+from llava_phi.constants import WORKER_HEART_BEAT_INTERVAL, IMAGE_TOKEN_INDEX
+from llava_phi.mm_utils import load_image_from_base64, process_images, tokenizer_image_token, get_model_name_from_path
+from llava_phi.model.builder import load_pretrained_model
+from llava_phi.serve.batch_scheduler import ContinuousBatchScheduler, GenerationRequest
+from llava_phi.streaming import IncrementalDetokenizer, StopStringMatcher
+from llava_phi.utils import build_logger, disable_torch_init, server_error_msg
+
+worker_id = str(uuid.uuid4())[:6]
+logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
+
+
+def heart_beat_worker(controller):
+    while True:
+        time.sleep(WORKER_HEART_BEAT_INTERVAL)
+        controller.send_heart_beat()
+
+
+class ModelWorker:
+    def __init__(self, controller_addr, worker_addr, worker_id, no_register, model_path, model_base,
+                 model_name, load_8bit, load_4bit, device, max_batch_size):
+        self.controller_addr = controller_addr
+        self.worker_addr = worker_addr
+        self.worker_id = worker_id
+        if model_name is None:
+            model_name = get_model_name_from_path(model_path)
+        self.model_name = model_name
+
+        disable_torch_init()
+        logger.info(f"Loading the model {self.model_name} on worker {worker_id} ...")
+        self.tokenizer, self.model, self.image_processor, self.context_len = load_pretrained_model(
+            model_path, model_base, self.model_name, load_8bit, load_4bit, device_map=device, device=device)
+        self.model.eval()
+
+        self.scheduler = ContinuousBatchScheduler(self.model, self.tokenizer, max_batch_size=max_batch_size)
+        self.scheduler.start()
+
+        if not no_register:
+            self.register_to_controller()
+            self.heart_beat_thread = threading.Thread(target=heart_beat_worker, args=(self,), daemon=True)
+            self.heart_beat_thread.start()
+
+    def register_to_controller(self):
+        logger.info("Register to controller")
+
+        url = self.controller_addr + "/register_worker"
+        data = {
+            "worker_name": self.worker_addr,
+            "check_heart_beat": True,
+            "worker_status": self.get_status()
+        }
+        r = requests.post(url, json=data)
+        assert r.status_code == 200
+
+    def send_heart_beat(self):
+        logger.info(f"Send heart beat. Models: {[self.model_name]}. "
+                    f"Status: {self.scheduler.get_status()}")
+
+        url = self.controller_addr + "/receive_heart_beat"
+
+        while True:
+            try:
+                ret = requests.post(url, json={
+                    "worker_name": self.worker_addr,
+                    "queue_length": self.get_queue_length()}, timeout=5)
+                exist = ret.json()["exist"]
+                break
+            except requests.exceptions.RequestException as e:
+                logger.error(f"heart beat error: {e}")
+            time.sleep(5)
+
+        if not exist:
+            self.register_to_controller()
+
+    def get_queue_length(self):
+        return self.scheduler.queue_length
+
+    def get_status(self):
+        return {
+            "model_names": [self.model_name],
+            "speed": 1,
+            "queue_length": self.get_queue_length(),
+        }
+
+    def build_request(self, params):
+        prompt = params["prompt"]
+        images = [load_image_from_base64(image).convert('RGB') for image in params["images"]]
+        assert len(images) == 2, "Dual-View SLaVA expects a frontal and a lateral image"
+        assert prompt.count("<image>") == 1, "The prompt must contain exactly one <image> placeholder"
+        images = process_images(images, self.image_processor, self.model.config)
+
+        input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt')
+        max_new_tokens = min(int(params.get("max_new_tokens", 256)), 1024)
+        max_new_tokens = min(max_new_tokens, self.context_len - input_ids.shape[0])
+        return GenerationRequest(
+            input_ids,
+            images,
+            max_new_tokens=max_new_tokens,
+            temperature=float(params.get("temperature", 0.0)),
+            top_p=float(params.get("top_p", 1.0)),
+            stop_str=params.get("stop", None))
+
+    def submit(self, params):
+        return self.scheduler.submit(self.build_request(params))
+
+    def get_result(self, request):
+        if request.error is not None:
+            logger.error(f"Generation error: {request.error}")
+            return {"text": server_error_msg, "error_code": 1}
+
+        text = self.tokenizer.decode(request.output_ids, skip_special_tokens=True)
+        if request.stop_str and request.stop_str in text:
+            text = text[:text.index(request.stop_str)]
+        return {
+            "text": text.strip(),
+            "error_code": 0,
+            "finish_reason": request.finish_reason,
+            "num_output_tokens": len(request.output_ids),
+            "time_to_first_token": request.first_token_time - request.submit_time,
+            "latency": request.latency,
+        }
+
+    async def generate_stream(self, request):
+        detokenizer = IncrementalDetokenizer(self.tokenizer)
+        matcher = StopStringMatcher([request.stop_str])
+        text, num_read = "", 0
+        try:
+            while True:
+                finished = request.done.is_set()
+                num_ids = len(request.output_ids)
+                if num_ids > num_read:
+                    text += matcher.feed(detokenizer.add_tokens(request.output_ids[num_read:num_ids]))
+                    num_read = num_ids
+                    if matcher.stopped:
+                        request.cancelled = True
+                    yield json.dumps({"text": text, "error_code": 0}).encode() + b"\0"
+                if matcher.stopped or (finished and num_read == len(request.output_ids)):
+                    break
+                await asyncio.sleep(0.005)
+            if request.error is not None:
+                yield json.dumps({"text": server_error_msg, "error_code": 1}).encode() + b"\0"
+                return
+            text += matcher.feed(detokenizer.flush()) + matcher.flush()
+            yield json.dumps({"text": text, "error_code": 0, "finish_reason": request.finish_reason}).encode() + b"\0"
+        finally:
+            # client went away or the stop string was hit: free the batch slot
+            request.cancelled = True
+
+
+app = FastAPI()
+
+
+@app.post("/worker_generate")
+async def generate(request: Request):
+    params = await request.json()
+    try:
+        # decode the images off the event loop so they overlap with the running batch
+        gen_request = await asyncio.get_running_loop().run_in_executor(None, worker.submit, params)
+    except Exception as e:
+        logger.error(f"Bad request: {e}")
+        return {"text": server_error_msg, "error_code": 1}
+    # the scheduler thread owns the model; just wait for it to finish this study
+    try:
+        while not gen_request.done.is_set():
+            if await request.is_disconnected():
+                logger.info("Client disconnected, aborting generation")
+                return {"text": server_error_msg, "error_code": 1}
+            await asyncio.sleep(0.005)
+    finally:
+        if not gen_request.done.is_set():
+            # client went away: free the batch slot
+            gen_request.cancelled = True
+    return worker.get_result(gen_request)
+
+
+@app.post("/worker_generate_stream")
+async def generate_stream(request: Request):
+    params = await request.json()
+    try:
+        gen_request = await asyncio.get_running_loop().run_in_executor(None, worker.submit, params)
+    except Exception as e:
+        logger.error(f"Bad request: {e}")
+        return {"text": server_error_msg, "error_code": 1}
+    return StreamingResponse(worker.generate_stream(gen_request))
+
+
+@app.post("/worker_get_status")
+async def get_status(request: Request):
+    return worker.get_status()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=21002)
+    parser.add_argument("--worker-address", type=str, default="http://localhost:21002")
+    parser.add_argument("--controller-address", type=str, default="http://localhost:21001")
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--model-base", type=str, default=None)
+    parser.add_argument("--model-name", type=str)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--no-register", action="store_true")
+    parser.add_argument("--load-8bit", action="store_true")
+    parser.add_argument("--load-4bit", action="store_true")
+    args = parser.parse_args()
+    logger.info(f"args: {args}")
+
+    worker = ModelWorker(args.controller_address,
+                         args.worker_address,
+                         worker_id,
+                         args.no_register,
+                         args.model_path,
+                         args.model_base,
+                         args.model_name,
+                         args.load_8bit,
+                         args.load_4bit,
+                         args.device,
+                         args.max_batch_size)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
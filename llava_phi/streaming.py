@@ -0,0 +1,162 @@
+"""
+Token streaming for report generation.
+
+`IncrementalDetokenizer` turns token ids into text chunks by decoding only a short window
+around the newest token, `StopStringMatcher` finds `conv.sep` / `conv.sep2` in the streamed
+text while holding back only the characters that could still start a stop string, and
+`stream_generate` runs `model.generate` on a background thread and yields the chunks.
+"""
+import queue
+import threading
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+
+class IncrementalDetokenizer:
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, token_ids):
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens,
+                                     clean_up_tokenization_spaces=False)
+
+    def add_tokens(self, token_ids):
+        """Append ids and return the newly completed text (possibly empty)."""
+        self.token_ids.extend(token_ids)
+        # Decoding `prefix_offset:` instead of just the new ids keeps BPE merges and
+        # leading-space handling identical to a full decode.
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self):
+        """Return the text still held back, e.g. a multi-byte character cut off by `max_new_tokens`."""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class StopStringMatcher:
+    def __init__(self, stop_strs):
+        self.stop_strs = [s for s in stop_strs if s]
+        self.pending = ""
+        self.stopped = False
+
+    def _held_back(self, text):
+        """Length of the longest suffix of `text` that is a proper prefix of a stop string."""
+        hold = 0
+        for stop in self.stop_strs:
+            for k in range(min(len(stop) - 1, len(text)), hold, -1):
+                if text.endswith(stop[:k]):
+                    hold = k
+                    break
+        return hold
+
+    def feed(self, chunk):
+        """Return the text that is safe to emit; sets `stopped` once a stop string appears."""
+        if self.stopped:
+            return ""
+        text = self.pending + chunk
+        hits = [i for i in (text.find(stop) for stop in self.stop_strs) if i >= 0]
+        if hits:
+            self.stopped = True
+            self.pending = ""
+            return text[:min(hits)]
+        hold = self._held_back(text)
+        self.pending = text[len(text) - hold:] if hold else ""
+        return text[:len(text) - hold]
+
+    def flush(self):
+        text, self.pending = self.pending, ""
+        return "" if self.stopped else text
+
+
+class TokenQueueStreamer(BaseStreamer):
+    """Hands generated token ids to the consuming thread, skipping the prompt."""
+
+    def __init__(self, timeout=None):
+        self.queue = queue.Queue()
+        self.timeout = timeout
+        self.next_tokens_are_prompt = True
+
+    def put(self, value):
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        if value.dim() > 1:
+            value = value[0]
+        self.queue.put(value.tolist())
+
+    def end(self):
+        self.queue.put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.queue.get(timeout=self.timeout)
+        if value is None:
+            raise StopIteration
+        return value
+
+
+class _EventStoppingCriteria(StoppingCriteria):
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+def stream_generate(model, tokenizer, input_ids, stop_strs=(), timeout=None, **generate_kwargs):
+    """
+    Yield text chunks while `model.generate` runs; the concatenation equals the full
+    decode cut at the first stop string.  Batch size 1 only.
+    """
+    assert input_ids.shape[0] == 1, "stream_generate only supports batch size 1"
+    streamer = TokenQueueStreamer(timeout=timeout)
+    stop_event = threading.Event()
+    stopping_criteria = StoppingCriteriaList(generate_kwargs.pop("stopping_criteria", []))
+    stopping_criteria.append(_EventStoppingCriteria(stop_event))
+    errors = []
+
+    def run():
+        try:
+            with torch.inference_mode():
+                model.generate(input_ids, streamer=streamer, stopping_criteria=stopping_criteria, **generate_kwargs)
+        except Exception as e:
+            errors.append(e)
+            streamer.end()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    matcher = StopStringMatcher(stop_strs)
+    try:
+        for token_ids in streamer:
+            text = matcher.feed(detokenizer.add_tokens(token_ids))
+            if text:
+                yield text
+            if matcher.stopped:
+                stop_event.set()
+                break
+        text = matcher.feed(detokenizer.flush()) + matcher.flush()
+        if text:
+            yield text
+    finally:
+        stop_event.set()
+        thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,119 @@
+"""
+Non-blocking checkpoint writes for `LLaVAPhiTrainer` (`--async_checkpoint True`).
+
+A save copies the tensors to host buffers, pinned when they live on CUDA.  The buffers
+are allocated on the first save and reused afterwards.  Training resumes as soon as the
+copies land.  A single background thread then serializes the copies: safetensors for
+weights, `torch.save` for the optimizer.  Each file is written under a `.tmp` name, fsynced
+and renamed into place, and the directory is fsynced after the rename.  A file therefore
+either holds a whole snapshot or does not exist.  Jobs run in submission order.  A later
+job (the rename of `trainer_state.json`, checkpoint rotation) therefore only runs after the
+files before it are on disk.  The weights are
+written as a delta checkpoint (`llava_phi.model.delta_checkpoint`).  The buffers are
+reused, so the trainer waits for the previous checkpoint's writes before the next one.
+"""
+import os
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from safetensors.torch import save_file
+from transformers.trainer import PREFIX_CHECKPOINT_DIR, TRAINER_STATE_NAME
+
+
+def last_complete_checkpoint(output_dir):
+    """Newest `checkpoint-*` with a `trainer_state.json`, the last file an async save puts in place."""
+    checkpoints = [p for p in pathlib.Path(output_dir).glob(f"{PREFIX_CHECKPOINT_DIR}-*")
+                   if p.name.split("-")[-1].isdigit() and (p / TRAINER_STATE_NAME).exists()]
+    if not checkpoints:
+        return None
+    return str(max(checkpoints, key=lambda p: int(p.name.split("-")[-1])))
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_replace(tmp_path, path):
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    _replace(tmp_path, path)
+
+
+def _replace(tmp_path, path):
+    """`os.replace` followed by an fsync of the directory, so the rename itself survives a power loss."""
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+class AsyncCheckpointer:
+    def __init__(self):
+        self._buffers = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint-writer")
+        self._pending = []
+        self.snapshot_seconds = 0.0
+
+    def _copy(self, key, tensor):
+        tensor = tensor.detach()
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=tensor.is_cuda)
+            self._buffers[key] = buffer
+        buffer.copy_(tensor, non_blocking=tensor.is_cuda)
+        return buffer
+
+    def _copy_nested(self, key, obj):
+        if isinstance(obj, torch.Tensor):
+            return self._copy(key, obj)
+        if isinstance(obj, dict):
+            return {k: self._copy_nested(f"{key}.{k}", v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._copy_nested(f"{key}.{i}", v) for i, v in enumerate(obj))
+        return obj
+
+    def snapshot(self, key, obj):
+        """
+        Host copies of every tensor in `obj`, in the buffers kept under `key` (e.g. "model").
+        Call `wait()` before snapshotting the same key again.
+        """
+        start = time.perf_counter()
+        copy = self._copy_nested(key, obj)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.snapshot_seconds += time.perf_counter() - start
+        return copy
+
+    def submit(self, fn, *args, **kwargs):
+        self._pending.append(self._executor.submit(fn, *args, **kwargs))
+
+    def save_tensors(self, key, tensors, path, metadata=None):
+        snapshot = self.snapshot(key, dict(tensors))
+        self.submit(self._write_safetensors, snapshot, path, metadata)
+
+    def save_object(self, key, obj, path):
+        snapshot = self.snapshot(key, obj)
+        self.submit(self._write_torch, snapshot, path)
+
+    def rename_when_written(self, tmp_path, path):
+        self.submit(_replace, tmp_path, path)
+
+    @staticmethod
+    def _write_safetensors(tensors, path, metadata):
+        save_file(tensors, path + ".tmp", metadata=metadata)
+        _fsync_replace(path + ".tmp", path)
+
+    @staticmethod
+    def _write_torch(obj, path):
+        torch.save(obj, path + ".tmp")
+        _fsync_replace(path + ".tmp", path)
+
+    def wait(self):
+        """Blocks until every submitted write is done; re-raises the first failure."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
@@ -18,7 +18,6 @@ import os
 import copy
 from dataclasses import dataclass, field
 import json
-import logging
 import pathlib
 from typing import Dict, Optional, Sequence, List
 
@@ -31,11 +30,14 @@ from llava_phi.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_T
     DEFAULT_IM_END_TOKEN
 from torch.utils.data import Dataset
 from llava_phi.train.llava_phi_trainer import LLaVAPhiTrainer
+from llava_phi.train.zero_state import get_mm_adapter_state_maybe_zero_3, get_peft_state_maybe_zero_3, \
+    get_peft_state_non_lora_maybe_zero_3, save_state_shards
 
 from llava_phi import conversation as conversation_lib
 from llava_phi.model import *
 from llava_phi.mm_utils import tokenizer_image_token
 from transformers import CLIPVisionConfig, CLIPImageProcessor
+from transformers.integrations import is_deepspeed_zero3_enabled
 
 from PIL import Image
 
@@ -117,60 +119,6 @@ class TrainingArguments(transformers.TrainingArguments):
     group_by_modality_length: bool = field(default=False)
 
 
-def maybe_zero_3(param, ignore_status=False, name=None):
-    from deepspeed import zero
-    from deepspeed.runtime.zero.partition_parameters import ZeroParamStatus
-    if hasattr(param, "ds_id"):
-        if param.ds_status == ZeroParamStatus.NOT_AVAILABLE:
-            if not ignore_status:
-                logging.warning(f"{name}: param.ds_status != ZeroParamStatus.NOT_AVAILABLE: {param.ds_status}")
-        with zero.GatheredParameters([param]):
-            param = param.data.detach().cpu().clone()
-    else:
-        param = param.detach().cpu().clone()
-    return param
-
-
-# Borrowed from peft.utils.get_peft_model_state_dict
-def get_peft_state_maybe_zero_3(named_params, bias):
-    if bias == "none":
-        to_return = {k: t for k, t in named_params if "lora_" in k}
-    elif bias == "all":
-        to_return = {k: t for k, t in named_params if "lora_" in k or "bias" in k}
-    elif bias == "lora_only":
-        to_return = {}
-        maybe_lora_bias = {}
-        lora_bias_names = set()
-        for k, t in named_params:
-            if "lora_" in k:
-                to_return[k] = t
-                bias_name = k.split("lora_")[0] + "bias"
-                lora_bias_names.add(bias_name)
-            elif "bias" in k:
-                maybe_lora_bias[k] = t
-        for k, t in maybe_lora_bias:
-            if bias_name in lora_bias_names:
-                to_return[bias_name] = t
-    else:
-        raise NotImplementedError
-    to_return = {k: maybe_zero_3(v, ignore_status=True) for k, v in to_return.items()}
-    return to_return
-
-
-def get_peft_state_non_lora_maybe_zero_3(named_params, require_grad_only=True):
-    to_return = {k: t for k, t in named_params if "lora_" not in k}
-    if require_grad_only:
-        to_return = {k: t for k, t in to_return.items() if t.requires_grad}
-    to_return = {k: maybe_zero_3(v, ignore_status=True).cpu() for k, v in to_return.items()}
-    return to_return
-
-
-def get_mm_adapter_state_maybe_zero_3(named_params, keys_to_match):
-    to_return = {k: t for k, t in named_params if any(key_match in k for key_match in keys_to_match)}
-    to_return = {k: maybe_zero_3(v, ignore_status=True).cpu() for k, v in to_return.items()}
-    return to_return
-
-
 def find_all_linear_names(model):
     cls = torch.nn.Linear
     lora_module_names = set()
@@ -216,6 +164,13 @@ def safe_save_model_for_hf_trainer(trainer: transformers.Trainer,
 
     if trainer.deepspeed:
         torch.cuda.synchronize()
+        if is_deepspeed_zero3_enabled():
+            # gathered bucket by bucket and streamed to disk, never the whole model at once
+            model = trainer.accelerator.unwrap_model(trainer.model)
+            save_state_shards(model.state_dict(keep_vars=True).items(), output_dir, write=trainer.args.should_save)
+            if trainer.args.should_save:
+                model.config.save_pretrained(output_dir)
+            return
         trainer.save_model(output_dir)
         return
 
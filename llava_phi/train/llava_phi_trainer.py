@@ -1,33 +1,38 @@
 import os
+import resource
+import time
+import warnings
+
 import torch
 
 from torch.utils.data import Sampler
 
-from transformers import Trainer
+from transformers import Trainer, TrainerCallback
 from transformers.trainer import (
+    OPTIMIZER_NAME,
+    PREFIX_CHECKPOINT_DIR,
+    SCHEDULER_NAME,
+    TRAINER_STATE_NAME,
+    TRAINING_ARGS_NAME,
     has_length,
 )
+from transformers.trainer_pt_utils import reissue_pt_warnings
+from transformers.utils import logging
 from typing import List, Optional
 
+from llava_phi.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from llava_phi.model.delta_checkpoint import (
+    DELTA_WEIGHTS_NAME,
+    delta_state_dict,
+    is_delta_checkpoint,
+    overlay_delta,
+    save_delta,
+    write_delta_config,
+)
+from llava_phi.profiling import get_profiler
+from llava_phi.train.async_checkpoint import AsyncCheckpointer
 
-def maybe_zero_3(param, ignore_status=False, name=None):
-    from deepspeed import zero
-    from deepspeed.runtime.zero.partition_parameters import ZeroParamStatus
-    if hasattr(param, "ds_id"):
-        if param.ds_status == ZeroParamStatus.NOT_AVAILABLE:
-            if not ignore_status:
-                print(name, 'no ignore status')
-        with zero.GatheredParameters([param]):
-            param = param.data.detach().cpu().clone()
-    else:
-        param = param.detach().cpu().clone()
-    return param
-
-
-def get_mm_adapter_state_maybe_zero_3(named_params, keys_to_match):
-    to_return = {k: t for k, t in named_params if any(key_match in k for key_match in keys_to_match)}
-    to_return = {k: maybe_zero_3(v, ignore_status=True, name=k).cpu() for k, v in to_return.items()}
-    return to_return
+logger = logging.get_logger(__name__)
 
 
 def split_to_even_chunks(indices, lengths, num_chunks):
@@ -132,8 +137,192 @@ class LengthGroupedSampler(Sampler):
 
 
 
+class StageProfilerCallback(TrainerCallback):
+    """Closes a profiling step per optimizer step and writes the stage timings or memory at the end of training."""
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self._optimizer_range = None
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        profiler = get_profiler()
+        if profiler is not None:
+            self._optimizer_range = profiler.range("optimizer_step")
+            self._optimizer_range.__enter__()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        if self._optimizer_range is not None:
+            self._optimizer_range.__exit__(None, None, None)
+            self._optimizer_range = None
+
+    def on_step_end(self, args, state, control, **kwargs):
+        profiler = get_profiler()
+        if profiler is not None:
+            profiler.step()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        profiler = get_profiler()
+        if profiler is not None and state.is_world_process_zero:
+            profiler.save(self.output_path)
+            profiler.print_summary()
+            print(f"Stage profile saved to {self.output_path}")
+
+
+def collect_batch_stats(input_ids, labels, attention_mask, studies):
+    """Token counts of a collated batch, before the image features are spliced in."""
+    return {
+        "samples": input_ids.shape[0],
+        "studies": len(set(studies)),
+        "tokens": int(attention_mask.sum()),
+        "padding_tokens": int(attention_mask.numel() - attention_mask.sum()),
+        "supervised_tokens": int((labels != IGNORE_INDEX).sum()),
+        "image_placeholders": int((input_ids == IMAGE_TOKEN_INDEX).sum()),
+    }
+
+
+def image_tokens_per_placeholder(config):
+    """Length of the fused image feature sequence that replaces each `<image>` token."""
+    vision_config = config.vision_config["vision_tower"]
+    num_tokens = (vision_config["image_size"] // vision_config["patch_size"]) ** 2
+    return num_tokens + (vision_config.get("mm_vision_select_feature") == "cls_patch")
+
+
+class ThroughputCallback(TrainerCallback):
+    """
+    Per-process throughput over each logging window, from the collator's `batch_stats` and step timings.
+
+    Wall time is split into dataloader wait, from the end of one (micro-)step to the arrival
+    of the next batch, and compute, from that arrival to the end of the (micro-)step.  With
+    CUDA, the device is synchronized once per optimizer step, so that queued kernels count as
+    compute.  Time spent logging, evaluating and saving counts as neither.
+    """
+
+    def __init__(self, image_tokens_per_placeholder):
+        self.image_tokens_per_placeholder = image_tokens_per_placeholder
+        self.cuda = torch.cuda.is_available()
+        self._reset_window()
+
+    @staticmethod
+    def _pop_peak_memory():
+        """Peak allocated and reserved bytes since the previous call."""
+        profiler = get_profiler()
+        if hasattr(profiler, "pop_window_peaks"):
+            # the memory profiler resets the peak counter inside its ranges and keeps the window peak
+            return profiler.pop_window_peaks()
+        peaks = torch.cuda.max_memory_allocated(), torch.cuda.max_memory_reserved()
+        torch.cuda.reset_peak_memory_stats()
+        return peaks
+
+    def _reset_window(self):
+        self.totals = {}
+        self.wait_seconds = 0.0
+        self.compute_seconds = 0.0
+        self.steps = 0
+        self._mark = self._window_start = time.perf_counter()
+        if self.cuda:
+            self._pop_peak_memory()
+
+    def add_batch(self, stats):
+        now = time.perf_counter()
+        self.wait_seconds += now - self._mark
+        self._mark = now
+        for key, value in stats.items():
+            self.totals[key] = self.totals.get(key, 0) + value
+
+    def _end_compute(self):
+        now = time.perf_counter()
+        self.compute_seconds += now - self._mark
+        self._mark = now
+
+    def _skip(self, *args, **kwargs):
+        self._mark = time.perf_counter()
+
+    on_evaluate = on_save = _skip
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._reset_window()
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        self._end_compute()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.cuda:
+            torch.cuda.synchronize()
+        self._end_compute()
+        self.steps += 1
+
+    def metrics(self):
+        elapsed = max(self.wait_seconds + self.compute_seconds, 1e-9)
+        totals = self.totals
+        image_tokens = totals.get("image_placeholders", 0) * self.image_tokens_per_placeholder
+        padded = totals.get("tokens", 0) + totals.get("padding_tokens", 0)
+        logs = {
+            "throughput/samples_per_s": totals.get("samples", 0) / elapsed,
+            "throughput/studies_per_s": totals.get("studies", 0) / elapsed,
+            "throughput/text_tokens_per_s": totals.get("tokens", 0) / elapsed,
+            "throughput/supervised_tokens_per_s": totals.get("supervised_tokens", 0) / elapsed,
+            "throughput/image_tokens_per_s": image_tokens / elapsed,
+            "throughput/padding_ratio": totals.get("padding_tokens", 0) / padded if padded else 0.0,
+            "throughput/dataloader_wait_frac": self.wait_seconds / elapsed,
+            "throughput/dataloader_wait_ms_per_step": 1000 * self.wait_seconds / max(self.steps, 1),
+            "throughput/compute_ms_per_step": 1000 * self.compute_seconds / max(self.steps, 1),
+        }
+        if self.cuda:
+            peak_allocated, peak_reserved = self._pop_peak_memory()
+            logs["throughput/peak_memory_allocated_gb"] = peak_allocated / 2 ** 30
+            logs["throughput/peak_memory_reserved_gb"] = peak_reserved / 2 ** 30
+        else:
+            # ru_maxrss is in KiB on Linux and covers the whole process lifetime
+            logs["throughput/peak_rss_gb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 20
+        self._reset_window()
+        return {key: round(value, 4) for key, value in logs.items()}
+
+
 class LLaVAPhiTrainer(Trainer):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.throughput = None
+        if getattr(self.args, "log_throughput", False):
+            self.throughput = ThroughputCallback(image_tokens_per_placeholder(self.model.config))
+            self.add_callback(self.throughput)
+        self.async_checkpointer = None
+        self.delta_checkpoint = getattr(self.args, "delta_checkpoint", False)
+        self._async_saving = False
+        self._deferred_rotation = None
+        if self.is_deepspeed_enabled or self.is_fsdp_enabled:
+            if self.delta_checkpoint or getattr(self.args, "async_checkpoint", False):
+                logger.warning("--async_checkpoint/--delta_checkpoint are ignored with DeepSpeed/FSDP, "
+                               "which write their own sharded checkpoints")
+            self.delta_checkpoint = False
+        elif getattr(self.args, "async_checkpoint", False):
+            self.async_checkpointer = AsyncCheckpointer()
+
+    def train(self, *args, **kwargs):
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            if self.async_checkpointer is not None:
+                self.async_checkpointer.wait()
+
+    def _prepare_inputs(self, inputs):
+        # image decode time measured in the dataloader workers, not a model input
+        decode_seconds = inputs.pop("image_decode_seconds", None)
+        if decode_seconds is not None and get_profiler() is not None:
+            get_profiler().add("image_decode", decode_seconds)
+        batch_stats = inputs.pop("batch_stats", None)
+        if batch_stats is not None and self.throughput is not None:
+            self.throughput.add_batch(batch_stats)
+        return super()._prepare_inputs(inputs)
+
+    def log(self, logs, *args, **kwargs):
+        profiler = get_profiler()
+        if profiler is not None and "loss" in logs:
+            logs.update(profiler.log_metrics())
+        if self.throughput is not None and "loss" in logs:
+            logs.update(self.throughput.metrics())
+        super().log(logs, *args, **kwargs)
+
     def _get_train_sampler(self,dataset) -> Optional[torch.utils.data.Sampler]:
         if self.train_dataset is None or not has_length(self.train_dataset):
             return None
@@ -152,7 +341,83 @@ class LLaVAPhiTrainer(Trainer):
 
 
     def _save_checkpoint(self, model, trial, metrics=None):
-        super(LLaVAPhiTrainer, self)._save_checkpoint(model, trial)
+        if self.async_checkpointer is None:
+            super(LLaVAPhiTrainer, self)._save_checkpoint(model, trial)
+            return
+
+        # the host buffers are reused, so the previous checkpoint has to be on disk first
+        start = time.perf_counter()
+        self.async_checkpointer.wait()
+        waited = time.perf_counter() - start
+        self.async_checkpointer.snapshot_seconds = 0.0
+        self._async_saving = True
+        try:
+            super(LLaVAPhiTrainer, self)._save_checkpoint(model, trial)
+        finally:
+            self._async_saving = False
+        if not self.args.should_save:
+            return
+
+        output_dir = os.path.join(self._get_output_dir(trial=trial), f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+        # trainer_state.json goes in last, marking the checkpoint complete for `last_complete_checkpoint`
+        state_file = os.path.join(output_dir, TRAINER_STATE_NAME)
+        os.replace(state_file, state_file + ".tmp")
+        self.async_checkpointer.rename_when_written(state_file + ".tmp", state_file)
+        if self._deferred_rotation is not None:
+            self.async_checkpointer.submit(super(LLaVAPhiTrainer, self)._rotate_checkpoints, *self._deferred_rotation)
+            self._deferred_rotation = None
+        logger.info(f"Checkpoint {output_dir}: waited {waited:.2f}s for the previous write, "
+                    f"snapshot {self.async_checkpointer.snapshot_seconds:.2f}s, writing in the background")
+
+    def _load_from_checkpoint(self, resume_from_checkpoint, model=None):
+        if is_delta_checkpoint(resume_from_checkpoint):
+            overlay_delta(self.accelerator.unwrap_model(model or self.model), resume_from_checkpoint)
+            return
+        super(LLaVAPhiTrainer, self)._load_from_checkpoint(resume_from_checkpoint, model)
+
+    def _load_best_model(self):
+        if self.async_checkpointer is not None:
+            self.async_checkpointer.wait()
+        if is_delta_checkpoint(self.state.best_model_checkpoint):
+            overlay_delta(self.accelerator.unwrap_model(self.model), self.state.best_model_checkpoint)
+            return
+        super(LLaVAPhiTrainer, self)._load_best_model()
+
+    def _rotate_checkpoints(self, use_mtime=False, output_dir=None):
+        if self._async_saving:
+            # never delete an older checkpoint before the new one is written
+            self._deferred_rotation = (use_mtime, output_dir)
+            return
+        super(LLaVAPhiTrainer, self)._rotate_checkpoints(use_mtime=use_mtime, output_dir=output_dir)
 
     def _save(self, output_dir: Optional[str] = None, state_dict=None):
+        if not (self._async_saving or self.delta_checkpoint):
             super(LLaVAPhiTrainer, self)._save(output_dir, state_dict)
+            return
+
+        # trainable parameters and the fusion head only, overlaid on the base checkpoint when loading
+        output_dir = output_dir if output_dir is not None else self.args.output_dir
+        model = self.accelerator.unwrap_model(self.model)
+        if self._async_saving:
+            os.makedirs(output_dir, exist_ok=True)
+            delta = delta_state_dict(model)
+            self.async_checkpointer.save_tensors("model", delta, os.path.join(output_dir, DELTA_WEIGHTS_NAME),
+                                                 metadata={"format": "pt"})
+            write_delta_config(output_dir, model, delta)
+            model.config.save_pretrained(output_dir)
+        else:
+            save_delta(model, output_dir)
+        if self.processing_class is not None:
+            self.processing_class.save_pretrained(output_dir)
+        torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
+
+    def _save_optimizer_and_scheduler(self, output_dir):
+        if not (self._async_saving and self.args.should_save):
+            super(LLaVAPhiTrainer, self)._save_optimizer_and_scheduler(output_dir)
+            return
+
+        self.async_checkpointer.save_object("optimizer", self.optimizer.state_dict(),
+                                            os.path.join(output_dir, OPTIMIZER_NAME))
+        with warnings.catch_warnings(record=True) as caught_warnings:
+            torch.save(self.lr_scheduler.state_dict(), os.path.join(output_dir, SCHEDULER_NAME))
+        reissue_pt_warnings(caught_warnings)
@@ -19,8 +19,7 @@ import os
 import copy
 from dataclasses import dataclass, field
 import json
-import logging
-import pathlib
+import time
 from typing import Dict, Optional, Sequence, List
 
 import torch
@@ -31,12 +30,19 @@ from llava_phi.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_T
     DEFAULT_IM_END_TOKEN
 from torch.utils.data import Dataset
 from llava_phi.train.llava_phi_trainer import LLaVAPhiTrainer
+from llava_phi.train.zero_state import get_peft_state_maybe_zero_3, get_peft_state_non_lora_maybe_zero_3, \
+    save_state_shards
 
 from llava_phi import conversation as conversation_lib
 from llava_phi.model import *
 from llava_phi.mm_utils import tokenizer_image_token
+from llava_phi.model.activation_checkpointing import configure_activation_checkpointing
+from llava_phi.data.build_manifests import ManifestReader
+from llava_phi.profiling import enable_profiling, get_profiler
+from llava_phi.train.async_checkpoint import last_complete_checkpoint
+from llava_phi.train.llava_phi_trainer import StageProfilerCallback, collect_batch_stats
 from transformers import CLIPVisionConfig, CLIPImageProcessor
-from dualViewScripts.compute import compute_metrics
+from transformers.integrations import is_deepspeed_zero3_enabled
 from PIL import Image
 
 local_rank = None
@@ -114,60 +120,58 @@ class TrainingArguments(transformers.TrainingArguments):
     lora_bias: str = "none"
     mm_projector_lr: Optional[float] = None
     group_by_modality_length: bool = field(default=False)
-
-
-def maybe_zero_3(param, ignore_status=False, name=None):
-    from deepspeed import zero
-    from deepspeed.runtime.zero.partition_parameters import ZeroParamStatus
-    if hasattr(param, "ds_id"):
-        if param.ds_status == ZeroParamStatus.NOT_AVAILABLE:
-            if not ignore_status:
-                logging.warning(f"{name}: param.ds_status != ZeroParamStatus.NOT_AVAILABLE: {param.ds_status}")
-        with zero.GatheredParameters([param]):
-            param = param.data.detach().cpu().clone()
-    else:
-        param = param.detach().cpu().clone()
-    return param
-
-
-# Borrowed from peft.utils.get_peft_model_state_dict
-def get_peft_state_maybe_zero_3(named_params, bias):
-    if bias == "none":
-        to_return = {k: t for k, t in named_params if "lora_" in k}
-    elif bias == "all":
-        to_return = {k: t for k, t in named_params if "lora_" in k or "bias" in k}
-    elif bias == "lora_only":
-        to_return = {}
-        maybe_lora_bias = {}
-        lora_bias_names = set()
-        for k, t in named_params:
-            if "lora_" in k:
-                to_return[k] = t
-                bias_name = k.split("lora_")[0] + "bias"
-                lora_bias_names.add(bias_name)
-            elif "bias" in k:
-                maybe_lora_bias[k] = t
-        for k, t in maybe_lora_bias:
-            if bias_name in lora_bias_names:
-                to_return[bias_name] = t
-    else:
-        raise NotImplementedError
-    to_return = {k: maybe_zero_3(v, ignore_status=True) for k, v in to_return.items()}
-    return to_return
-
-
-def get_peft_state_non_lora_maybe_zero_3(named_params, require_grad_only=True):
-    to_return = {k: t for k, t in named_params if "lora_" not in k}
-    if require_grad_only:
-        to_return = {k: t for k, t in to_return.items() if t.requires_grad}
-    to_return = {k: maybe_zero_3(v, ignore_status=True).cpu() for k, v in to_return.items()}
-    return to_return
-
-
-def get_mm_adapter_state_maybe_zero_3(named_params, keys_to_match):
-    to_return = {k: t for k, t in named_params if any(key_match in k for key_match in keys_to_match)}
-    to_return = {k: maybe_zero_3(v, ignore_status=True).cpu() for k, v in to_return.items()}
-    return to_return
+    vision_checkpoint_every: int = field(
+        default=0,
+        metadata={"help": "Recompute CLIP encoder layers 0, k, 2k, ... in backward (1 = every layer, 0 = none); "
+                          "see llava_phi/model/activation_checkpointing.py."}
+    )
+    fusion_checkpoint: bool = field(
+        default=False,
+        metadata={"help": "Recompute the fusion head (cross-attention, gate, projector) in backward."}
+    )
+    activation_offload: str = field(
+        default="",
+        metadata={"help": "Comma-separated regions (vision_tower, fusion) whose saved activations are kept "
+                          "in host memory."}
+    )
+    async_checkpoint: bool = field(
+        default=False,
+        metadata={"help": "Snapshot checkpoints to host memory and write them as deltas on a background thread."}
+    )
+    delta_checkpoint: bool = field(
+        default=False,
+        metadata={"help": "Save checkpoints and the final model as trainable parameters + fusion head over the "
+                          "base checkpoint; see llava_phi/model/delta_checkpoint.py."}
+    )
+    log_throughput: bool = field(
+        default=False,
+        metadata={"help": "Log samples/s, tokens/s, padding, dataloader wait and peak memory with the loss."}
+    )
+    profile_stages: bool = field(
+        default=False,
+        metadata={"help": "Time the dual-view forward stages per step; see llava_phi/profiling.py."}
+    )
+    profile_cuda_sync: bool = field(
+        default=True,
+        metadata={"help": "Synchronize CUDA around each profiled stage (only with --profile_stages)."}
+    )
+    profile_memory: bool = field(
+        default=False,
+        metadata={"help": "Record allocator/RSS snapshots per stage and per-module peaks instead of times; "
+                          "see llava_phi/memory_profiler.py."}
+    )
+    profile_memory_depth: int = field(
+        default=3,
+        metadata={"help": "Attribute peak memory to modules named at most this many levels deep."}
+    )
+    profile_memory_history: bool = field(
+        default=False,
+        metadata={"help": "Also record CUDA allocation stacks and dump a snapshot for pytorch.org/memory_viz."}
+    )
+    profile_output: Optional[str] = field(
+        default=None,
+        metadata={"help": "Profile JSON; defaults to <output_dir>/stage_profile.json or memory_profile.json."}
+    )
 
 
 def find_all_linear_names(model):
@@ -190,8 +194,20 @@ def safe_save_model_for_hf_trainer(trainer: transformers.Trainer,
                                    output_dir: str):
     """Collects the state dict and dump to disk."""
 
+    if getattr(trainer, "delta_checkpoint", False):
+        # `LLaVAPhiTrainer._save` writes the trainable parameters only; no full state dict needed
+        trainer.save_model(output_dir)
+        return
+
     if trainer.deepspeed:
         torch.cuda.synchronize()
+        if is_deepspeed_zero3_enabled():
+            # gathered bucket by bucket and streamed to disk, never the whole model at once
+            model = trainer.accelerator.unwrap_model(trainer.model)
+            save_state_shards(model.state_dict(keep_vars=True).items(), output_dir, write=trainer.args.should_save)
+            if trainer.args.should_save:
+                model.config.save_pretrained(output_dir)
+            return
         trainer.save_model(output_dir)
         return
 
@@ -475,7 +491,11 @@ class LazySupervisedDataset(Dataset):
                  tokenizer: transformers.PreTrainedTokenizer,
                  data_args: DataArguments):
         super(LazySupervisedDataset, self).__init__()
-        list_data_dict = json.load(open(data_path, "r"))
+        if data_path.endswith(".jsonl"):
+            # manifests from llava_phi.data.build_manifests, read by offset instead of loaded whole
+            list_data_dict = ManifestReader(data_path)
+        else:
+            list_data_dict = json.load(open(data_path, "r"))
 
         rank0_print("Formatting inputs...Skip in lazy mode")
         self.tokenizer = tokenizer
@@ -512,6 +532,8 @@ class LazySupervisedDataset(Dataset):
         image_folder = self.data_args.image_folder
         processor = self.data_args.image_processor
     
+        # timed here and carried in the sample, since dataloader workers have their own profiler
+        decode_start = time.perf_counter() if get_profiler() is not None else None
         if 'frontal' in item and 'lateral' in item:
             # Load both images
             image_paths = [item['frontal'], item['lateral']]
@@ -550,8 +572,11 @@ class LazySupervisedDataset(Dataset):
             data_dict = dict(
                 input_ids=data_dict["input_ids"][0],
                 labels=data_dict["labels"][0],
-                image=image  # shape: [2, C, H, W]
+                image=image,  # shape: [2, C, H, W]
+                study=(item['frontal'], item['lateral'])
             )
+            if decode_start is not None:
+                data_dict["image_decode_seconds"] = time.perf_counter() - decode_start
         return data_dict
 
 
@@ -561,6 +586,7 @@ class DataCollatorForSupervisedDataset(object):
     """Collate examples for supervised fine-tuning."""
 
     tokenizer: transformers.PreTrainedTokenizer
+    with_stats: bool = False
 
     def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
         input_ids, labels = tuple([instance[key] for instance in instances]
@@ -591,6 +617,13 @@ class DataCollatorForSupervisedDataset(object):
             else:
                 batch['images'] = images
 
+        if 'image_decode_seconds' in instances[0]:
+            batch['image_decode_seconds'] = sum(instance['image_decode_seconds'] for instance in instances)
+
+        if self.with_stats:
+            studies = [instance.get('study', i) for i, instance in enumerate(instances)]
+            batch['batch_stats'] = collect_batch_stats(input_ids, labels, batch['attention_mask'], studies)
+
         return batch
 
 class EvalCallback(transformers.TrainerCallback):
@@ -599,7 +632,7 @@ class EvalCallback(transformers.TrainerCallback):
         print(kwargs.get("metrics", {}))
         
 def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer,
-                                data_args) -> Dict:
+                                data_args, with_stats=False) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
     train_dataset = LazySupervisedDataset(tokenizer=tokenizer,
                                           data_path=data_args.data_path,
@@ -607,7 +640,7 @@ def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer,
 
 
 
-    data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
+    data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer, with_stats=with_stats)
     return dict(train_dataset=train_dataset,
                 eval_dataset=None,
                 data_collator=data_collator)
@@ -741,6 +774,11 @@ def train():
         for p in model.get_model().vision_tower.parameters():
             p.requires_grad = True
 
+    if training_args.vision_checkpoint_every or training_args.fusion_checkpoint or training_args.activation_offload:
+        configure_activation_checkpointing(model, vision_every=training_args.vision_checkpoint_every,
+                                           fusion=training_args.fusion_checkpoint,
+                                           offload=[r for r in training_args.activation_offload.split(",") if r])
+
     if training_args.bits in [4, 8]:
         model.get_model().mm_projector.to(dtype=compute_dtype, device=training_args.device)
 
@@ -768,8 +806,16 @@ def train():
         if not os.path.exists(data_args.eval_data_path):
             raise FileNotFoundError(f"Eval data not found at {data_args.eval_data_path}")
             
+    if training_args.profile_memory:
+        profiler = enable_profiling(memory=True, record_history=training_args.profile_memory_history,
+                                    max_depth=training_args.profile_memory_depth)
+        profiler.attach(model.get_base_model() if hasattr(model, "get_base_model") else model)
+    elif training_args.profile_stages:
+        # before the dataloader workers fork, so they carry image decode times
+        enable_profiling(cuda_sync=training_args.profile_cuda_sync and torch.cuda.is_available())
     data_module = make_supervised_data_module(tokenizer=tokenizer,
-                                              data_args=data_args)
+                                              data_args=data_args,
+                                              with_stats=training_args.log_throughput)
     
    
     
@@ -777,10 +823,15 @@ def train():
                               tokenizer=tokenizer,
                               args=training_args,
                               **data_module)
+    if training_args.profile_stages or training_args.profile_memory:
+        default_name = "memory_profile.json" if training_args.profile_memory else "stage_profile.json"
+        trainer.add_callback(StageProfilerCallback(
+            training_args.profile_output or os.path.join(training_args.output_dir, default_name)))
 
 
-    if list(pathlib.Path(training_args.output_dir).glob("checkpoint-*")):
-        trainer.train(resume_from_checkpoint=True)
+    last_checkpoint = last_complete_checkpoint(training_args.output_dir)
+    if last_checkpoint:
+        trainer.train(resume_from_checkpoint=last_checkpoint)
     else:
         trainer.train()
 
@@ -0,0 +1,119 @@
+"""
+Host copies of model state that may be partitioned by DeepSpeed ZeRO-3, for saving.
+
+Gathering one parameter at a time costs one `zero.GatheredParameters` context, and so one
+all-gather, per tensor.  Here parameters are grouped into buckets of at most `bucket_bytes`
+(full, unpartitioned size).  Each bucket is gathered in one context, and each tensor is
+copied to the host once.  With `save_state_shards`, each bucket also becomes a safetensors
+shard written before the next bucket is gathered.  Peak host and device memory is then
+one bucket rather than the whole model.
+
+Every rank has to run the gathers, because they are collective; only ranks with `write=True`
+save.  `zero` defaults to `deepspeed.zero`, imported when a ZeRO-3 parameter is first seen.
+Any object with a `GatheredParameters(params)` context manager can stand in for it.
+"""
+import contextlib
+import json
+import os
+
+from safetensors.torch import save_file
+
+DEFAULT_BUCKET_BYTES = 512 * 2 ** 20
+WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+
+
+def is_zero3_param(param):
+    return hasattr(param, "ds_id")
+
+
+def _full_nbytes(param):
+    numel = param.ds_numel if is_zero3_param(param) else param.numel()
+    return numel * param.element_size()
+
+
+def _gather_bucket(bucket, zero):
+    params = list({id(p): p for _, p in bucket if is_zero3_param(p)}.values())
+    if params and zero is None:
+        from deepspeed import zero
+    with zero.GatheredParameters(params) if params else contextlib.nullcontext():
+        # one device-to-host copy; `.cpu().clone()` would copy CPU tensors twice
+        return {name: p.data.detach().to("cpu", copy=True) for name, p in bucket}
+
+
+def iter_gathered_buckets(named_params, bucket_bytes=DEFAULT_BUCKET_BYTES, zero=None):
+    """Yields `{name: cpu tensor}` dicts, one per bucket of at most `bucket_bytes` (or one oversized tensor)."""
+    bucket, size = [], 0
+    for name, param in named_params:
+        nbytes = _full_nbytes(param)
+        if bucket and size + nbytes > bucket_bytes:
+            yield _gather_bucket(bucket, zero)
+            bucket, size = [], 0
+        bucket.append((name, param))
+        size += nbytes
+    if bucket:
+        yield _gather_bucket(bucket, zero)
+
+
+def gather_state_dict(named_params, bucket_bytes=DEFAULT_BUCKET_BYTES, zero=None):
+    state_dict = {}
+    for bucket in iter_gathered_buckets(named_params, bucket_bytes, zero):
+        state_dict.update(bucket)
+    return state_dict
+
+
+def save_state_shards(named_params, output_dir, write=True, bucket_bytes=DEFAULT_BUCKET_BYTES, zero=None):
+    """
+    Writes one `model-XXXXX.safetensors` shard per bucket and a `model.safetensors.index.json`
+    in the layout `from_pretrained` reads.
+    """
+    if write:
+        os.makedirs(output_dir, exist_ok=True)
+    weight_map, total_size = {}, 0
+    for i, bucket in enumerate(iter_gathered_buckets(named_params, bucket_bytes, zero)):
+        if not write:
+            continue
+        shard_file = f"model-{i + 1:05d}.safetensors"
+        save_file(bucket, os.path.join(output_dir, shard_file), metadata={"format": "pt"})
+        weight_map.update({name: shard_file for name in bucket})
+        total_size += sum(t.numel() * t.element_size() for t in bucket.values())
+    if write:
+        with open(os.path.join(output_dir, WEIGHTS_INDEX_NAME), "w") as f:
+            json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, f, indent=2)
+    return weight_map
+
+
+# Borrowed from peft.utils.get_peft_model_state_dict
+def get_peft_state_maybe_zero_3(named_params, bias, zero=None):
+    if bias == "none":
+        to_return = {k: t for k, t in named_params if "lora_" in k}
+    elif bias == "all":
+        to_return = {k: t for k, t in named_params if "lora_" in k or "bias" in k}
+    elif bias == "lora_only":
+        to_return = {}
+        maybe_lora_bias = {}
+        lora_bias_names = set()
+        for k, t in named_params:
+            if "lora_" in k:
+                to_return[k] = t
+                bias_name = k.split("lora_")[0] + "bias"
+                lora_bias_names.add(bias_name)
+            elif "bias" in k:
+                maybe_lora_bias[k] = t
+        for k, t in maybe_lora_bias.items():
+            if k in lora_bias_names:
+                to_return[k] = t
+    else:
+        raise NotImplementedError
+    return gather_state_dict(to_return.items(), zero=zero)
+
+
+def get_peft_state_non_lora_maybe_zero_3(named_params, require_grad_only=True, zero=None):
+    to_return = {k: t for k, t in named_params if "lora_" not in k}
+    if require_grad_only:
+        to_return = {k: t for k, t in to_return.items() if t.requires_grad}
+    return gather_state_dict(to_return.items(), zero=zero)
+
+
+def get_mm_adapter_state_maybe_zero_3(named_params, keys_to_match, zero=None):
+    to_return = {k: t for k, t in named_params if any(key_match in k for key_match in keys_to_match)}
+    return gather_state_dict(to_return.items(), zero=zero)
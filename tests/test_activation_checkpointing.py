@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+from benchmarks.bench_activation_checkpointing import make_batch
+from benchmarks.tiny_model import build_tiny_model
+from llava_phi.model.activation_checkpointing import configure_activation_checkpointing
+
+VISION_LAYERS = 5
+BATCH_SIZE = 2
+# the tower returns the second-to-last hidden state, so the last layer gets no backward
+TRAINED_LAYERS = VISION_LAYERS - 1
+
+
+def run_step(policy=None, gradient_checkpointing=False):
+    """Gradients of one training step and the forward calls per CLIP layer made during backward."""
+    model = build_tiny_model(vision_layers=VISION_LAYERS)
+    model.train()
+    model.requires_grad_(True)
+    if policy is not None:
+        configure_activation_checkpointing(model, **policy)
+    if gradient_checkpointing:
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+
+    in_backward = False
+    recomputed = [0] * VISION_LAYERS
+    layers = model.get_model().get_vision_tower().vision_model.encoder.layers
+    for i, layer in enumerate(layers):
+        def count(module, inputs, i=i):
+            if in_backward:
+                recomputed[i] += 1
+        layer.register_forward_pre_hook(count)
+
+    torch.manual_seed(1)
+    loss = model(**make_batch(model, BATCH_SIZE, 32, "cpu")).loss
+    in_backward = True
+    loss.backward()
+    grads = {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+    return grads, recomputed
+
+
+@pytest.fixture(scope="module")
+def reference_grads():
+    grads, recomputed = run_step()
+    assert recomputed == [0] * VISION_LAYERS
+    return grads
+
+
+@pytest.mark.parametrize("policy, expected", [
+    (dict(vision_every=1), [0, 1, 2, 3]),
+    (dict(vision_every=2), [0, 2]),
+    (dict(vision_every=3, fusion=True), [0, 3]),
+    (dict(offload=("vision_tower", "fusion")), []),
+    (dict(vision_every=2, offload=("vision_tower",)), [0, 2]),
+])
+@pytest.mark.parametrize("gradient_checkpointing", [False, True])
+def test_vision_policy_recomputes_chosen_layers(reference_grads, policy, expected, gradient_checkpointing):
+    grads, recomputed = run_step(policy, gradient_checkpointing)
+    # the CLIP tower follows the policy whether or not the backbone is checkpointed; each view
+    # of each study goes through the tower separately
+    assert recomputed[:TRAINED_LAYERS] == [2 * BATCH_SIZE if i in expected else 0 for i in range(TRAINED_LAYERS)]
+    assert grads.keys() == reference_grads.keys()
+    for name, grad in grads.items():
+        torch.testing.assert_close(grad, reference_grads[name], rtol=1e-5, atol=1e-6)
@@ -0,0 +1,55 @@
+import pytest
+import torch
+
+from benchmarks.tiny_model import build_tiny_model, tiny_tokenizer
+from llava_phi.constants import IMAGE_TOKEN_INDEX
+from llava_phi.serve.batch_scheduler import ContinuousBatchScheduler, GenerationRequest
+
+MAX_NEW_TOKENS = 40
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return tiny_tokenizer()
+
+
+@pytest.fixture(scope="module")
+def model(tokenizer):
+    return build_tiny_model(vocab_size=len(tokenizer)).eval()
+
+
+def make_request(model, **kwargs):
+    image_size = model.config.vision_config["vision_tower"]["image_size"]
+    generator = torch.Generator().manual_seed(0)
+    return GenerationRequest(torch.tensor([5, IMAGE_TOKEN_INDEX, 7, 9]),
+                             torch.randn(2, 3, image_size, image_size, generator=generator),
+                             max_new_tokens=MAX_NEW_TOKENS, **kwargs)
+
+
+def run(scheduler, requests):
+    for request in requests:
+        scheduler.submit(request)
+    while scheduler.queue_length:
+        scheduler.step()
+
+
+def test_stop_string_spanning_many_tokens(model, tokenizer):
+    scheduler = ContinuousBatchScheduler(model, tokenizer)
+    reference = make_request(model)
+    run(scheduler, [reference])
+    assert reference.finish_reason == "length"
+
+    def decode(ids):
+        return tokenizer.decode(ids, skip_special_tokens=True)
+
+    # a stop string covering output tokens 3..14
+    stop_str = decode(reference.output_ids[:15])[len(decode(reference.output_ids[:3])):]
+    expected_len = next(n for n in range(1, MAX_NEW_TOKENS + 1) if stop_str in decode(reference.output_ids[:n]))
+    assert expected_len - 3 > 8
+
+    stopped, plain = make_request(model, stop_str=stop_str), make_request(model)
+    run(scheduler, [stopped, plain])
+    assert stopped.finish_reason == "stop"
+    assert stopped.output_ids == reference.output_ids[:expected_len]
+    assert plain.finish_reason == "length"
+    assert plain.output_ids == reference.output_ids
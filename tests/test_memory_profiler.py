@@ -0,0 +1,43 @@
+import torch
+
+from llava_phi.memory_profiler import MemoryProfiler
+
+MB = 2 ** 20
+
+
+def test_cpu_ranges_see_temporaries_and_nested_peaks():
+    profiler = MemoryProfiler(device="cpu")
+    x = torch.empty(MB, dtype=torch.uint8)  # created outside any range: not counted
+    with profiler.range("outer"):
+        y = x + 1  # 1 MB kept
+        with profiler.range("inner"):
+            tmp = torch.empty(4 * MB, dtype=torch.uint8)  # 4 MB freed inside the range
+            del tmp
+            view = y.view(-1)  # no new storage
+        tmp = torch.empty(2 * MB, dtype=torch.uint8)
+        del tmp
+    profiler.step()
+
+    outer, = profiler.history["outer"]
+    inner, = profiler.history["inner"]
+    assert (outer["allocated_before"], outer["allocated_after"]) == (0, MB)
+    assert outer["peak"] == inner["peak"] == 5 * MB
+    assert (inner["allocated_before"], inner["allocated_after"]) == (MB, MB)
+
+    del y, view
+    assert profiler.cpu_tracker.live == 0
+    assert profiler.pop_window_peaks() == (5 * MB, 0)
+
+
+def test_cpu_module_hooks_report_peak_increase():
+    profiler = MemoryProfiler(device="cpu", max_depth=1)
+    model = torch.nn.Sequential(torch.nn.Linear(256, 1024), torch.nn.ReLU(), torch.nn.Linear(1024, 8))
+    profiler.attach(model)
+    with torch.no_grad():
+        model(torch.randn(64, 256))
+    profiler.detach()
+
+    hidden_bytes = 64 * 1024 * 4
+    assert profiler.modules["0"]["peak_increase_bytes"] == hidden_bytes
+    assert profiler.modules["0"]["output_bytes"] == hidden_bytes
+    assert profiler.modules["2"]["peak_increase_bytes"] == 64 * 8 * 4
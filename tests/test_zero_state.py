@@ -0,0 +1,90 @@
+import contextlib
+import json
+import os
+
+import torch
+from safetensors.torch import load_file
+
+from benchmarks.tiny_model import build_tiny_model
+from llava_phi.train.zero_state import WEIGHTS_INDEX_NAME, gather_state_dict, get_peft_state_maybe_zero_3, \
+    save_state_shards
+
+
+class StubZero:
+    """Stands in for `deepspeed.zero`: partitioned parameters hold an empty tensor until gathered."""
+
+    def __init__(self):
+        self.full = {}
+        self.gathers = []
+
+    def partition(self, model):
+        for param in model.parameters():
+            param.ds_id = len(self.full)
+            param.ds_numel = param.numel()
+            self.full[param.ds_id] = param.data
+            param.data = torch.empty(0, dtype=param.dtype)
+
+    @contextlib.contextmanager
+    def GatheredParameters(self, params):
+        self.gathers.append(len(params))
+        for param in params:
+            param.data = self.full[param.ds_id]
+        try:
+            yield
+        finally:
+            for param in params:
+                param.data = torch.empty(0, dtype=param.dtype)
+
+
+def partitioned_tiny_model():
+    model = build_tiny_model()
+    reference = {name: t.detach().clone() for name, t in model.state_dict().items()}
+    zero = StubZero()
+    zero.partition(model)
+    return model, reference, zero
+
+
+def test_save_state_shards_round_trip(tmp_path):
+    model, reference, zero = partitioned_tiny_model()
+    bucket_bytes = 2 ** 20
+    weight_map = save_state_shards(model.state_dict(keep_vars=True).items(), str(tmp_path),
+                                   bucket_bytes=bucket_bytes, zero=zero)
+
+    assert len(zero.gathers) > 1
+    assert all(param.numel() == 0 for param in model.parameters())
+    with open(os.path.join(tmp_path, WEIGHTS_INDEX_NAME)) as f:
+        assert json.load(f)["weight_map"] == weight_map
+    loaded = {}
+    for shard_file in sorted(set(weight_map.values())):
+        shard = load_file(os.path.join(tmp_path, shard_file))
+        assert sum(t.numel() * t.element_size() for t in shard.values()) <= bucket_bytes or len(shard) == 1
+        loaded.update(shard)
+    assert loaded.keys() == reference.keys()
+    assert all(torch.equal(loaded[name], reference[name]) for name in reference)
+
+
+def test_save_state_shards_only_writes_on_write_ranks(tmp_path):
+    model, _, zero = partitioned_tiny_model()
+    save_state_shards(model.state_dict(keep_vars=True).items(), str(tmp_path / "out"), write=False,
+                      bucket_bytes=2 ** 20, zero=zero)
+    # the gathers are collective, so every rank runs them
+    assert zero.gathers
+    assert not os.path.exists(tmp_path / "out")
+
+
+def test_gather_state_dict_without_zero3_params():
+    model = torch.nn.Linear(4, 4)
+    state_dict = gather_state_dict(model.named_parameters())
+    assert torch.equal(state_dict["weight"], model.weight.detach())
+    assert state_dict["weight"].data_ptr() != model.weight.data_ptr()
+
+
+def test_peft_state_lora_only_keeps_biases_of_lora_layers():
+    named_params = [
+        ("q_proj.lora_A.weight", torch.zeros(2, 4)),
+        ("q_proj.lora_B.weight", torch.zeros(4, 2)),
+        ("q_proj.bias", torch.ones(4)),
+        ("k_proj.bias", torch.ones(4)),
+    ]
+    state_dict = get_peft_state_maybe_zero_3(named_params, "lora_only")
+    assert sorted(state_dict) == ["q_proj.bias", "q_proj.lora_A.weight", "q_proj.lora_B.weight"]